@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# 大きなメールの再検査（-f 相当）の所要時間とピークメモリの測定
+#   1 / 10 / 50 MB の SMTP通信記録（本文 + base64添付 + quoted-printable）を作成し、
+#   -f と同じ読み込み・デコード（smtpfile_chunks → decode_chunks）と judge_spam を
+#   別プロセスで 1回ずつ実行する
+#   peak_mb はルール読み込み後からの VmHWM の増分
+#
+#   python3 bench/bench_large_mail.py [-s 1,10,50] [-r repeat]
+#
+
+import os
+import sys
+import json
+import base64
+import getopt
+import quopri
+import tempfile
+import subprocess
+
+import benchlib
+
+CHILD = r"""
+import sys, time, json
+import content_filter as cf
+cf.G.IS_DAEMON = False
+cf.loadcheck_spam_dat()
+base = benchlib.proc_status(os.getpid())["VmHWM"]
+t0 = time.perf_counter()
+if hasattr(cf, "smtpfile_chunks"):
+    dec, msg_id = cf.decode_chunks(cf.smtpfile_chunks(sys.argv[1]))
+else:   # 旧版との比較用
+    dec, msg_id = cf.decode_mail(cf.load_smtpfile(sys.argv[1]))
+v = cf.judge_spam(dec)
+sec = time.perf_counter() - t0
+print(json.dumps(dict(sec=sec, peak_kb=benchlib.proc_status(os.getpid())["VmHWM"] - base,
+                      dec_mb=len(dec) / 1e6, kind=v.kind)))
+"""
+
+def gen_transcript(path, size):
+    bnd = b"BENCH_BOUNDARY"
+    text = b"Lorem ipsum dolor sit amet, consectetur adipiscing elit 0123456789\r\n"
+    blob = os.urandom(size * 3 // 4 // 4 * 3)
+    qp = quopri.encodestring(("あいう mixed text =\n".encode("utf8") * (size // 8 // 32 + 1)))
+    with open(path, "wb") as f:
+        f.write(b"S: 220 bench.example ESMTP\r\n")
+        for cmd in [b"EHLO bench.example", b"XFORWARD NAME=bench.example ADDR=127.0.0.1",
+                    b"MAIL FROM:<a@bench.example>", b"RCPT TO:<b@bench.example>", b"DATA"]:
+            f.write(b"R: %s\r\nS: 250 ok\r\n" % cmd)
+        f.write(b"R: Received-SPF: pass\r\nMessage-ID: <large@bench.example>\r\n"
+                b"From: a@bench.example\r\nTo: b@bench.example\r\nSubject: large mail\r\n"
+                b"Content-Type: multipart/mixed; boundary=\"%s\"\r\n\r\n" % bnd)
+        f.write(b"--%s\r\nContent-Type: text/plain\r\n\r\n" % bnd)
+        f.write(text * (size // 8 // len(text) + 1))
+        f.write(b"--%s\r\nContent-Type: text/plain\r\nContent-Transfer-Encoding: quoted-printable\r\n\r\n" % bnd)
+        f.write(qp.replace(b"\n", b"\r\n"))
+        f.write(b"--%s\r\nContent-Type: application/octet-stream\r\nContent-Transfer-Encoding: base64\r\n\r\n" % bnd)
+        f.write(base64.encodebytes(blob).replace(b"\n", b"\r\n"))
+        f.write(b"--%s--\r\n.\r\nS: 250 2.0.0 Ok: queued\r\n" % bnd)
+
+def run(size_mb, repeat):
+    with tempfile.TemporaryDirectory(prefix="cfbench_") as tmp:
+        benchlib.write_spam_dat(tmp, DBG=-1, TMP_DIR=os.path.join(tmp, "log"))
+        path = os.path.join(tmp, "smtp_bench.txt")
+        gen_transcript(path, size_mb * 1000 * 1000)
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([tmp, benchlib.ROOT, os.path.dirname(__file__)]))
+        code = "import os, benchlib\n" + CHILD
+        res = []
+        for _ in range(repeat):
+            out = subprocess.run([sys.executable, "-c", code, path], env=env, cwd=tmp, check=True,
+                                 stdout=subprocess.PIPE).stdout
+            res.append(json.loads(out))
+        best = min(res, key=lambda x: x["sec"])
+        return dict(size_mb=size_mb, file_mb=round(os.path.getsize(path) / 1e6, 1),
+                    sec=round(best["sec"], 3), peak_mb=round(max(x["peak_kb"] for x in res) / 1000, 1),
+                    dec_mb=round(best["dec_mb"], 1), kind=best["kind"])
+
+def main():
+    sizes, repeat = [1, 10, 50], 3
+    optlist, _ = getopt.getopt(sys.argv[1:], "s:r:")
+    for key, val in optlist:
+        if key == "-s":
+            sizes = [int(x) for x in val.split(",")]
+        elif key == "-r":
+            repeat = int(val)
+    print(json.dumps([run(x, repeat) for x in sizes], indent=1))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# 実 Postfix を使わない負荷試験（content_filter_core の同時接続時の性能）
+#   DST_ADDR 側 smtpd の代わりに SmtpSink、SRC_ADDR 側 smtpd の代わりに並列のクライアントを使い、
+#   保存された SMTP通信記録（smtp_*.txt。-f）または合成メール（-g）を目標レート（-R）で送信する
+#   サーバ構成（-m）毎に、sessions/sec、DATA終端から応答までの遅延（p50/p95/p99）、
+#   content_filter を通さずに SmtpSink へ直接送った場合からの増分（added_*）、
+#   RSS（子プロセスを含む合計）、セッションあたりの CPU時間を出力
+#
+#   -m の各要素は SERVER_MODE 名に "/名前=値" で spam_dat の設定を追加できる
+#   （例: -m thread,async,async/SCAN_POOL=2,thread/WORKERS=2）
+#   -x で全構成に共通の設定を追加（例: -x CHECK_DATA=[[b"viagra"]]）
+#   -R 0 は目標レートなし（-c の並列数で可能な限り送信）
+#
+#   python3 bench/bench_load.py [-f smtp_files] [-g kinds] [-s size_kb] [-n sessions]
+#                               [-c concurrency] [-R rate] [-m modes] [-x name=value]
+#
+
+import os
+import ast
+import sys
+import glob
+import time
+import json
+import getopt
+import threading
+import collections
+import concurrent.futures
+
+import benchlib
+
+def percentile(ll, p):
+    return ll and ll[min(len(ll) - 1, int(len(ll) * p / 100))] or 0
+
+# 構成の文字列（"async/SCAN_POOL=2"）から spam_dat の設定へ
+def mode_conf(spec):
+    ll = spec.split("/")
+    conf = dict(SERVER_MODE=ll[0])
+    for kv in ll[1:]:
+        k, _, v = kv.partition("=")
+        conf[k] = ast.literal_eval(v)
+    return conf
+
+def load_mails(files, kinds, size):
+    ret = []
+    for arg in files:
+        fl = [arg] if os.path.isfile(arg) else sorted(glob.glob(os.path.join(arg, "**", "smtp_*.txt"), recursive=True)
+                                                      if os.path.isdir(arg) else glob.glob(arg))
+        for fn in fl:
+            try:
+                ret.append(benchlib.load_transcript(fn))
+            except ValueError:
+                pass
+    for i, k in enumerate(kinds):
+        ret.append((None, benchlib.synth_mail(k, size, i)))
+    if not ret:
+        raise Exception("no mails to send")
+    return ret
+
+# 送信（rate が 0 以外なら i 番目のセッションを開始時刻 + i/rate に開始する開ループ）
+def drive(addr, mails, sessions, conc, rate):
+    lat, codes, lock = [], collections.Counter(), threading.Lock()
+
+    def one(i):
+        cmds, mail = mails[i % len(mails)]
+        try:
+            l, ret = benchlib.smtp_session(addr, mail, cmds=cmds)
+        except OSError:
+            ret = b"err"
+        with lock:
+            codes[ret[:1].decode() + "xx" if ret[:1].isdigit() else "err"] += 1
+            if ret[:1] in (b"2", b"5"):
+                lat.append(l)
+
+    late = 0
+    t0 = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(conc) as ex:
+        for i in range(sessions):
+            if rate:
+                d = t0 + i / rate - time.perf_counter()
+                if d > 0:
+                    time.sleep(d)
+                else:
+                    late += d < -0.01
+            ex.submit(one, i)
+    elapsed = time.perf_counter() - t0
+    lat.sort()
+    return dict(sessions=sessions, elapsed=elapsed, lat=lat, codes=dict(codes), late=late)
+
+def report(name, r, base=None):
+    ret = dict(mode=name, sessions=r["sessions"], replies=r["codes"],
+               sessions_per_sec=round(r["sessions"] / r["elapsed"], 1), late_starts=r["late"])
+    for p in (50, 95, 99):
+        ret["p%d_ms" % p] = round(percentile(r["lat"], p) * 1000, 2)
+        if base:
+            ret["added_p%d_ms" % p] = round((percentile(r["lat"], p) - percentile(base["lat"], p)) * 1000, 2)
+    return ret
+
+def run_mode(spec, sink, mails, sessions, conc, rate, extra, base):
+    conf = dict(VERDICT_CACHE=0)
+    conf.update(extra)
+    conf.update(mode_conf(spec))
+    srv = benchlib.CfServer(sink.server_address, **conf)
+    peak = {"VmHWM": 0, "VmRSS": 0, "Threads": 0}
+    running = [True]
+
+    def sampler():
+        while running[0]:
+            st = srv.status()
+            for k in peak:
+                peak[k] = max(peak[k], st[k])
+            time.sleep(0.05)
+    try:
+        drive(srv.addr, mails, min(sessions, 20), min(conc, 4), 0)    # 子プロセス起動等のウォームアップ
+        rss0 = srv.status()["VmRSS"]
+        th = threading.Thread(target=sampler)
+        th.start()
+        cpu0 = srv.cpu()
+        r = drive(srv.addr, mails, sessions, conc, rate)
+        cpu = srv.cpu() - cpu0
+        running[0] = False
+        th.join()
+    finally:
+        running[0] = False
+        srv.stop()
+    ret = report(spec, r, base)
+    ret.update(cpu_ms_per_session=round(cpu / sessions * 1000, 3), rss_start_mb=round(rss0 / 1024, 1),
+               rss_peak_mb=round(peak["VmRSS"] / 1024, 1), threads_peak=peak["Threads"])
+    return ret
+
+def main():
+    files, kinds, size = [], [], 16
+    sessions, conc, rate = 1000, 20, 0
+    modes, extra = ["thread", "async"], {}
+    optlist, args = getopt.getopt(sys.argv[1:], "f:g:s:n:c:R:m:x:")
+    for key, val in optlist:
+        if key == "-f":
+            files.append(val)
+        elif key == "-g":
+            kinds = val.split(",")
+        elif key == "-s":
+            size = int(val)
+        elif key == "-n":
+            sessions = int(val)
+        elif key == "-c":
+            conc = int(val)
+        elif key == "-R":
+            rate = float(val)
+        elif key == "-m":
+            modes = val.split(",")
+        elif key == "-x":
+            k, _, v = val.partition("=")
+            extra[k] = ast.literal_eval(v)
+    if not files and not kinds:
+        kinds = ["plain", "multipart"]
+    mails = load_mails(files, kinds, size * 1024)
+
+    sink = benchlib.SmtpSink()
+    try:
+        base = drive(sink.server_address, mails, sessions, conc, rate)
+        res = [report("direct", base)]
+        res += [run_mode(x, sink, mails, sessions, conc, rate, extra, base) for x in modes]
+    finally:
+        sink.shutdown()
+    print(json.dumps(res, indent=1))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# 主要関数のマイクロベンチマーク（バージョン間の性能比較用）
+#   合成メール（benchlib.synth_mail）毎に check_head / decode_mail / dedup_spf_header / load_smtpfile、
+#   合成ルールセット（benchlib.synth_rules。10 / 100 / 1000 ルール）毎に is_match（CHECK_DATA）/ is_spam
+#   を、ルールセット毎に別プロセスで測定する（入力はシード固定で毎回同じ）
+#   結果は 1呼び出しあたりのマイクロ秒（us は最小値、median_us は中央値）をキー順の JSON で出力
+#   -b で以前の出力を指定すると比較し、-t の比率を超えて遅くなったものがあれば終了コード 1
+#   -p で別のディレクトリの content_filter.py（旧版等）を測定
+#
+#   python3 bench/bench_micro.py [-s size_kb] [-m kinds] [-n 10,100,1000] [-k filter]
+#                                [-r repeat] [-T min_time] [-p cf_dir] [-o out.json] [-b base.json] [-t 1.1]
+#
+
+import os
+import re
+import sys
+import json
+import getopt
+import timeit
+import hashlib
+import inspect
+import platform
+import tempfile
+import subprocess
+
+import benchlib
+
+CHILD = "import bench_micro, sys; bench_micro.child(sys.argv[1])"
+
+# 有効数字4桁（比較時の差分を安定させる）
+def sig(x):
+    return float("%.4g" % x)
+
+# 1呼び出しあたりの秒数（1回の測定が min_time 以上になるようにループ数を決め、repeat 回測定）
+def measure(fn, min_time, repeat):
+    tm = timeit.Timer(fn)
+    loops = 1
+    while True:
+        t = tm.timeit(loops)
+        if t >= min_time:
+            break
+        loops = max(loops * 2, int(loops * min_time / max(t, 1e-9) * 1.2))
+    ts = sorted([t] + [tm.timeit(loops) for _ in range(repeat - 1)])
+    return ts[0] / loops, ts[len(ts) // 2] / loops
+
+def check_head_fn(cf, mail):
+    lines = mail.split(b"\n")
+
+    def fn():
+        head_phase, enc_mode, boundary = True, cf.STD_ENC, []
+        for L in lines:
+            head_phase, enc_mode, boundary = cf.check_head(L, head_phase, enc_mode, boundary)
+    return fn
+
+# CHECK_DATA の is_match（旧版は is_match(data, re_list) のみ）
+def is_match_fn(cf, dec):
+    rs = getattr(cf.G, "RULES", None) or cf.G
+    if not hasattr(cf, "scan_target"):
+        return lambda: cf.is_match(dec, rs.CHECK_RE)
+    params = inspect.signature(cf.scan_target).parameters
+    head = bytes(dec[:dec.find(b"\r\n\r\n")])
+
+    def fn():
+        kw = {}
+        if "lits" in params:
+            kw["lits"] = rs.LITERALS
+        if "hdr" in params:
+            kw["hdr"] = cf.header_ref(head)
+        return cf.is_match(cf.scan_target(dec, **kw), rs.CHECK_RE, getattr(rs, "CHECK_PF", None))
+    return fn
+
+def is_spam_fn(cf, dec, msg_id):
+    t = cf.Obj(t=0, idx=0)
+    return lambda: cf.is_spam(dec, msg_id, t, fname=b"bench")
+
+def child(arg):
+    cfg = json.loads(arg)
+    out = sys.stdout
+    sys.stdout = open(os.devnull, "w")     # putlog の出力
+    import content_filter as cf
+    cf.G.IS_DAEMON = False
+    cf.loadcheck_spam_dat()
+    cf.G.DBG = -1
+
+    flt = cfg["filter"] and re.compile(cfg["filter"])
+    mails = dict((k, benchlib.synth_mail(k, cfg["size"], cfg["seed"])) for k in cfg["kinds"])
+    cases = []
+    if cfg["rules"] is None:
+        for k, mail in mails.items():
+            path = os.path.join(cfg["tmp"], "smtp_%s.txt" % k)
+            with open(path, "wb") as f:
+                f.write(benchlib.synth_transcript(mail))
+            head = mail[:mail.find(b"\r\n\r\n")]
+            cases += [("check_head/%s" % k, len(mail), check_head_fn(cf, mail)),
+                      ("decode_mail/%s" % k, len(mail), lambda mail=mail: cf.decode_mail(mail)),
+                      ("dedup_spf_header/%s" % k, len(head), lambda head=head: cf.dedup_spf_header(head)),
+                      ("load_smtpfile/%s" % k, os.path.getsize(path), lambda path=path: cf.load_smtpfile(path))]
+    else:
+        for k, mail in mails.items():
+            dec, msg_id = cf.decode_mail(mail)
+            cases += [("is_match/r%d/%s" % (cfg["rules"], k), len(dec), is_match_fn(cf, dec)),
+                      ("is_spam/r%d/%s" % (cfg["rules"], k), len(dec), is_spam_fn(cf, dec, msg_id))]
+
+    res = {}
+    for name, nbytes, fn in cases:
+        if flt and not flt.search(name):
+            continue
+        best, med = measure(fn, cfg["min_time"], cfg["repeat"])
+        res[name] = dict(us=sig(best * 1e6), median_us=sig(med * 1e6), bytes=nbytes,
+                         mb_s=sig(nbytes / best / 1e6))
+    print(json.dumps(res), file=out)
+
+def run_child(cf_dir, cfg, rules):
+    with tempfile.TemporaryDirectory(prefix="cfbench_") as tmp:
+        conf = dict(DBG=-1, TMP_DIR=os.path.join(tmp, "log"), VERDICT_CACHE=0, RULE_COST_MAX=0)
+        if rules is not None:
+            src = open(os.path.join(cf_dir, "content_filter.py"), "rb").read()
+            conf.update(benchlib.synth_rules(rules, cfg["seed"], fields=b"class FieldRe" in src))
+        benchlib.write_spam_dat(tmp, **conf)
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([tmp, cf_dir, os.path.dirname(os.path.abspath(__file__))]))
+        arg = json.dumps(dict(cfg, rules=rules, tmp=tmp))
+        out = subprocess.run([sys.executable, "-c", CHILD, arg], env=env, cwd=tmp, check=True,
+                             stdout=subprocess.PIPE).stdout
+        return json.loads(out)
+
+def cpu_model():
+    try:
+        for L in open("/proc/cpuinfo"):
+            if L.startswith("model name"):
+                return L.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+# 以前の結果との比較（th の比率を超えて遅くなったものの数を返す）
+def compare(base, cur, th):
+    bad = 0
+    for name in sorted(set(base["results"]) & set(cur["results"])):
+        b, c = base["results"][name]["us"], cur["results"][name]["us"]
+        ratio = c / b if b else 0
+        mark = ratio > th and "  REGRESSION" or ""
+        bad += bool(mark)
+        print("%-36s %12.1f %12.1f %7.3f%s" % (name, b, c, ratio, mark), file=sys.stderr)
+    return bad
+
+def main():
+    cf_dir = benchlib.ROOT
+    cfg = dict(size=64, kinds=list(benchlib.MAIL_KINDS), filter="", repeat=5, min_time=0.1, seed=0)
+    rule_sizes = [10, 100, 1000]
+    out_file = base_file = None
+    th = 1.1
+    optlist, _ = getopt.getopt(sys.argv[1:], "s:m:n:k:r:T:p:o:b:t:")
+    for key, val in optlist:
+        if key == "-s":
+            cfg["size"] = int(val)
+        elif key == "-m":
+            cfg["kinds"] = val.split(",")
+        elif key == "-n":
+            rule_sizes = [int(x) for x in val.split(",") if x]
+        elif key == "-k":
+            cfg["filter"] = val
+        elif key == "-r":
+            cfg["repeat"] = int(val)
+        elif key == "-T":
+            cfg["min_time"] = float(val)
+        elif key == "-p":
+            cf_dir = os.path.abspath(val)
+        elif key == "-o":
+            out_file = val
+        elif key == "-b":
+            base_file = val
+        elif key == "-t":
+            th = float(val)
+    cfg["size"] *= 1024
+
+    results = {}
+    for rules in [None] + rule_sizes:
+        results.update(run_child(cf_dir, cfg, rules))
+    src = open(os.path.join(cf_dir, "content_filter.py"), "rb").read()
+    meta = dict(python=platform.python_version(), machine=platform.machine(), cpu=cpu_model(),
+                content_filter_sha1=hashlib.sha1(src).hexdigest(), size=cfg["size"], seed=cfg["seed"],
+                kinds=cfg["kinds"], rules=rule_sizes, repeat=cfg["repeat"], min_time=cfg["min_time"])
+    cur = dict(meta=meta, results=results)
+    s = json.dumps(cur, indent=1, sort_keys=True)
+    if out_file:
+        with open(out_file, "w") as f:
+            f.write(s + "\n")
+    else:
+        print(s)
+    if base_file:
+        with open(base_file) as f:
+            sys.exit(compare(json.load(f), cur, th) and 1 or 0)
+
+if __name__ == "__main__":
+    main()
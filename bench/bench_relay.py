@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# 検査不要なセッションの中継コスト（RELAY_SPLICE の有無での比較）
+#   ローカルからの投入（XFORWARD ... SOURCE=LOCAL）と、ヘッダでホワイトリストと判定されるメールを
+#   SmtpSink へ中継し、content_filter のプロセスの CPU時間を中継量 1GB あたりの秒数で出力
+#   （SmtpSink 側の CPU時間は含まない）
+#
+#   python3 bench/bench_relay.py [-s size_mb] [-n sessions] [-m modes]
+#
+
+import sys
+import time
+import json
+import getopt
+
+import benchlib
+
+WHITE_SUBJECT = b"relay-white"
+
+def run(sink, mode, splice, kind, mail, sessions):
+    srv = benchlib.CfServer(sink.server_address, SERVER_MODE=mode, DBG=1, RELAY_SPLICE=splice, HEAD_VERDICT=True,
+                            WHITE_HEAD=[[rb"(?m)^Subject: " + WHITE_SUBJECT]])
+    kw = kind == "local" and dict(xforward=b"NAME=localhost ADDR=127.0.0.1 SOURCE=LOCAL") or {}
+    try:
+        benchlib.smtp_session(srv.addr, benchlib.gen_mail(4000, WHITE_SUBJECT), **kw)    # ウォームアップ
+        cpu0 = srv.cpu()
+        t0 = time.perf_counter()
+        for _ in range(sessions):
+            ret = benchlib.smtp_session(srv.addr, mail, **kw)[1]
+            if ret[:1] != b"2":
+                raise Exception("unexpected reply: %r" % ret)
+        elapsed = time.perf_counter() - t0
+        cpu = srv.cpu() - cpu0
+    finally:
+        srv.stop()
+    gb = len(mail) * sessions / 1e9
+    return dict(mode=mode, kind=kind, splice=splice, sessions=sessions, bytes=len(mail) * sessions,
+                cpu_sec_per_gb=round(cpu / gb, 3), mb_s=round(gb * 1000 / elapsed, 1))
+
+def main():
+    size, sessions, modes = 32, 8, ["thread"]
+    optlist, _ = getopt.getopt(sys.argv[1:], "s:n:m:")
+    for key, val in optlist:
+        if key == "-s":
+            size = int(val)
+        elif key == "-n":
+            sessions = int(val)
+        elif key == "-m":
+            modes = val.split(",")
+    mail = benchlib.gen_mail(size * 1000 * 1000, WHITE_SUBJECT)
+
+    sink = benchlib.SmtpSink()
+    try:
+        res = [run(sink, mode, splice, kind, mail, sessions)
+               for mode in modes for kind in ("local", "white") for splice in (False, True)]
+    finally:
+        sink.shutdown()
+    print(json.dumps(res, indent=1))
+
+if __name__ == "__main__":
+    main()
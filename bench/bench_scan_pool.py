@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# SCAN_POOL の効果測定
+#   高コストな正規表現にかかるメールの判定中に、通常メールのセッションが
+#   どれだけ待たされるか（セッション全体の所要時間）を SCAN_POOL = 0 / N で比較
+#
+#   python3 bench/bench_scan_pool.py [-p pool_size] [-x x_count]
+#
+
+import sys
+import time
+import json
+import getopt
+import threading
+
+import benchlib
+
+# (x+x+)+y は x の連続に対して指数時間のバックトラックとなる
+SLOW_RULE = [[rb'(x+x+)+y']]
+
+def run(pool, xcnt):
+    sink = benchlib.SmtpSink()
+    srv = benchlib.CfServer(sink.server_address, SCAN_POOL=pool, CHECK_DATA=SLOW_RULE)
+    try:
+        bad = benchlib.gen_mail(1000) + b"x" * xcnt + b"\r\n"
+        clean = benchlib.gen_mail(1000)
+        benchlib.smtp_session(srv.addr, clean)  # プール起動等のウォームアップ
+
+        t0 = time.perf_counter()
+        th = threading.Thread(target=benchlib.smtp_session, args=(srv.addr, bad))
+        th.start()
+        time.sleep(0.1)
+        lat = []
+        while th.is_alive():
+            t = time.perf_counter()
+            benchlib.smtp_session(srv.addr, clean)
+            lat.append(time.perf_counter() - t)
+        th.join()
+        slow = time.perf_counter() - t0
+    finally:
+        srv.stop()
+        sink.shutdown()
+
+    lat.sort()
+    return dict(scan_pool=pool, slow_mail_sec=round(slow, 2), clean_sessions=len(lat),
+                clean_p50_ms=lat and round(lat[len(lat) // 2] * 1000, 2),
+                clean_max_ms=lat and round(lat[-1] * 1000, 2))
+
+def main():
+    pool, xcnt = 2, 24
+    optlist, _ = getopt.getopt(sys.argv[1:], "p:x:")
+    for key, val in optlist:
+        if key == "-p":
+            pool = int(val)
+        elif key == "-x":
+            xcnt = int(val)
+    print(json.dumps([run(0, xcnt), run(pool, xcnt)], indent=1))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# SERVER_MODE = "thread" / "async" の比較（sessions/sec, RSS, スレッド数）
+#
+#   python3 bench/bench_server_mode.py [-n sessions] [-c concurrency] [-s mail_size]
+#
+
+import sys
+import time
+import json
+import getopt
+import threading
+import concurrent.futures
+
+import benchlib
+
+def run_mode(mode, sink, sessions, conc, size):
+    srv = benchlib.CfServer(sink.server_address, SERVER_MODE=mode)
+    peak = {"VmHWM": 0, "Threads": 0}
+    running = [True]
+
+    def sampler():
+        while running[0]:
+            st = srv.status()
+            peak["VmHWM"] = max(peak["VmHWM"], st["VmHWM"])
+            peak["Threads"] = max(peak["Threads"], st["Threads"])
+            time.sleep(0.05)
+    th = threading.Thread(target=sampler)
+    th.start()
+
+    mail = benchlib.gen_mail(size)
+    lat = []
+    try:
+        t0 = time.perf_counter()
+        cpu0 = srv.cpu()
+        with concurrent.futures.ThreadPoolExecutor(conc) as ex:
+            for l, _ in ex.map(lambda _: benchlib.smtp_session(srv.addr, mail), range(sessions)):
+                lat.append(l)
+        elapsed = time.perf_counter() - t0
+        cpu = srv.cpu() - cpu0
+    finally:
+        running[0] = False
+        th.join()
+        srv.stop()
+
+    lat.sort()
+    return dict(mode=mode, sessions=sessions, concurrency=conc, mail_size=size,
+                sessions_per_sec=round(sessions / elapsed, 1),
+                cpu_sec=round(cpu, 2),
+                peak_rss_kb=peak["VmHWM"], peak_threads=peak["Threads"],
+                p50_ms=round(lat[len(lat) // 2] * 1000, 2),
+                p99_ms=round(lat[int(len(lat) * 0.99)] * 1000, 2))
+
+def main():
+    sessions, conc, size = 2000, 200, 4000
+    optlist, _ = getopt.getopt(sys.argv[1:], "n:c:s:")
+    for key, val in optlist:
+        if key == "-n":
+            sessions = int(val)
+        elif key == "-c":
+            conc = int(val)
+        elif key == "-s":
+            size = int(val)
+
+    sink = benchlib.SmtpSink()
+    results = [run_mode(mode, sink, sessions, conc, size) for mode in ("thread", "async")]
+    print(json.dumps(results, indent=1))
+
+if __name__ == "__main__":
+    main()
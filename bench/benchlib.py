@@ -0,0 +1,346 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# content_filter ベンチマーク共通部
+#
+#  - SmtpSink : DST_ADDR 側 smtpd の代わりとなる簡易 SMTP サーバ
+#  - CfServer : 一時ディレクトリの spam_dat.py で content_filter.py を起動
+#  - smtp_session : SRC_ADDR 側 smtpd の代わりに 1セッションを送信
+#  - synth_mail / synth_rules : 合成メール・合成ルールセット（シード固定で再現可能）
+#
+
+import os
+import re
+import sys
+import time
+import base64
+import quopri
+import random
+import socket
+import tempfile
+import threading
+import subprocess
+import socketserver
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CF_PATH = os.path.join(ROOT, "content_filter.py")
+SAMPLE_DAT = os.path.join(ROOT, "spam_dat.py.sample")
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def wait_port(addr, timeout=10):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            socket.create_connection(addr, 1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise Exception("port %s not ready" % (addr,))
+
+# spam_dat.py.sample に設定を上書きした spam_dat.py を作成
+def write_spam_dat(dirpath, **kw):
+    s = open(SAMPLE_DAT, encoding="utf8").read()
+    s += "\n# benchmark overrides\n"
+    s += "".join("%s = %r\n" % kv for kv in kw.items())
+    open(os.path.join(dirpath, "spam_dat.py"), "w", encoding="utf8").write(s)
+
+# /proc/<pid>/status の VmRSS/VmHWM(kB) 及び Threads
+def proc_status(pid):
+    ret = {}
+    for L in open("/proc/%d/status" % pid):
+        k, _, v = L.partition(":")
+        if k in ("VmRSS", "VmHWM", "Threads"):
+            ret[k] = int(v.split()[0])
+    return ret
+
+# /proc/<pid>/stat の utime+stime（秒）
+#   children が真なら、終了・回収済みの子プロセス分（cutime+cstime）も含める
+def proc_cpu(pid, children=False):
+    f = open("/proc/%d/stat" % pid).read().rsplit(")", 1)[1].split()
+    return sum(int(x) for x in f[11:children and 15 or 13]) / os.sysconf("SC_CLK_TCK")
+
+# pid とその子孫のプロセス（WORKERS / SCAN_POOL の子プロセスを含む）
+def proc_tree(pid):
+    ret = [pid]
+    for p in ret:
+        try:
+            for task in os.listdir("/proc/%d/task" % p):
+                ret += [int(x) for x in open("/proc/%d/task/%s/children" % (p, task)).read().split()]
+        except OSError:
+            pass
+    return ret
+
+# プロセスツリー全体の proc_status の合計 / proc_cpu の合計
+def tree_status(pid):
+    ret = {"VmRSS": 0, "VmHWM": 0, "Threads": 0}
+    for p in proc_tree(pid):
+        try:
+            for k, v in proc_status(p).items():
+                ret[k] += v
+        except OSError:
+            pass
+    return ret
+
+def tree_cpu(pid):
+    ret = 0
+    for p in proc_tree(pid):
+        try:
+            ret += proc_cpu(p, True)
+        except OSError:
+            pass
+    return ret
+
+class _SinkHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        w = self.wfile
+        w.write(b"220 sink ESMTP\r\n")
+        data_mode = False
+        for L in self.rfile:
+            if data_mode:
+                if L == b".\r\n":
+                    data_mode = False
+                    self.server.mails += 1
+                    w.write(b"250 2.0.0 Ok: queued\r\n")
+                continue
+            cmd = L[:4].upper()
+            if cmd == b"EHLO":
+                w.write(b"250-sink\r\n250-XFORWARD NAME ADDR PROTO HELO SOURCE\r\n250 8BITMIME\r\n")
+            elif cmd == b"DATA":
+                w.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                data_mode = True
+            elif cmd == b"QUIT":
+                w.write(b"221 2.0.0 Bye\r\n")
+                break
+            else:
+                w.write(b"250 2.0.0 Ok\r\n")
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, addr=("127.0.0.1", 0)):
+        super().__init__(addr, _SinkHandler)
+        self.mails = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+class CfServer:
+    def __init__(self, dst_addr, **conf):
+        self.tmp = tempfile.TemporaryDirectory(prefix="cfbench_")
+        self.addr = ("127.0.0.1", free_port())
+        kw = dict(SRC_ADDR=self.addr, DST_ADDR=dst_addr, DBG=-1,
+                  TMP_DIR=os.path.join(self.tmp.name, "log"))
+        kw.update(conf)
+        write_spam_dat(self.tmp.name, **kw)
+        env = dict(os.environ, PYTHONPATH=self.tmp.name)
+        self.proc = subprocess.Popen([sys.executable, CF_PATH, "-d"], env=env,
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wait_port(self.addr)
+        self.pid = self.proc.pid
+
+    # 子プロセス（WORKERS / SCAN_POOL）を含む合計
+    def status(self):
+        return tree_status(self.pid)
+
+    def cpu(self):
+        return tree_cpu(self.pid)
+
+    def stop(self):
+        self.proc.terminate()
+        try:
+            self.proc.wait(10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self.tmp.cleanup()
+
+def _reply(f):
+    lines = []
+    while True:
+        L = f.readline()
+        if not L:
+            break
+        lines.append(L)
+        if L[3:4] != b"-":
+            break
+    return b"".join(lines)
+
+def gen_mail(size=4000, subject=b"benchmark"):
+    line = b"Lorem ipsum dolor sit amet, consectetur adipiscing elit 0123456789\r\n"
+    body = line * max(1, size // len(line))
+    return (b"Received-SPF: pass\r\nMessage-ID: <%d.%d@bench.example>\r\n"
+            b"From: a@bench.example\r\nTo: b@bench.example\r\nSubject: %s\r\n\r\n" %
+            (os.getpid(), threading.get_ident(), subject)) + body
+
+# 1セッション送信（DATA終端送信から応答までの秒数と応答を返す）
+#   cmds を指定すると、DATA の前にそのコマンド列（load_transcript）を送信
+def smtp_session(addr, mail, helo=b"bench.example", mail_from=b"a@bench.example",
+                 rcpt_to=b"b@bench.example", xforward=b"NAME=bench.example ADDR=127.0.0.1 HELO=bench.example",
+                 cmds=None):
+    cmds = cmds or [b"EHLO " + helo, b"XFORWARD " + xforward, b"MAIL FROM:<%s>" % mail_from,
+                    b"RCPT TO:<%s>" % rcpt_to]
+    with socket.create_connection(addr) as c:
+        c.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        f = c.makefile("rb")
+        _reply(f)
+        for cmd in cmds + [b"DATA"]:
+            c.sendall(cmd + b"\r\n")
+            _reply(f)
+        c.sendall(mail)
+        t0 = time.perf_counter()
+        c.sendall(b".\r\n")
+        ret = _reply(f)
+        lat = time.perf_counter() - t0
+        try:
+            c.sendall(b"QUIT\r\n")
+            _reply(f)
+        except OSError:
+            pass
+    return lat, ret
+
+# SMTP通信記録（smtp_*.txt）の再送用の読み込み
+#   受信側（"R: "）の内容から、DATA までのコマンド（EHLO / XFORWARD / MAIL / RCPT）と
+#   メール本体（終端の "." を除く）を返す
+REPLAY_CMDS = (b"EHLO", b"HELO", b"XFOR", b"MAIL", b"RCPT")
+
+def load_transcript(path):
+    with open(path, "rb") as f:
+        ll = f.read().split(b"\n")
+    stream = b"\n".join(L[3:] if L[:3] == b"R: " else L for L in ll if L[:3] != b"S: ")
+    cmds, pos = [], 0
+    while pos < len(stream):
+        end = stream.find(b"\n", pos) + 1 or len(stream)
+        cmd = stream[pos:end].strip()
+        pos = end
+        if cmd.upper() == b"DATA":
+            break
+        if cmd[:4].upper() in REPLAY_CMDS:
+            cmds.append(cmd)
+    else:
+        raise ValueError("no DATA in %s" % path)
+    end = stream.find(b"\r\n.\r\n", pos - 2)
+    mail = stream[pos:end + 2] if end >= 0 else stream[pos:]
+    return cmds, mail if mail[-2:] == b"\r\n" or not mail else mail + b"\r\n"
+
+# 合成メール（DATA の内容。終端の "." は含まない）
+#   kind: plain / multipart / nested / base64 / qp / bighead / encwords
+#   size: 本文のおおよそのバイト数、parts: multipart のパート数、depth: nested の入れ子の深さ
+#   headers: bighead / encwords のヘッダ数
+MAIL_KINDS = ("plain", "multipart", "nested", "base64", "qp", "bighead", "encwords")
+
+WORDS = (b"lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+         b"incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud "
+         b"exercitation ullamco laboris nisi aliquip ex ea commodo consequat").split()
+
+def synth_text(rnd, size, width=72):
+    lines, n = [], 0
+    while n < size:
+        L = b""
+        while len(L) < width:
+            L += rnd.choice(WORDS) + b" "
+        lines.append(L.rstrip())
+        n += len(L) + 1
+    return b"\r\n".join(lines) + b"\r\n"
+
+def synth_part(rnd, size, enc=b"7bit", ctype=b"text/plain"):
+    if enc == b"base64":
+        n = max(1, size * 3 // 4)
+        body = base64.encodebytes(rnd.getrandbits(n * 8).to_bytes(n, "little"))
+    elif enc == b"quoted-printable":
+        txt = synth_text(rnd, size // 2).replace(b"\r\n", "あいう \n".encode("utf8"))
+        body = quopri.encodestring(txt)
+    else:
+        return b"Content-Type: %s\r\n\r\n" % ctype + synth_text(rnd, size)
+    return (b"Content-Type: %s\r\nContent-Transfer-Encoding: %s\r\n\r\n" % (ctype, enc) +
+            body.replace(b"\n", b"\r\n"))
+
+def synth_multipart(rnd, parts, depth, level=0):
+    bnd = b"=_bench_%d_%08x" % (level, rnd.getrandbits(32))
+    ret = b"Content-Type: multipart/%s; boundary=\"%s\"\r\n\r\n" % (level and b"alternative" or b"mixed", bnd)
+    for i, p in enumerate(parts):
+        ret += b"--%s\r\n" % bnd
+        ret += synth_multipart(rnd, parts, depth, level + 1) if i == 0 and level + 1 < depth else p
+    return ret + b"--%s--\r\n" % bnd
+
+def synth_mail(kind, size=64 * 1024, seed=0, parts=3, depth=3, headers=200):
+    rnd = random.Random("%s/%d/%d" % (kind, size, seed))
+    head = [b"Received-SPF: pass (bench.example: domain of a@bench.example designates 192.0.2.1)",
+            b"Received-SPF: none", b"Message-ID: <%s.%d@bench.example>" % (kind.encode(), seed),
+            b"From: a@bench.example", b"To: b@bench.example", b"Subject: synthetic %s mail" % kind.encode(),
+            b"Date: Mon, 1 Jan 2024 00:00:00 +0900", b"MIME-Version: 1.0"]
+    if kind == "bighead":
+        for i in range(headers):
+            head += [b"Received: from relay%d.bench.example (relay%d.bench.example [192.0.2.%d])" % (i, i, i % 250),
+                     b"\tby mx.bench.example (Postfix) with ESMTP id %08X" % rnd.getrandbits(32),
+                     b"\tfor <b@bench.example>; Mon, 1 Jan 2024 00:00:%02d +0900" % (i % 60)]
+    elif kind == "encwords":
+        for i in range(headers):
+            w = " ".join(rnd.choice(["件名", "お知らせ", "テスト", "ご案内", "重要"]) for _ in range(4))
+            ew = b"=?UTF-8?B?%s?=" % base64.b64encode(w.encode("utf8"))
+            head += [b"X-Bench-%d: %s" % (i, ew), b" =?ISO-2022-JP?Q?=1B=24B=24=22=1B=28B?="]
+    part_size = max(1, size // max(1, parts * (kind == "nested" and depth or 1)))
+    if kind in ("plain", "bighead", "encwords"):
+        body = b"Content-Type: text/plain; charset=utf-8\r\n\r\n" + synth_text(rnd, size)
+    elif kind == "base64":
+        body = synth_part(rnd, size, b"base64", b"application/octet-stream")
+    elif kind == "qp":
+        body = synth_part(rnd, size, b"quoted-printable", b"text/plain; charset=utf-8")
+    elif kind in ("multipart", "nested"):
+        encs = [(b"7bit", b"text/plain"), (b"quoted-printable", b"text/html"), (b"base64", b"image/png")]
+        pl = [synth_part(rnd, part_size, *encs[i % len(encs)]) for i in range(parts)]
+        body = synth_multipart(rnd, pl, kind == "nested" and depth or 1)
+    else:
+        raise ValueError("unknown mail kind: %s" % kind)
+    return b"\r\n".join(head) + b"\r\n" + body
+
+# SMTP通信記録（-f / load_smtpfile の入力形式）
+def synth_transcript(mail):
+    ret = b"S: 220 bench.example ESMTP\r\n"
+    for cmd in [b"EHLO bench.example", b"XFORWARD NAME=bench.example ADDR=192.0.2.1",
+                b"MAIL FROM:<a@bench.example>", b"RCPT TO:<b@bench.example>", b"DATA"]:
+        ret += b"R: %s\r\nS: 250 ok\r\n" % cmd
+    return ret + b"R: " + mail + b".\r\nS: 250 2.0.0 Ok: queued\r\n"
+
+# 合成ルールセット（spam_dat の WHITE_HEAD ～ CHECK_DATA。合計 n ルール）
+#   合成メールにはほぼマッチしない（全ルールを評価する最悪ケースに近い）
+#   fields が真ならフィールド指定 ("Subject", rb'...') も含める
+RULE_SHARE = (("WHITE_HEAD", 5), ("PRECHK_HEAD", 5), ("WHITE_DATA", 10), ("CHECK_HEAD", 20), ("CHECK_DATA", 60))
+
+def synth_rules(n, seed=0, fields=False):
+    rnd = random.Random("rules/%d/%d" % (n, seed))
+    vocab = [b"%s%s" % (rnd.choice(WORDS)[:4], rnd.choice([b"zz", b"qx", b"vk", b"jj"])) for _ in range(200)]
+
+    def term(head):
+        k = rnd.randrange(6)
+        w = rnd.choice(vocab)
+        if k == 0:
+            return re.escape(w + b" " + rnd.choice(vocab))
+        if k == 1:
+            return b"(?:%s)" % b"|".join(rnd.sample(vocab, 3))
+        if k == 2:
+            return rb"https?://[a-z0-9.-]+\.%s/\w+" % w
+        if k == 3:
+            return w + rb"\s+[0-9]{2,4}\s*%s" % rnd.choice(vocab)
+        if k == 4 and head:
+            return rb"^Subject:.*%s" % w
+        if k == 4:
+            return rb"[A-Z][a-z]+ %s" % w
+        return re.escape(rnd.choice(WORDS)) + rb"\W+" + w
+
+    ret = {}
+    for name, share in RULE_SHARE:
+        head = name.endswith("_HEAD")
+        ll = []
+        for _ in range(max(1, n * share // 100)):
+            L = [term(head) for _ in range(rnd.choice((1, 1, 2, 3)))]
+            if fields and rnd.random() < 0.1:
+                L[0] = (rnd.choice(["Subject", "From", "X-Mailer"]), rb"%s" % rnd.choice(vocab))
+            ll.append(L)
+        ret[name] = ll
+    return ret
@@ -42,18 +42,59 @@ import re
 import syslog
 import traceback
 import signal
+import threading
 from functools import reduce
 from operator import add
 
 import select
+import fcntl
 import _thread
 import socket
+import asyncio
+import concurrent.futures
+import multiprocessing
+from multiprocessing import shared_memory
 import base64
 import quopri
+import mmap
+import shutil
+import tempfile
 import importlib
 import getopt
+import glob
+import json
+import ast
+import hashlib
+import ipaddress
+import collections
+import contextlib
+import gzip
+import zlib
+import io
+import bisect
+import cProfile
+import pstats
+import tracemalloc
 import email.header
 
+try:
+    import re._parser as sre_parse
+except ImportError:
+    import sre_parse
+import _sre
+import ctypes
+import pickle
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
 sys.path.append("/etc/postfix/")
 import spam_dat
 
@@ -68,20 +109,83 @@ HEADER_PHASE, DATA_PHASE = range(2)
 
 # グローバル設定データ類（loadcheck_spam_dat で設定）
 G = Obj(
-        WHITE_HEAD_RE   = None,
-        PRECHK_HEAD_RE  = None,
-        WHITE_RE        = None,
-        CHECK_HEAD_RE   = None,
-        CHECK_RE        = None,
+        RULES           = None,     # ルールセット（load_rules。再ロード時は一括で差し替え）
+        RE_CACHE        = {},       # コンパイル済み正規表現（キーはパターン）
+        RULE_DISABLED   = None,     # 親プロセス・マスターが実行コスト検査で無効化した正規表現（None なら自身で検査）
+        RULE_SNAPSHOT   = None,
+        RULE_OPTIMIZE   = None,
+        RULE_COST_FILE  = None,
+        RULE_COST       = None,     # RULE_COST_FILE の内容（正規表現毎のコスト）
+        STATS_FILE      = None,
+        STATS_INTERVAL  = None,
         DBG             = None,
         TMP_DIR         = None,
         SPAM_ERRCODE    = None,
+        SERVER_MODE     = None,
+        SCAN_WORKERS    = None,
+        SESSION_MEM_CAP = None,
+        WORKERS         = None,
+        SCAN_POOL       = None,
+        HEAD_VERDICT    = None,
+        PART_POLICY     = None,     # MIMEパートの検査範囲（part_policy）
+        SCAN_TIME_BUDGET = None,
+        SCAN_TIMEOUT_ACTION = None,
+        MAX_SESSIONS    = None,
+        MAX_SCANS       = None,
+        TOTAL_MEM_CAP   = None,
+        ADMIT_QUEUE     = None,
+        ADMIT_WAIT      = None,
+        LISTEN_BACKLOG  = None,
+        RELAY_SPLICE    = None,
+        REPUTATION_SIZE = None,
+        REPUTATION_TTL  = None,
+        REPUTATION_TEMPFAIL = None,
+        REPUTATION_REJECT = None,
+        REPUTATION_GOOD = None,
+        REPUTATION_RECHECK = None,
+        REPUTATION_KEYS = None,
+        REPUTATION_FILE = None,
+        REPUTATION      = None,     # 接続元の評価キャッシュ（reputation_init。再ロードではクリアしない）
+        REP_STAT        = Obj(rejected=0, tempfailed=0, good=0),
+        REP_TIME        = 0,        # 評価キャッシュの最終保存時刻
+        PROFILE_SESSIONS = None,
+        PROFILE_MODE    = None,
+        SCAN_CUR        = None,     # 検査中の正規表現（タイマーでの中断時のログ用）
+        SCAN_ARMED      = False,    # 検査時間のタイマー動作中
         STAT            = None,
+        WATCH_FD        = None,     # spam_dat.py の変更監視（inotify）
+        WAKE_FD         = None,     # 定期処理の待ちを中断させるパイプ（ワーカーの SIGHUP）
 
-        # これは例外（スレッド数カウンタ）
-        THR_CNT         = 0,
+        # これは例外（同時実行数等のカウンタ。ADMIT_COND のロック内で更新）
+        ADMIT           = Obj(sessions=0, waiting=0, scans=0, mem=0, sessions_total=0,
+                              sessions_rejected=0, scans_rejected=0, log_time=0, log_cnt=0),
+        ADMIT_COND      = threading.Condition(),
         IS_DAEMON       = True,
         VERBOSE         = False,
+        LISTEN_SOCK     = None,     # ワーカー間で共有する待ち受けソケット
+        RELOAD_REQ      = False,    # マスターからの再ロード要求（SIGHUP）
+        WORKER_IDX      = 0,        # ワーカー番号（ファイル名の連番をワーカー毎に分ける）
+        SCAN_EXEC       = None,     # SPAM判定プロセスプール（SCAN_POOL > 0 の場合）
+        LOG_BUF         = None,     # プール内ではログを溜めて、親プロセスで出力
+        LOG_WRITER      = None,
+        LOG_QUEUE_MAX   = None,
+        LOG_COMPRESS    = None,
+        LOG_SEGMENT_SIZE = None,
+        LOG_SEGMENT_SEC = None,
+        LOG_MAX_TOTAL   = None,
+        INDEX_FILE      = None,
+        WHATIF          = None,     # ルール案の検索条件（whatif_proc。プール内で参照）
+        LOG_QUEUE       = None,     # ログ書き込みキュー（log_enqueue）
+        LOG_LOCK        = threading.Lock(),
+        TMP_DIR_OK      = None,     # 作成済みの TMP_DIR
+        STATS_LOCK      = threading.Lock(),
+        STATS_TIME      = 0,        # 統計ファイルの最終出力時刻
+        OPTIMIZE_TIME   = 0,        # 評価順の最終更新時刻
+        ORDER_VER       = 0,        # 評価順の版数（SCAN_POOL のプロセスへ渡す。order_file）
+        CACHE_STAT      = Obj(hits=0, misses=0, bypass=0, saved_ns=0),
+        PHASE_HIST      = {},       # 処理段階毎の所要時間のヒストグラム（hist_add）
+        DUMP_REQ        = False,    # ヒストグラムの出力・プロファイル開始の要求（SIGUSR1）
+        PROF            = None,     # 実行中のプロファイル（profile_start）
     )
 
 # 正規表現の事前定義コンパイル
@@ -92,6 +196,17 @@ SUBJECT_RE = re.compile(rb'Subject: ([^\r\n]+)')
 FROM_RE    = re.compile(rb'From: ([^\r\n]+)')
 TO_RE      = re.compile(rb'To: ([^\r\n]+)')
 
+NEVER_RE   = re.compile(rb'(?!)')  # 無効化したルール用
+SPF_LINE_RE = re.compile(rb'^Received-SPF:', re.IGNORECASE | re.MULTILINE)
+
+DECODE_CHUNK   = 1024 * 1024        # 一括デコード・SMTP通信記録の読み込み時の分割サイズ
+LOWER_COPY_MAX = 8 * 1024 * 1024    # これを超えるメールは、リテラル検索用の小文字化コピーを作らない
+
+BUSY_REPLY = b"421 4.3.2 Service busy, try again later\r\n"   # 受付数の超過
+
+# 判定キャッシュのキーから除くヘッダ行（メール毎に変わるもの）
+CACHE_IGNORE_DEFAULT = [r"XFORWARD ", r"RCPT TO:", r"Received:", r"Message-ID:", r"Date:", r"To:"]
+
 def bytes2str(s):
     try:
         s = s.decode("utf8", "ignore")
@@ -103,6 +218,9 @@ def bytes2str(s):
 # syslog & 画面出力
 def putlog(s, only_print=False):
     try:
+        if G.LOG_BUF is not None:
+            G.LOG_BUF.append(("log", s, only_print))
+            return
         if type(s) != str:
             s = bytes2str(s)
         if not only_print and G.IS_DAEMON:
@@ -129,19 +247,307 @@ def sdec_fname(t):
     return "sdec_%s.txt" % time_to_str(t)
 
 # ログファイル出力(& syslog)
-def write_log(t, smtp_data, msg_id):
+#   smtp_data は spool（spool_init）。head/tail はその前後に付加
+#   書き込みスレッド経由の場合、通信記録は連結せずに spool ごとキューへ移し（smtp_data は空になる）、
+#   書き込みスレッドで分割して圧縮・出力する
+def write_log(t, smtp_data, msg_id, head=b'', tail=b''):
+    if log_writer_on(t):
+        putlog("smtp_log for msg_id=%s to %s" % (bytes2str(msg_id), smtp_fname(t)))
+        log_enqueue(smtp_fname(t), (head, spool_take(smtp_data), tail))
+        return
     fname = logpath(smtp_fname(t), is_time_zero(t))
     putlog("smtp_log for msg_id=%s to %s" % (bytes2str(msg_id), fname))
     f = open(fname, "wb")
-    f.write(smtp_data)
+    f.write(head)
+    spool_writeto(smtp_data, f)
+    f.write(tail)
+
+# デコード後のメール内容の出力
+def sdec_log(dec_data, t):
+    if log_writer_on(t):
+        log_enqueue(sdec_fname(t), bytes(dec_data))
+    else:
+        open(logpath(sdec_fname(t), is_time_zero(t)), "wb").write(dec_data)
 
 
 # SMTPデータ等の保存パス生成
 def logpath(fname, is_tmp):
-    if not os.access(G.TMP_DIR, os.F_OK):
-        os.mkdir(G.TMP_DIR)
+    if G.TMP_DIR_OK != G.TMP_DIR:
+        if not os.access(G.TMP_DIR, os.F_OK):
+            os.mkdir(G.TMP_DIR)
+        G.TMP_DIR_OK = G.TMP_DIR
     return  os.path.join(is_tmp and "/tmp" or G.TMP_DIR, fname)
 
+# 書き込みスレッド経由でセグメントファイルへ出力するか（-f 等の t=0 は従来通り）
+def log_writer_on(t):
+    return  G.LOG_WRITER and not is_time_zero(t)
+
+# 書き込みキューへの追加（キューが LOG_QUEUE_MAX を超える場合は破棄）
+#   data は bytes、または (先頭, spool, 末尾)（write_log。書き込み後に spool を閉じる）
+#   プール内では親プロセスへ渡して、親プロセスの書き込みスレッドで出力
+def log_enqueue(fname, data):
+    if G.LOG_BUF is not None:
+        G.LOG_BUF.append(("dump", fname, data))
+        return
+    with G.LOG_LOCK:
+        if G.LOG_QUEUE is None:
+            lq = Obj(q=collections.deque(), size=0, dropped=0, stop=False, cond=threading.Condition())
+            lq.thread = threading.Thread(target=log_writer, args=(lq,), daemon=True)
+            lq.thread.start()
+            G.LOG_QUEUE = lq
+    lq = G.LOG_QUEUE
+    size = log_size(data)
+    with lq.cond:
+        if lq.size + size > G.LOG_QUEUE_MAX:
+            lq.dropped += 1
+            dropped = True
+        else:
+            lq.q.append((fname, data))
+            lq.size += size
+            lq.cond.notify()
+            dropped = False
+    if dropped:
+        log_release(data)
+        putlog("log queue is full. %s is dropped." % fname)
+
+def log_size(data):
+    return  type(data) is tuple and len(data[0]) + data[1].size + len(data[2]) or len(data)
+
+def log_release(data):
+    if type(data) is tuple:
+        spool_close(data[1])
+
+# 書き込みスレッドの停止（キューの残りは書き込んでから停止）
+def log_writer_stop():
+    lq = G.LOG_QUEUE
+    if lq:
+        with lq.cond:
+            lq.stop = True
+            lq.cond.notify()
+        lq.thread.join(60)
+
+# 書き込みスレッド
+#   キューに溜まった分をまとめてセグメントファイルに書き込み、
+#   サイズ（LOG_SEGMENT_SIZE）・時間（LOG_SEGMENT_SEC）で次のセグメントに切り替える
+def log_writer(lq):
+    seg = None
+    while True:
+        with lq.cond:
+            if not lq.q and not lq.stop:
+                lq.cond.wait(10)
+            batch = list(lq.q)
+            lq.q.clear()
+            lq.size = 0
+            stop = lq.stop
+        try:
+            seg = segment_write(seg, batch)
+        except Exception:
+            putlog(traceback.format_exc())
+        if stop and not batch:
+            break
+    if seg:
+        segment_close(seg)
+
+# セグメントファイル（seg_YYYYmmdd_HHMMSS_wN.dat）とインデックス（同 .idx）
+#   インデックスは1行1件で「ファイル名 TAB 位置 TAB 長さ TAB 圧縮方式」
+#   圧縮は1件毎に行うため、任意の1件を取り出せる
+def segment_open():
+    base = logpath("seg_%s_w%d" % (time.strftime("%Y%m%d_%H%M%S"), G.WORKER_IDX), False)
+    dat = open(base + ".dat", "ab")
+    return  Obj(base=base, dat=dat, idx=open(base + ".idx", "a", encoding="utf8"), t=time.time(), size=dat.tell())
+
+def segment_close(seg):
+    seg.dat.close()
+    seg.idx.close()
+
+def segment_write(seg, batch):
+    if seg and (seg.size >= G.LOG_SEGMENT_SIZE or time.time() - seg.t >= G.LOG_SEGMENT_SEC):
+        segment_close(seg)
+        seg = None
+        segment_expire()
+    if not batch:
+        return  seg
+    if seg is None:
+        seg = segment_open()
+
+    comp = G.LOG_COMPRESS or "-"
+    idx = []
+    try:
+        for fname, data in batch:
+            off = seg.dat.tell()
+            if type(data) is tuple:
+                n = log_compress_to(seg.dat, log_chunks(data), log_size(data), comp)
+            else:
+                data = log_compress(data, comp)
+                seg.dat.write(data)
+                n = len(data)
+            idx.append("%s\t%d\t%d\t%s\n" % (fname, off, n, comp))
+    finally:
+        for _, data in batch:
+            log_release(data)
+        seg.dat.flush()
+        seg.idx.write("".join(idx))
+        seg.idx.flush()
+        seg.size = seg.dat.tell()
+    return  seg
+
+# 古いセグメントの削除（合計が LOG_MAX_TOTAL を超えた分）
+def segment_expire():
+    if not G.LOG_MAX_TOTAL:
+        return
+    segs = []
+    for path in glob.glob(os.path.join(G.TMP_DIR, "seg_*.dat")):
+        try:
+            st = os.stat(path)
+            segs.append((st.st_mtime, st.st_size, path))
+        except OSError:
+            pass
+    total = sum(x[1] for x in segs)
+    for _, size, path in sorted(segs):
+        if total <= G.LOG_MAX_TOTAL:
+            break
+        for fn in (path, path[:-4] + ".idx"):
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+        total -= size
+
+def log_compress(data, comp):
+    if comp == "gzip":
+        return  gzip.compress(data, 6)
+    if comp == "zstd":
+        return  zstandard.ZstdCompressor().compress(data)
+    return  data
+
+# 分割データの圧縮出力（log_compress と同じ形式。size は全体のバイト数。出力したバイト数を返す）
+def log_compress_to(f, chunks, size, comp):
+    if comp == "gzip":
+        c = zlib.compressobj(6, zlib.DEFLATED, 31)
+    elif comp == "zstd":
+        c = zstandard.ZstdCompressor().compressobj(size=size)
+    else:
+        c = None
+    n = 0
+    for x in chunks:
+        x = c.compress(x) if c else x
+        f.write(x)
+        n += len(x)
+    if c:
+        x = c.flush()
+        f.write(x)
+        n += len(x)
+    return  n
+
+def log_chunks(data):
+    head, sp, tail = data
+    yield head
+    yield from spool_chunks(sp)
+    yield tail
+
+def log_decompress(data, comp):
+    if comp == "gzip":
+        return  gzip.decompress(data)
+    if comp == "zstd":
+        return  zstandard.ZstdDecompressor().decompress(data)
+    return  data
+
+# セグメントファイルからの1件読み込み（fname: smtp_YYYYmmdd_HHMMSS_N.txt 等）
+def segment_read(fname):
+    for ipath in sorted(glob.glob(os.path.join(G.TMP_DIR, "seg_*.idx")), reverse=True):
+        for L in open(ipath, encoding="utf8"):
+            name, off, size, comp = L.rstrip("\n").split("\t")
+            if name == fname:
+                with open(ipath[:-4] + ".dat", "rb") as f:
+                    return  log_decompress(os.pread(f.fileno(), int(size), int(off)), comp)
+    return  None
+
+# メモリ上限付きバッファ
+#   acct（Obj(cap=, used=, total=)）をセッション内の spool で共有し、
+#   合計が cap を超えると、超えた spool を一時ファイルへ退避する
+#   （全セッションの合計（G.ADMIT.mem）が total を超える場合も同様）
+def spool_init(acct=None):
+    return Obj(buf=bytearray(), f=None, size=0, acct=acct)
+
+def spool_write(sp, data):
+    acct = sp.acct
+    if sp.f is None:
+        if acct and (acct.cap and acct.used + len(data) > acct.cap or
+                     acct.total and G.ADMIT.mem + len(data) > acct.total):
+            sp.f = tempfile.TemporaryFile(prefix="content_filter_")
+            sp.f.write(sp.buf)
+            acct_add(acct, -len(sp.buf))
+            sp.buf = bytearray()
+        else:
+            sp.buf += data
+            if acct:
+                acct_add(acct, len(data))
+            sp.size += len(data)
+            return
+    sp.f.write(data)
+    sp.size += len(data)
+
+# 指定範囲の読み出し
+def spool_read(sp, start, end):
+    if sp.f is None:
+        return bytes(sp.buf[start:end])
+    sp.f.flush()
+    return os.pread(sp.f.fileno(), end - start, start)
+
+def spool_writeto(sp, f, start=0):
+    if sp.f is None:
+        f.write(memoryview(sp.buf)[start:])
+    else:
+        sp.f.flush()
+        sp.f.seek(start)
+        shutil.copyfileobj(sp.f, f)
+        sp.f.seek(0, os.SEEK_END)
+
+# DECODE_CHUNK 毎の読み出し
+def spool_chunks(sp, start=0):
+    if sp.f is None:
+        with memoryview(sp.buf) as mv:
+            for i in range(start, sp.size, DECODE_CHUNK):
+                with mv[i:i + DECODE_CHUNK] as x:
+                    yield x
+        return
+    sp.f.flush()
+    for i in range(start, sp.size, DECODE_CHUNK):
+        yield os.pread(sp.f.fileno(), min(DECODE_CHUNK, sp.size - i), i)
+
+# 内容を新しい spool へ移す（sp は空になり、移した分はメモリ上限の集計から除く）
+def spool_take(sp):
+    ret = spool_init()
+    ret.buf, ret.f, ret.size = sp.buf, sp.f, sp.size
+    if sp.acct:
+        acct_add(sp.acct, -len(sp.buf))
+    sp.buf, sp.f, sp.size = bytearray(), None, 0
+    return  ret
+
+def spool_readinto(sp, buf):
+    if sp.f is None:
+        buf[:sp.size] = sp.buf
+        return
+    sp.f.flush()
+    sp.f.seek(0)
+    pos = 0
+    while pos < sp.size:
+        pos += sp.f.readinto(buf[pos:sp.size])
+    sp.f.seek(0, os.SEEK_END)
+
+def spool_close(sp):
+    if sp.f:
+        sp.f.close()
+        sp.f = None
+    if sp.acct:
+        acct_add(sp.acct, -len(sp.buf))
+    sp.buf = bytearray()
+
+def acct_add(acct, n):
+    acct.used += n
+    with G.ADMIT_COND:
+        G.ADMIT.mem += n
+
 # SMTPデータ等の保存パス生成
 def check_head(L, head_phase, enc_mode, boundary):
     bound_key = b'boundary='
@@ -171,117 +577,802 @@ def check_head(L, head_phase, enc_mode, boundary):
 
     return  head_phase, enc_mode, boundary
 
-# メールの MIMEパート毎の base64 / quoted-printable のデコード
-# （なお、文字コードはそのまま）
-def decode_mail(s):
-    ll = s.split(b'\n')
+# メールデコードの状態（check_head の状態を、受信チャンクを跨いで保持）
+#   pp は MIMEパートの検査範囲（PART_POLICY）の状態、size はデコード前の入力バイト数
+def decode_init(acct=None):
+    return Obj(part=b'', head_phase=True, enc_mode=STD_ENC, boundary=[], msg_id=b'',
+               last=None, out=spool_init(acct), otail=b'', sep=-1, size=0, undo=None,
+               pp=Obj(no=0, ctype=b'text/plain', skip=False, plen=0, mlen=0, skipped={}))
+
+# MIMEパートの検査範囲（SCAN_TYPES, PART_SCAN_MAX, MSG_SCAN_MAX。全て無指定なら None）
+def part_policy(types, part_max, msg_max):
+    if types is None and not part_max and not msg_max:
+        return  None
+    types = types is not None and tuple(x if type(x) == bytes else x.encode() for x in types)
+    return  Obj(types=types and tuple(x.lower() for x in types), part_max=part_max, msg_max=msg_max)
+
+# 本文の1行を検査対象とするか（対象外の行はデコードせず、出力もしない）
+#   パートのヘッダ（Content-Type 等）は常に出力する
+def part_line(pol, pp, L, was_head, head_phase):
+    if head_phase:
+        if not was_head:
+            pp.no += 1                      # 次のパート
+            pp.ctype = b'text/plain'
+            pp.plen = 0
+        if L[:13].lower() == b'content-type:':
+            pp.ctype = L[13:].split(b';')[0].strip().lower()
+        return  True
+    if was_head:
+        pp.skip = pol.types is not False and not pp.ctype.startswith(pol.types)
+        return  True
+    if pp.skip or (pol.part_max and pp.plen >= pol.part_max) or (pol.msg_max and pp.mlen >= pol.msg_max):
+        # multipart のプリアンブル（最初の区切りの前の本文）は読み捨てるのみで、skip_summary には含めない
+        if not pp.ctype.startswith(b'multipart/'):
+            sk = pp.skipped.setdefault(pp.no, [pp.ctype, 0, pp.skip])
+            sk[1] += len(L) + 1
+        return  False
+    pp.plen += len(L)
+    pp.mlen += len(L)
+    return  True
+
+# 検査対象外としたパートの一覧（ログ用。無ければ空）
+#   パート番号:Content-Type（一部のみの場合は、除いたバイト数）
+def skip_summary(st):
+    ll = []
+    for no, (ctype, size, whole) in sorted(st.pp.skipped.items()):
+        ll.append(whole and b'%d:%s' % (no, ctype) or b'%d:%s(+%d)' % (no, ctype, size))
+    return  ll and b' skip=<%s>' % b' '.join(ll) or b''
+
+# 行単位のデコード（ヘッダ継続行の連結があるため、最後の1要素は st.last に保留）
+def decode_lines(st, ll):
     d = []
-    enc_mode = STD_ENC
-    head_phase = True
-    boundary = []
-    msg_id = b''
+    head_phase, enc_mode, boundary, last = st.head_phase, st.enc_mode, st.boundary, st.last
+    pol = G.PART_POLICY
 
     for L in ll:
+        was_head = head_phase
         head_phase, enc_mode, boundary = check_head(L, head_phase, enc_mode, boundary)
         # putlog("%s %s %s %s" % (str(head_phase), enc_mode, boundary, str(L)), True)
+        if pol and not part_line(pol, st.pp, L, was_head, head_phase):
+            continue
 
-        if not msg_id and head_phase:
+        if not st.msg_id and head_phase:
             m = MSGID_RE.search(L)
             if m:
-                msg_id = m.group().strip()
+                st.msg_id = m.group().strip()
 
         try:
             # 分割されたheader行の連結
-            if head_phase and len(L) > 0 and b'\t '.find(L[0:1]) >= 0 and len(d) > 0 and d[-1][-1:] == b'\r':
-                d[-1] = d[-1][:-1]
+            if head_phase and len(L) > 0 and b'\t '.find(L[0:1]) >= 0 and last is not None and last[-1:] == b'\r':
+                last = last[:-1]
 
             if enc_mode == STD_ENC or head_phase or L == b'\r':
-                d.append(L)
+                e = L
             elif enc_mode == B64_ENC:
-                d.append(base64.decodebytes(L))
+                e = base64.decodebytes(L)
             elif enc_mode == QP_ENC:
-                s = quopri.decodestring(L)
-                d.append(s)
+                e = quopri.decodestring(L)
             else:
-                d.append(L)
+                e = L
         except:
-            d.append(L)
+            e = L
 
-    msg = b''.join(d)
-    msg = msg.replace(b'\n', b'')
-    msg = msg.replace(b'\r', b'\r\n')
+        if last is not None:
+            d.append(last)
+        last = e
 
-    try:
-        head, body = msg.split(b'\r\n\r\n', 1)
-    except:
-        head = msg
-        body = b''
+    st.head_phase, st.enc_mode, st.boundary, st.last = head_phase, enc_mode, boundary, last
+
+    # 改行の正規化は1バイト単位の置換のため、まとめて行う
+    data = b''.join(d).replace(b'\n', b'').replace(b'\r', b'\r\n')
+    if st.sep < 0:
+        idx = (st.otail + data).find(b'\r\n\r\n')
+        if idx >= 0:
+            st.sep = st.out.size - len(st.otail) + idx
+        else:
+            st.otail = (st.otail + data[-3:])[-3:]
+    spool_write(st.out, data)
+
+# 受信チャンクの追加デコード
+def decode_feed(st, data):
+    st.size += len(data)
+    ll = (st.part + data).split(b'\n')
+    st.part = ll.pop()
+    decode_lines(st, ll)
+
+# デコード結果の取得（st は変更しないため、続けて decode_feed 可能）
+#   出力が一時ファイルへ退避されている場合、結果も一時ファイルの mmap で返す
+#   inplace の場合は st の出力バッファをそのまま結果（bytearray）とし、本文をコピーしない
+#   （以降 st は、decode_restore で結果を戻すまで使えない）
+def decode_finish(st, inplace=False):
+    f = decode_init()
+    f.head_phase, f.enc_mode, f.boundary = st.head_phase, st.enc_mode, list(st.boundary)
+    f.msg_id, f.last = st.msg_id, st.last
+    f.pp = Obj(**st.pp.__dict__)
+    f.pp.skipped = {}
+    decode_lines(f, [st.part])
+    tail = bytes(f.out.buf) + f.last.replace(b'\n', b'').replace(b'\r', b'\r\n')
+
+    out = st.out
+    if st.sep >= 0:
+        head = spool_read(out, 0, st.sep)
+        start = st.sep + 4
+    else:
+        msg = spool_read(out, 0, out.size) + tail
+        try:
+            head, tail = msg.split(b'\r\n\r\n', 1)
+        except:
+            head = msg
+            tail = b''
+        start = out.size
 
     for r in [SUBJECT_RE, FROM_RE, TO_RE]:
         head = replace_re_data(r, head)
 
-    msg = head + b"\r\n\r\n" + body
+    if out.f is None and inplace:
+        msg, out.buf = out.buf, bytearray()
+        if out.acct:
+            acct_add(out.acct, -len(msg))
+        st.undo = (len(head) + 4, bytes(msg[:start]), len(tail))
+        msg[:start] = head + b"\r\n\r\n"
+        msg += tail
+    elif out.f is None:
+        msg = b''.join([head, b"\r\n\r\n", memoryview(out.buf)[start:], tail])
+    else:
+        with tempfile.TemporaryFile(prefix="content_filter_") as tf:
+            tf.write(head + b"\r\n\r\n")
+            spool_writeto(out, tf, start)
+            tf.write(tail)
+            tf.flush()
+            msg = mmap.mmap(tf.fileno(), 0, access=mmap.ACCESS_READ)
+
+    return  msg, f.msg_id
+
+# decode_finish（inplace）の結果を st の出力バッファへ戻す（同じセッションで続くメッセージのデコード用）
+#   置換したヘッダ部と追加した末尾のみを元に戻し、本文はコピーしない（以降 msg は使えない）
+def decode_restore(st, msg):
+    if st.undo is None:
+        return
+    hlen, head, tlen = st.undo
+    st.undo = None
+    del msg[len(msg) - tlen:]
+    msg[:hlen] = head
+    msg += st.out.buf
+    if st.out.acct:
+        acct_add(st.out.acct, len(msg) - len(st.out.buf))
+    st.out.buf = msg
+
+# デコード済みのヘッダ部（ヘッダの終わりまで到達していなければ None）
+#   decode_finish の結果のヘッダ部と同じもの
+def decode_head(st):
+    if st.sep < 0:
+        return  None
+    head = spool_read(st.out, 0, st.sep)
+    for r in [SUBJECT_RE, FROM_RE, TO_RE]:
+        head = replace_re_data(r, head)
+    return  head
 
-    return  msg, msg_id
+# メールの MIMEパート毎の base64 / quoted-printable のデコード
+# （なお、文字コードはそのまま）
+#   st（decode_init）を渡すと、デコード後の状態（skip_summary 用）を参照できる
+#   巨大なメールでも行分割等の作業領域が DECODE_CHUNK 程度で済むよう、分割してデコードする
+def decode_mail(s, st=None):
+    return  decode_chunks((s[i:i + DECODE_CHUNK] for i in range(0, len(s), DECODE_CHUNK)), st)
+
+# チャンク列のデコード（SMTP通信記録の mmap や共有メモリから、全体をコピーせずにデコード）
+def decode_chunks(chunks, st=None):
+    st = st or decode_init()
+    for data in chunks:
+        decode_feed(st, data)
+    return  decode_finish(st, True)
 
 def strip_ln(s):
     return s.replace(b'\r\n', b' ').replace(b'\n', b' ').replace(b'\r', b' ')
 
+# 正規表現から、マッチに必須なリテラル（最長のもの、小文字化）を抽出
+# （抽出できない場合は None）
+def required_literal(r):
+    if r.flags & re.LOCALE:
+        return None
+    try:
+        return parsed_literal(sre_parse.parse(r.pattern, r.flags))
+    except Exception:
+        return None
+
+# 必須リテラル（構文解析済みの正規表現から）
+def parsed_literal(parsed):
+    repeat_ops = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, "POSSESSIVE_REPEAT", None))
+
+    def walk(items, lits):
+        run = []
+        for op, av in items:
+            if op == sre_parse.LITERAL:
+                run.append(av)
+                continue
+            if run:
+                lits.append(bytes(run))
+                run = []
+            if op == sre_parse.SUBPATTERN:
+                walk(av[-1], lits)
+            elif op in repeat_ops and av[0] >= 1:
+                walk(av[2], lits)
+        if run:
+            lits.append(bytes(run))
+
+    lits = []
+    walk(parsed, lits)
+    lits = [x for x in lits if len(x) >= 3]
+    return lits and max(lits, key=len).lower() or None
+
+# ルール毎の前置フィルタ（AND条件の各正規表現の必須リテラル）
+def build_prefilter(re_list):
+    return [tuple({x for x in map(regex_literal, ll) if x}) for ll in re_list]
+
+# 必須リテラル（RE_CACHE にあればその値。フィールド指定はデータ全体の前置フィルタに使えないため None）
+def regex_literal(r):
+    if type(r) is FieldRe:
+        return  None
+    ent = G.RE_CACHE.get(r.pattern)
+    return  ent.lit if ent and ent.re is r else required_literal(r)
+
+# 検査対象データ（小文字化データとリテラル検査結果をキャッシュ）
+#   memo は正規表現毎のマッチ結果（同じ正規表現は1メッセージにつき1回のみ検索）
+#   deadline は検査時間の上限（scan_budget）、lits はルールセットの全必須リテラル（LITERALS）
+#   hdr はフィールド指定のルール用のヘッダの索引（header_ref）
+def scan_target(data, deadline=None, lits=None, hdr=None):
+    return Obj(data=data, low=None, lit={}, memo={}, deadline=deadline, lits=lits, hdr=hdr)
+
+def has_literal(tg, lit):
+    ret = tg.lit.get(lit)
+    if ret is None:
+        if tg.low is None:
+            # mmap や巨大なメールは小文字化のコピーを作らず、全リテラルを分割して一括検索
+            tg.low = isinstance(tg.data, mmap.mmap) or len(tg.data) > LOWER_COPY_MAX or tg.data.lower()
+            if tg.low is True and tg.lits:
+                tg.lit = chunk_literals(tg.data, tg.lits)
+                ret = tg.lit.get(lit)
+        if ret is not None:
+            pass
+        elif tg.low is True:
+            ret = re.search(re.escape(lit), tg.data, re.IGNORECASE) is not None
+        else:
+            ret = lit in tg.low
+        tg.lit[lit] = ret
+    return ret
+
+# リテラルの一括検索（DECODE_CHUNK 毎に小文字化。リテラルが跨る分は重ねる）
+def chunk_literals(data, lits):
+    pend = set(lits)
+    over = max(map(len, pend)) - 1
+    for i in range(0, len(data), DECODE_CHUNK):
+        low = data[i:i + DECODE_CHUNK + over].lower()
+        pend -= {x for x in pend if x in low}
+        if not pend:
+            break
+    return  {x: x not in pend for x in lits}
+
 # 正規表現リストのマッチ検査
-def is_match(data, re_list):
+#   pf_list（build_prefilter）があれば、必須リテラルが揃わないルールは
+#   正規表現を実行せずにスキップ（結果は変わらない）
+#   st_list（rule_stats）があれば、ルール毎・正規表現毎の統計を記録
+#   ord_list（build_order）があれば、ルール内の正規表現をその順で評価
+#   （AND条件のため結果は変わらず、マッチ文字列も元の順で返す）
+#   tg.deadline を過ぎた場合は ScanTimeout 例外
+#   フィールド指定（FieldRe）は、データ全体ではなくヘッダの索引のそのフィールドのみを検索
+def is_match(tg, re_list, pf_list=None, st_list=None, ord_list=None):
+    data = tg.data
+    memo = tg.memo
+    deadline = tg.deadline
     for re_i, ll in enumerate(re_list):
-        m = []
-        for L in ll:
-            r = L.search(data)
-            if r:
-                m.append(strip_ln(r.group(0)[:100]))
-            else:
+        if pf_list and not all(has_literal(tg, lit) for lit in pf_list[re_i]):
+            if st_list:
+                stat_skip(st_list[re_i])
+            continue
+        st = st_list and st_list[re_i]
+        m = {}
+        done = []
+        for t_i in ord_list and ord_list[re_i] or range(len(ll)):
+            L = ll[t_i]
+            r = memo.get(L, memo)
+            if r is memo:
+                if deadline:
+                    G.SCAN_CUR = (re_i, L.pattern)
+                targ = type(L) is FieldRe and tg.hdr or data
+                if st:
+                    t0 = time.perf_counter_ns()
+                    r = L.search(targ)
+                    done.append((t_i, time.perf_counter_ns() - t0))
+                else:
+                    r = L.search(targ)
+                r = memo[L] = r and strip_ln(r.group(0)[:100])
+                if deadline and time.perf_counter() > deadline:
+                    raise ScanTimeout(re_i, L.pattern)
+            if r is None:
                 break
-        else:
-            return  True, re_i, b", ".join(m)
+            m[t_i] = r
+        ret = len(m) == len(ll)
+        if st:
+            stat_rule(st, done, m)
+        if ret:
+            return  True, re_i, b", ".join(m[i] for i in range(len(ll)))
 
     return  False, -1, b""
 
+# 1ルール分の統計記録（done: 実際に検索した正規表現と所要時間、m: マッチしたもの）
+def stat_rule(st, done, m):
+    with G.STATS_LOCK:
+        st.evals += 1
+        st.hits += len(m) == len(st.terms)
+        ns = sum(x[1] for x in done)
+        st.ns += ns
+        st.max_ns = max(st.max_ns, ns)
+        for t_i, ns in done:
+            ts = st.terms[t_i]
+            ts.evals += 1
+            ts.hits += t_i in m
+            ts.ns += ns
+            ts.max_ns = max(ts.max_ns, ns)
+
+def stat_skip(st):
+    with G.STATS_LOCK:
+        st.skips += 1
+
+# ルール毎の統計オブジェクト（STATS_FILE 指定時のみ）
+#   ルールの内容をキーとするため、再ロード後も変更の無いルールの統計は引き継がれる
+def rule_stats(name, rules, stats):
+    ret = []
+    for ll in rules:
+        key = (name, tuple(ll))
+        st = stats.get(key) or (G.RULES and G.RULES.RULE_STATS.get(key))
+        if st is None:
+            st = Obj(key=key, evals=0, hits=0, skips=0, ns=0, max_ns=0,
+                     terms=[Obj(evals=0, hits=0, ns=0, max_ns=0) for _ in ll])
+        stats[key] = st
+        ret.append(st)
+    return ret
+
+# 統計の取り出し（値をリセット。SPAM判定プロセスプールから親プロセスへ渡す）
+def stats_take():
+    ret = []
+    with G.STATS_LOCK:
+        for st in G.RULES.RULE_STATS.values():
+            if st.evals or st.skips:
+                ret.append((st.key, (st.evals, st.hits, st.skips, st.ns, st.max_ns),
+                            [(ts.evals, ts.hits, ts.ns, ts.max_ns) for ts in st.terms]))
+                st.evals = st.hits = st.skips = st.ns = st.max_ns = 0
+                for ts in st.terms:
+                    ts.evals = ts.hits = ts.ns = ts.max_ns = 0
+        cs = G.CACHE_STAT
+        cache = (cs.hits, cs.misses, cs.bypass, cs.saved_ns)
+        cs.hits = cs.misses = cs.bypass = cs.saved_ns = 0
+    return ret, cache
+
+def stats_merge(stats):
+    rules, (hits, misses, bypass, saved_ns) = stats
+    with G.STATS_LOCK:
+        cs = G.CACHE_STAT
+        cs.hits += hits
+        cs.misses += misses
+        cs.bypass += bypass
+        cs.saved_ns += saved_ns
+        for key, (evals, hits, skips, ns, max_ns), terms in rules:
+            st = G.RULES.RULE_STATS.get(key)
+            if st is None:
+                continue
+            st.evals += evals
+            st.hits += hits
+            st.skips += skips
+            st.ns += ns
+            st.max_ns = max(st.max_ns, max_ns)
+            for ts, (evals, hits, ns, max_ns) in zip(st.terms, terms):
+                ts.evals += evals
+                ts.hits += hits
+                ts.ns += ns
+                ts.max_ns = max(ts.max_ns, max_ns)
+
+# 正規表現毎のコスト {"head"/"data": {pattern: [評価回数, ヒット数, 累計ns]}}
+#   実行時の統計（RULE_STATS）と RULE_COST_FILE の内容を合算
+def term_costs(rule_stats=None, base=None):
+    ret = {"head": {}, "data": {}}
+    for targ, d in (base or {}).items():
+        for pat, v in d.items():
+            ret.setdefault(targ, {})[pat] = list(v)
+    on_head = dict((x[0], x[1]) for x in CHECK_STAGES)
+    with G.STATS_LOCK:
+        for st in (rule_stats or {}).values():
+            d = ret[on_head[st.key[0]] and "head" or "data"]
+            for ts, pat in zip(st.terms, st.key[1]):
+                c = d.setdefault(term_key(pat).decode("latin-1"), [0, 0, 0])
+                c[0] += ts.evals
+                c[1] += ts.hits
+                c[2] += ts.ns
+    return ret
+
+# ルール内の正規表現の評価順
+#   期待コスト順（平均検索時間 / 不一致率）。統計が不足する場合は推定値
+#   （必須リテラルがあるか、フィールド指定なら低コスト、それ以外は高コスト）を用いる
+def rule_order(ll, costs, min_evals=20):
+    cl = [costs.get(L.pattern.decode("latin-1")) for L in ll]
+    if all(c and c[0] >= min_evals for c in cl):
+        est = [c[2] / c[0] / max(1 - c[1] / c[0], 0.001) for c in cl]
+    else:
+        est = [(type(L) is FieldRe or regex_literal(L)) and 1 or 10 for L in ll]
+    return tuple(sorted(range(len(ll)), key=lambda i: est[i]))
+
+#   costs が無ければ評価順の変更なし
+def build_order(obj, costs):
+    for name, on_head, _, re_name, _, _, ord_name in CHECK_STAGES:
+        c = costs and costs[on_head and "head" or "data"]
+        setattr(obj, ord_name, costs and [rule_order(ll, c) for ll in getattr(obj, re_name)] or None)
+
+def load_rule_cost(fname):
+    try:
+        return json.load(open(fname, encoding="utf8"))
+    except Exception:
+        return None
+
+def save_rule_cost(fname, costs):
+    tmp = fname + ".tmp"
+    with open(tmp, "w", encoding="utf8") as f:
+        json.dump(costs, f)
+    os.replace(tmp, fname)
+
+# 評価順の定期更新（RULE_OPTIMIZE）とコストファイルの保存（RULE_COST_FILE）
+#   SCAN_POOL 指定時は、コストを order_file に保存して版数（ORDER_VER）を更新し、
+#   プールの各プロセスは pool_check で版数の変更を検出して同じコストで評価順を更新する
+def optimize_proc(force=False):
+    now = time.time()
+    if not (G.RULE_OPTIMIZE or G.RULE_COST_FILE) or (not force and now - G.OPTIMIZE_TIME < G.STATS_INTERVAL):
+        return
+    G.OPTIMIZE_TIME = now
+    costs = term_costs(G.RULES.RULE_STATS, G.RULE_COST)
+    if G.RULE_OPTIMIZE:
+        rs = Obj(**G.RULES.__dict__)
+        build_order(rs, costs)
+        G.RULES = rs
+        if G.SCAN_EXEC:
+            try:
+                save_rule_cost(order_file(), costs)
+                G.ORDER_VER += 1
+            except Exception:
+                putlog(traceback.format_exc())
+    # 複数ワーカー時はワーカー0のみ保存
+    if G.RULE_COST_FILE and G.WORKER_IDX == 0:
+        try:
+            save_rule_cost(G.RULE_COST_FILE, costs)
+        except Exception:
+            putlog(traceback.format_exc())
+
+# SCAN_POOL のプロセスへ渡すコストのファイル（TMP_DIR。WORKERS 指定時はワーカー毎）
+def order_file():
+    return  logpath(G.WORKERS > 0 and "rule_order.w%d.json" % G.WORKER_IDX or "rule_order.json", False)
+
+# プールのプロセスでの評価順の更新（order は親プロセスの (ORDER_VER, order_file)）
+def order_apply(order):
+    ver, fname = order
+    if ver == G.RULES.ORDER_VER:
+        return
+    costs = load_rule_cost(fname)
+    if costs:
+        rs = Obj(**G.RULES.__dict__)
+        build_order(rs, costs)
+        rs.ORDER_VER = ver
+        G.RULES = rs
+
+# セッションの処理段階毎の所要時間（ns。tm は段階名をキーとする dict）
+#   conn: 中継先への接続、pre: DATA までの中継、data: DATA の受信、dec: デコード、
+#   wh/pc/wd/ch/cd: 検査段階（CHECK_STAGES の順）、log: ログ出力、
+#   reply: データ終端から最終応答の送信まで、total: セッション全体
+STAGE_TM = {"WHITE_HEAD": "wh", "PRECHK_HEAD": "pc", "WHITE_DATA": "wd", "CHECK_HEAD": "ch", "CHECK_DATA": "cd"}
+PHASES = ("conn", "pre", "data", "dec", "wh", "pc", "wd", "ch", "cd", "log", "reply", "total")
+PHASE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# t0 からの経過時間を tm[phase] に加算（現在時刻を返す。tm が None なら記録しない）
+def tm_add(tm, phase, t0):
+    now = time.perf_counter_ns()
+    if tm is not None:
+        tm[phase] = tm.get(phase, 0) + now - t0
+    return  now
+
+@contextlib.contextmanager
+def tm_phase(tm, phase):
+    t0 = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        tm_add(tm, phase, t0)
+
+# 判定ログ用の表記（ミリ秒）
+def tm_str(tm):
+    return  b' tm=<%s>' % b','.join(b'%s=%.2f' % (k.encode(), tm[k] / 1e6) for k in PHASES if k in tm)
+
+def tm_reply(param):
+    if param.t_eod and "reply" not in param.tm:
+        tm_add(param.tm, "reply", param.t_eod)
+
+# セッション終了時のヒストグラムへの集計
+def hist_add(tm):
+    with G.STATS_LOCK:
+        for k, ns in tm.items():
+            h = G.PHASE_HIST.get(k)
+            if h is None:
+                h = G.PHASE_HIST[k] = Obj(cnt=[0] * (len(PHASE_BUCKETS) + 1), n=0, ns=0, max_ns=0)
+            h.cnt[bisect.bisect_left(PHASE_BUCKETS, ns / 1e9)] += 1
+            h.n += 1
+            h.ns += ns
+            h.max_ns = max(h.max_ns, ns)
+
+# ヒストグラムからの分位点（その値を含むバケットの上限。最後のバケットは最大値）
+def hist_quantile(h, q):
+    c = 0
+    for i, x in enumerate(h.cnt):
+        c += x
+        if c >= h.n * q:
+            break
+    return  i < len(PHASE_BUCKETS) and min(PHASE_BUCKETS[i], h.max_ns / 1e9) or h.max_ns / 1e9
+
+# ヒストグラムのログ出力（SIGUSR1）
+def hist_dump():
+    with G.STATS_LOCK:
+        hl = [(k, Obj(**G.PHASE_HIST[k].__dict__)) for k in PHASES if k in G.PHASE_HIST]
+    wk = G.WORKERS > 0 and "worker %d " % G.WORKER_IDX or ""
+    putlog("%sphase timing (ms): %d sessions" % (wk, G.PHASE_HIST.get("total", Obj(n=0)).n))
+    for k, h in hl:
+        putlog("  %-5s n=%d avg=%.2f p50<=%.2f p95<=%.2f p99<=%.2f max=%.2f" % (
+               k, h.n, h.ns / h.n / 1e6, hist_quantile(h, 0.5) * 1000, hist_quantile(h, 0.95) * 1000,
+               hist_quantile(h, 0.99) * 1000, h.max_ns / 1e6))
+
+# SIGUSR1 の処理（定期処理から呼び出す）
+#   PROFILE_SESSIONS > 0 なら、以降の PROFILE_SESSIONS 件の検査のプロファイルを開始
+def dump_proc():
+    if not G.DUMP_REQ:
+        return
+    G.DUMP_REQ = False
+    hist_dump()
+    if G.PROFILE_SESSIONS > 0 and G.PROF is None:
+        profile_start(G.PROFILE_MODE, G.PROFILE_SESSIONS)
+
+# プロファイル（mode: "cprofile" は検査部分の関数毎の時間、"tracemalloc" はメモリ確保の増分）
+#   cprofile は同時には1セッションのみ（並行する他のセッションは対象外）
+def profile_start(mode, num):
+    pf = Obj(mode=mode, left=num, n=0, stats=[], lock=threading.Lock(), snap=None)
+    if mode == "tracemalloc":
+        tracemalloc.start()
+        pf.snap = tracemalloc.take_snapshot()
+    G.PROF = pf
+    putlog("profiling next %d sessions (%s)" % (num, mode))
+
+# 1セッション分のプロファイル（local が偽なら cProfile はプール側で行い、結果を smp.stats に設定）
+@contextlib.contextmanager
+def profile_session(local=True):
+    pf = G.PROF
+    if pf is None or not pf.lock.acquire(False):
+        yield None
+        return
+    smp = Obj(mode=pf.mode, prof=local and pf.mode == "cprofile" and cProfile.Profile() or None, stats=None)
+    try:
+        if smp.prof:
+            smp.prof.enable()
+        yield smp
+    finally:
+        if smp.prof:
+            smp.prof.disable()
+            smp.stats = prof_stats(smp.prof)
+        try:
+            profile_add(pf, smp.stats)
+        finally:
+            pf.lock.release()
+
+# cProfile の結果（プールから受け渡せる dict）
+def prof_stats(prof):
+    prof.create_stats()
+    return  prof.stats
+
+def profile_add(pf, stats):
+    if stats:
+        pf.stats.append(stats)
+    pf.n += 1
+    pf.left -= 1
+    if pf.left <= 0 and G.PROF is pf:
+        G.PROF = None
+        profile_write(pf)
+
+# プロファイル結果の出力（TMP_DIR/profile_YYYYmmdd_HHMMSS.txt）
+def profile_write(pf):
+    wk = G.WORKERS > 0 and "_w%d" % G.WORKER_IDX or ""
+    fname = logpath("profile_%s%s.txt" % (time.strftime("%Y%m%d_%H%M%S"), wk), False)
+    buf = io.StringIO()
+    if pf.mode == "tracemalloc":
+        snap = tracemalloc.take_snapshot()
+        cur, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        buf.write("%d sessions, traced current=%d peak=%d\n" % (pf.n, cur, peak))
+        for st in snap.compare_to(pf.snap, "lineno")[:40]:
+            buf.write("%s\n" % st)
+    elif pf.stats:
+        ps = pstats.Stats(Obj(stats=pf.stats[0], create_stats=lambda: None), stream=buf)
+        for stats in pf.stats[1:]:
+            ps.add(Obj(stats=stats, create_stats=lambda: None))
+        buf.write("%d sessions\n" % pf.n)
+        ps.sort_stats("cumulative").print_stats(40)
+    else:
+        buf.write("%d sessions, no samples\n" % pf.n)
+    with open(fname, "w", encoding="utf8") as f:
+        f.write(buf.getvalue())
+    putlog("profile done (%d sessions) to %s" % (pf.n, fname))
+
+def prom_label(s):
+    s = bytes2str(s)[:100]
+    return s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# 統計ファイル（Prometheus テキスト形式）の出力
+#   STATS_INTERVAL 秒毎に書き換える（ワーカーモードではワーカー毎のファイル）
+def stats_proc(force=False):
+    now = time.time()
+    if not G.STATS_FILE or (not force and now - G.STATS_TIME < G.STATS_INTERVAL):
+        return
+    G.STATS_TIME = now
+
+    path = G.STATS_FILE
+    label = ''
+    if G.WORKERS > 0:
+        root, ext = os.path.splitext(path)
+        path = "%s.w%d%s" % (root, G.WORKER_IDX, ext)
+        label = 'worker="%d",' % G.WORKER_IDX
+
+    rs = G.RULES
+    rule_l = []
+    term_l = []
+    with G.STATS_LOCK:
+        for name, _, _, _, _, st_name, _ in CHECK_STAGES:
+            for re_i, st in enumerate(getattr(rs, st_name) or []):
+                lb = '%slist="%s",rule="%d"' % (label, name, re_i)
+                rule_l.append((lb, st.evals, st.hits, st.skips, st.ns, st.max_ns))
+                for t_i, (ts, pat) in enumerate(zip(st.terms, st.key[1])):
+                    tlb = '%s,term="%d",pattern="%s"' % (lb, t_i, prom_label(term_key(pat)))
+                    term_l.append((tlb, ts.evals, ts.hits, ts.ns, ts.max_ns))
+
+    out = []
+    def metric(name, typ, help_s, vals):
+        out.append("# HELP content_filter_%s %s" % (name, help_s))
+        out.append("# TYPE content_filter_%s %s" % (name, typ))
+        out.extend("content_filter_%s%s %s" % (name, lb and "{%s}" % lb, v) for lb, v in vals)
+
+    metric("rule_evals_total", "counter", "Rule evaluations.", [(x[0], x[1]) for x in rule_l])
+    metric("rule_hits_total", "counter", "Rule matches.", [(x[0], x[2]) for x in rule_l])
+    metric("rule_skips_total", "counter", "Rules skipped by the literal prefilter.", [(x[0], x[3]) for x in rule_l])
+    metric("rule_seconds_total", "counter", "Cumulative search time of a rule.", [(x[0], x[4] / 1e9) for x in rule_l])
+    metric("rule_max_seconds", "gauge", "Longest search time of a rule.", [(x[0], x[5] / 1e9) for x in rule_l])
+    metric("term_evals_total", "counter", "Regex evaluations inside a rule.", [(x[0], x[1]) for x in term_l])
+    metric("term_hits_total", "counter", "Regex matches inside a rule.", [(x[0], x[2]) for x in term_l])
+    metric("term_seconds_total", "counter", "Cumulative search time of a regex.", [(x[0], x[3] / 1e9) for x in term_l])
+    metric("term_max_seconds", "gauge", "Longest search time of a regex.", [(x[0], x[4] / 1e9) for x in term_l])
+    label = label.rstrip(",")
+    if G.LOG_QUEUE:
+        metric("log_queue_bytes", "gauge", "Bytes waiting in the log writer queue.", [(label, G.LOG_QUEUE.size)])
+        metric("log_dropped_total", "counter", "Log dumps dropped because the queue was full.", [(label, G.LOG_QUEUE.dropped)])
+    with G.ADMIT_COND:
+        adm = Obj(**G.ADMIT.__dict__)
+    metric("sessions_active", "gauge", "Relay sessions in progress.", [(label, adm.sessions)])
+    metric("sessions_waiting", "gauge", "Accepted sessions waiting for a free slot.", [(label, adm.waiting)])
+    metric("sessions_total", "counter", "Relay sessions started.", [(label, adm.sessions_total)])
+    metric("sessions_rejected_total", "counter", "Sessions answered with 421 because of overload.", [(label, adm.sessions_rejected)])
+    metric("scans_active", "gauge", "Message scans in progress.", [(label, adm.scans)])
+    metric("scans_rejected_total", "counter", "Messages answered with 451 because of overload.", [(label, adm.scans_rejected)])
+    metric("buffered_bytes", "gauge", "Session data held in memory.", [(label, adm.mem)])
+    with G.STATS_LOCK:
+        hl = [(k, Obj(**G.PHASE_HIST[k].__dict__)) for k in PHASES if k in G.PHASE_HIST]
+    if hl:
+        out.append("# HELP content_filter_phase_seconds Time spent in each phase of a session.")
+        out.append("# TYPE content_filter_phase_seconds histogram")
+        for k, h in hl:
+            lb = '%sphase="%s"' % (label and label + ",", k)
+            c = 0
+            for le, x in zip(PHASE_BUCKETS + ("+Inf",), h.cnt):
+                c += x
+                out.append('content_filter_phase_seconds_bucket{%s,le="%s"} %d' % (lb, le, c))
+            out.append("content_filter_phase_seconds_sum{%s} %s" % (lb, h.ns / 1e9))
+            out.append("content_filter_phase_seconds_count{%s} %d" % (lb, h.n))
+    if rs.VERDICT_CACHE:
+        cs = G.CACHE_STAT
+        metric("verdict_cache_hits_total", "counter", "Messages judged from the verdict cache.", [(label, cs.hits)])
+        metric("verdict_cache_misses_total", "counter", "Messages not found in the verdict cache.", [(label, cs.misses)])
+        metric("verdict_cache_bypass_total", "counter", "Messages not cacheable (rules match ignored header lines).", [(label, cs.bypass)])
+        metric("verdict_cache_saved_seconds_total", "counter", "Search time saved by the verdict cache.", [(label, cs.saved_ns / 1e9)])
+        metric("verdict_cache_entries", "gauge", "Entries in the verdict cache.", [(label, len(rs.VERDICT_CACHE.d))])
+    if G.REPUTATION:
+        rp = G.REP_STAT
+        metric("reputation_rejected_total", "counter", "DATA commands rejected by client reputation.", [(label, rp.rejected)])
+        metric("reputation_tempfailed_total", "counter", "DATA commands answered with 451 by client reputation.", [(label, rp.tempfailed)])
+        metric("reputation_good_total", "counter", "Messages from well-reputed clients scanned without CHECK_DATA.", [(label, rp.good)])
+        metric("reputation_entries", "gauge", "Entries in the client reputation cache.", [(label, len(G.REPUTATION.d))])
+
+    try:
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf8") as f:
+            f.write("\n".join(out) + "\n")
+        os.replace(tmp, path)
+    except Exception:
+        putlog(traceback.format_exc())
+
 def replace_re_data(re_obj, data):
-    ret = b''
     m = re_obj.search(data)
-    if m:
-        targ = m[0]
-        try:
-            dd = email.header.decode_header(targ.decode("utf8"))
-            ss = b""
-            for s, enc in dd:
-                if enc:
-                    ss += s.decode(enc, "ignore").encode("utf8")
-                else:
-                    ss += s
+    if m and b'=?' in m[0]:
+        ss = decode_words(m[0], "ignore")
+        if ss is not m[0]:
             data = data[:m.start()] + ss + data[m.end():]
-        except Exception as e:
-            #print("exp", e)
-            pass
     return data
 
-def get_re_data(re_obj, data):
-    ret = b''
-    m = re_obj.search(data)
-    if m:
-        ret = m.groups()[0]
-        try:
-            dd = email.header.decode_header(ret.decode("utf8"))
-            ss = b""
-            for s, enc in dd:
-                if enc:
-                    ss += s.decode(enc).encode("utf8")
-                else:
-                    ss += s
-            ret = ss
-        except Exception as e:
-            # print("exp", e)
-            pass
-    return ret
+# RFC 2047 の encoded-word のデコード（文字コードは UTF-8 へ）
+#   encoded-word が無い、またはデコードできない場合はそのまま返す
+def decode_words(s, errors="strict"):
+    if b'=?' not in s:
+        return s
+    try:
+        ss = b""
+        for x, enc in email.header.decode_header(s.decode("utf8")):
+            if enc:
+                ss += x.decode(enc, errors).encode("utf8")
+            else:
+                ss += x
+        return ss
+    except Exception:
+        return s
+
+# ヘッダの索引 {フィールド名（小文字）: [値, ...]}
+#   継続行は連結し、encoded-word はデコードする
+#   （データ先頭の SMTPコマンドも "mail from", "rcpt to" として含まれる）
+def header_index(head):
+    idx = {}
+    vals = None
+    for L in head.split(b'\r\n'):
+        if L[:1] in (b' ', b'\t'):
+            if vals:
+                vals[-1] += L
+            continue
+        name, sep, val = L.partition(b':')
+        if not sep:
+            vals = None
+            continue
+        vals = idx.setdefault(bytes(name.strip().lower()), [])
+        vals.append(val)
+    for vals in idx.values():
+        vals[:] = [decode_words(bytes(x.strip())) for x in vals]
+    return idx
+
+# 検査対象データのヘッダの索引（最初に必要になった時点で作成し、以降は共有）
+def header_ref(head):
+    return Obj(head=head, idx=None)
+
+def header_of(hdr):
+    if hdr.idx is None:
+        hdr.idx = header_index(hdr.head)
+    return hdr.idx
+
+# ヘッダフィールドを対象とする正規表現（spam_dat のルールの ("Subject", rb'...') 指定）
+#   同名のフィールドが複数あれば、値毎に検索（^ や $ は各値の先頭・末尾）。フィールドが無ければ不一致
+class FieldRe:
+    def __init__(self, field, r):
+        self.field = field.strip().rstrip(b':').lower()
+        self.re = r
+        self.pattern = term_key((field, r.pattern))
+
+    def search(self, hdr):
+        idx = header_of(hdr) if isinstance(hdr, Obj) else header_index(hdr)
+        for val in idx.get(self.field, ()):
+            m = self.re.search(val)
+            if m:
+                return m
+        return None
+
+# ルールの要素の表示・統計用のキー（フィールド指定は "Subject=~正規表現"）
+def term_key(x):
+    return x if type(x) == bytes else b'%s=~%s' % x
 
 # Received-SPF: は最初の1つのみ有効に
 def dedup_spf_header(head_data):
+    if len(SPF_LINE_RE.findall(head_data)) < 2:
+        return head_data
     headers = head_data.split(b'\r\n')
     spf_key = b'Received-SPF:'.lower()
     is_spf = False
@@ -296,14 +1387,355 @@ def dedup_spf_header(head_data):
 
     return b"\r\n".join(lines)
 
-#スパム判定
-def is_spam(data, msg_id, t, fname=None):
-    head = data.split(b'\r\n\r\n')[0]
-    head = dedup_spf_header(head)
+# 検査順の定義
+#   (ルール名, ヘッダのみ検査か, ホワイトリストか, 正規表現リスト, 前置フィルタ, 統計, 評価順)
+CHECK_STAGES = [
+    ("WHITE_HEAD",  True,  True,  "WHITE_HEAD_RE",  "WHITE_HEAD_PF",  "WHITE_HEAD_ST",  "WHITE_HEAD_ORD"),
+    ("PRECHK_HEAD", True,  False, "PRECHK_HEAD_RE", "PRECHK_HEAD_PF", "PRECHK_HEAD_ST", "PRECHK_HEAD_ORD"),
+    ("WHITE_DATA",  False, True,  "WHITE_RE",       "WHITE_PF",       "WHITE_ST",       "WHITE_ORD"),
+    ("CHECK_HEAD",  True,  False, "CHECK_HEAD_RE",  "CHECK_HEAD_PF",  "CHECK_HEAD_ST",  "CHECK_HEAD_ORD"),
+    ("CHECK_DATA",  False, False, "CHECK_RE",       "CHECK_PF",       "CHECK_ST",       "CHECK_ORD"),
+]
+
+# スパム判定本体（ログ出力なし）
+#   kind: "white" / "spam" / "pass"、name: マッチしたルール名
+#   ルールセットは最初に1度だけ参照する（再ロード中でも新旧が混ざらない）
+#   head_tg（judge_head で検査済みのヘッダの検査対象）があれば、ヘッダの項の検査結果を再利用する
+#   rep_good（評価の良い接続元）なら CHECK_DATA を省略
+def judge_spam(data, head_tg=None, rep_good=False):
+    with scan_budget() as deadline:
+        return  judge_stages(data, deadline, head_tg, rep_good)
+
+# ヘッダの検査対象（SPFヘッダの重複除去、ヘッダフィールドの索引付き）
+def head_target(head, deadline=None):
+    hdr = header_ref(dedup_spf_header(head))
+    return  scan_target(hdr.head, deadline, hdr=hdr)
+
+def judge_stages(data, deadline, head_tg=None, rep_good=False):
+    rs = G.RULES
+    idx = data.find(b'\r\n\r\n')
+    head = bytes(data[:idx] if idx >= 0 else data)
+    ent = rs.VERDICT_CACHE and cache_entry(rs, data, head, idx)
+    if head_tg is None or head_tg.data != dedup_spf_header(head):
+        head_tg = head_target(head)
+    head_tg.deadline = deadline
+    hdr = head_tg.hdr
+    data_tg = scan_target(data, deadline, rs.LITERALS, hdr)
+    hit = None
+    tm = {}
+
+    for name, on_head, is_white, re_name, pf_name, st_name, ord_name in CHECK_STAGES:
+        if rep_good and name == "CHECK_DATA":
+            continue
+        t0 = time.perf_counter_ns()
+        # 本文検査の結果はキャッシュを利用（ヘッダのみの検査は毎回行う）
+        #   一致の結果はキーから除いたヘッダ行（本文に跨るもの・先読み等を含む）に依存し得るため、
+        #   一致したルールのみこのメールで確かめ、一致しなければ通常の検査とする（キャッシュは更新しない）
+        r = ent and not on_head and ent.res.get(name)
+        try:
+            if r and r[0]:
+                ok, _, ms = is_match(data_tg, [getattr(rs, re_name)[r[1]]])
+                r = ok and (True, r[1], ms, r[3])
+            if r:
+                hit = hit is not False
+                ret, re_i, ms, ns = r
+                with G.STATS_LOCK:
+                    G.CACHE_STAT.saved_ns += ns
+            else:
+                ret, re_i, ms = is_match(on_head and head_tg or data_tg, getattr(rs, re_name), getattr(rs, pf_name),
+                                         getattr(rs, st_name), getattr(rs, ord_name))
+                if ent and not on_head:
+                    hit = False
+                    if r is None:
+                        ent.res[name] = (ret, re_i, ms, time.perf_counter_ns() - t0)
+        except ScanTimeout as e:
+            e.name = name
+            raise
+        tm_add(tm, STAGE_TM[name], t0)
+        if ret:
+            break
+    else:
+        name = ""
+
+    if ent:
+        with G.STATS_LOCK:
+            if hit:
+                G.CACHE_STAT.hits += 1
+            elif hit is False:
+                G.CACHE_STAT.misses += 1
+
+    if name:
+        return  Obj(kind=is_white and "white" or "spam", name=name, re_i=re_i, ms=ms, rule=getattr(rs, name)[re_i],
+                    hdr=hdr, tm=tm)
+
+    return  Obj(kind="pass", name="", re_i=-1, ms=b"", rule=[], hdr=hdr, tm=tm)
+
+# ヘッダのみでの判定（判定が確定しない場合は None）
+#   WHITE_HEAD・PRECHK_HEAD の一致、WHITE_DATA が空の場合は CHECK_HEAD の一致で確定
+#   （judge_spam と同じ順で、本文の検査が必要になった時点で打ち切る）
+#   head_tg は head_target の結果（データ終了時の judge_spam で再利用される）
+def judge_head(head_tg):
+    rs = G.RULES
+    with scan_budget() as deadline:
+        head_tg.deadline = deadline
+        hdr = head_tg.hdr
+        tm = {}
+
+        for name, on_head, is_white, re_name, pf_name, st_name, ord_name in CHECK_STAGES:
+            if not on_head:
+                if getattr(rs, name):
+                    return  None
+                continue
+            t0 = time.perf_counter_ns()
+            ret, re_i, ms = is_match(head_tg, getattr(rs, re_name), getattr(rs, pf_name),
+                                     getattr(rs, st_name), getattr(rs, ord_name))
+            tm_add(tm, STAGE_TM[name], t0)
+            if ret:
+                return  Obj(kind=is_white and "white" or "spam", name=name, re_i=re_i, ms=ms, rule=getattr(rs, name)[re_i],
+                            hdr=hdr, tm=tm)
+
+    return  None
+
+# 1メッセージの検査時間の上限（budget 秒。省略時は SCAN_TIME_BUDGET）
+#   メインスレッド（SPAM判定プロセスプール内、-f, -c）ではタイマーで正規表現の実行中でも中断し、
+#   それ以外のスレッドでは正規表現毎の検索後に超過を判定する
+@contextlib.contextmanager
+def scan_budget(budget=None):
+    budget = budget or G.SCAN_TIME_BUDGET
+    if not budget:
+        yield None
+        return
+    timer = threading.current_thread() is threading.main_thread()
+    if timer:
+        G.SCAN_CUR = None
+        signal.signal(signal.SIGALRM, scan_alarm)
+        G.SCAN_ARMED = True
+        signal.setitimer(signal.ITIMER_REAL, budget)
+    try:
+        yield time.perf_counter() + budget
+    finally:
+        if timer:
+            G.SCAN_ARMED = False
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+def scan_alarm(k, s):
+    if G.SCAN_ARMED:
+        G.SCAN_ARMED = False
+        raise ScanTimeout(*(G.SCAN_CUR or (-1, b'')))
+
+# 判定キャッシュ（LRU、エントリ数と有効期限で制限）
+#   再ロード時に作り直すため、ルール変更後に古い判定が使われることはない
+def verdict_cache(size, ttl):
+    return  size > 0 and Obj(size=size, ttl=ttl, d=collections.OrderedDict(), lock=threading.Lock()) or None
+
+# 判定キャッシュのエントリ取得（無ければ空のエントリを登録）
+#   キーは本文と、メール毎に変わるヘッダ行（CACHE_IGNORE_RE）を除いたヘッダのハッシュ
+#   除いた行に本文検査の正規表現のマッチが掛かる（隣の行に跨るものを含む）場合は判定が変わり得るため、キャッシュしない
+#   （一致の結果は judge_stages でそのルールのみ確かめ直す）
+def cache_entry(rs, data, head, idx):
+    h = hashlib.blake2b(digest_size=20)
+    vol = []
+    spans = []      # 除いた行のヘッダ内の範囲
+    skip = False
+    pos = 0
+    for ln in head.split(b"\r\n"):
+        if ln[:1] not in (b" ", b"\t"):
+            skip = rs.CACHE_IGNORE_RE.match(ln)
+        if skip:
+            vol.append(ln)
+            spans.append((pos, pos + len(ln) + 2))
+        else:
+            h.update(ln)
+            h.update(b"\n")
+        pos += len(ln) + 2
+    vol = b"\r\n".join(vol)
+    if vol and any(L.search(vol) if type(L) is FieldRe else ignored_overlap(L, head + b"\r\n\r\n", spans)
+                   for L in rs.CACHE_TERMS):
+        with G.STATS_LOCK:
+            G.CACHE_STAT.bypass += 1
+        return  None
+    if idx >= 0:
+        with memoryview(data) as mv, mv[idx:] as body:
+            h.update(body)
+    key = h.digest()
+
+    c = rs.VERDICT_CACHE
+    now = time.monotonic()
+    with c.lock:
+        ent = c.d.get(key)
+        if ent is None or ent.expire < now:
+            ent = c.d[key] = Obj(expire=now + c.ttl, res={})
+            if len(c.d) > c.size:
+                c.d.popitem(last=False)
+        else:
+            c.d.move_to_end(key)
+    return  ent
+
+# ヘッダ内の正規表現のマッチ（開始位置が異なる全てのもの）が、spans のいずれかの範囲に掛かるか
+#   最後の範囲より後から始まるマッチは掛からないため、そこで打ち切る
+def ignored_overlap(r, head, spans):
+    pos = 0
+    while pos < spans[-1][1]:
+        m = r.search(head, pos)
+        if m is None:
+            return  False
+        s, e = m.start(), max(m.end(), m.start() + 1)
+        if any(s < ve and e > vs for vs, ve in spans):
+            return  True
+        pos = s + 1
+    return  False
 
-    # ホワイトリスト検査(head)
-    ret, re_i, ms = is_match(head, G.WHITE_HEAD_RE)
+# 接続元の評価キャッシュ（LRU、エントリ数と有効期限で制限。再ロードではクリアせず、サイズのみ変更）
+#   キーは (種類, 値)（reputation_keys）、値は最後の判定から REPUTATION_TTL 秒以内の spam / spam以外の判定数
+#   WORKERS 指定時はワーカー毎
+REP_ATTRS = {"addr": b"ADDR", "net": b"ADDR", "name": b"NAME", "helo": b"HELO"}
+REP_UNKNOWN = (b"", b"[unavailable]", b"[tempunavail]", b"unknown")
+XFORWARD_ATTR_RE = re.compile(rb'([A-Za-z]+)=(\S*)')
+
+def reputation_init():
+    if G.REPUTATION_SIZE <= 0:
+        G.REPUTATION = None
+    elif G.REPUTATION is None:
+        G.REPUTATION = Obj(d=collections.OrderedDict(), lock=threading.Lock(), loaded=False)
+
+# XFORWARD の属性（NAME, ADDR, HELO 等。複数のコマンドに分かれる場合は順に追加）
+def xforward_attrs(client, data):
+    for L in data.split(b'\r\n'):
+        if L[:9].upper() == b'XFORWARD ':
+            client.update((k.upper(), v) for k, v in XFORWARD_ATTR_RE.findall(L[9:]))
+
+# 評価キャッシュのキー（REPUTATION_KEYS の順。不明な値は除く。"net" は ADDR の /24（IPv6 は /64））
+def reputation_keys(client):
+    ret = []
+    for kind in G.REPUTATION_KEYS:
+        v = client.get(REP_ATTRS[kind], b'').lower()
+        if kind == "net":
+            v = client_net(v)
+        if v not in REP_UNKNOWN:
+            ret.append((kind, v))
+    return  ret
+
+def client_net(addr):
+    try:
+        ip = ipaddress.ip_address((addr[:5] == b"ipv6:" and addr[5:] or addr).decode())
+        return  ipaddress.ip_network("%s/%d" % (ip, ip.version == 4 and 24 or 64), strict=False).with_prefixlen.encode()
+    except ValueError:
+        return  b''
+
+# 判定結果の記録（DATA コマンドで評価したセッションのみ）
+#   全て検査したセッションなので、CHECK_DATA を省略した回数（skip）は 0 に戻す
+def reputation_add(param, spam):
+    c = G.REPUTATION
+    if c is None or not param.rep_keys:
+        return
+    now = time.time()
+    with c.lock:
+        for key in param.rep_keys:
+            ent = c.d.get(key)
+            if ent is None or ent.expire < now:
+                ent = c.d[key] = Obj(spam=0, good=0, skip=0, expire=0)
+            c.d.move_to_end(key)
+            ent.expire = now + G.REPUTATION_TTL
+            ent.skip = 0
+            if spam:
+                ent.spam += 1
+            else:
+                ent.good += 1
+        while len(c.d) > G.REPUTATION_SIZE:
+            c.d.popitem(last=False)
+
+# 接続元の評価（DATA コマンドの時点。本文の受信・デコード前に判定）
+#   spam 判定数が REPUTATION_REJECT 以上のキーがあれば拒否（SpamError）、REPUTATION_TEMPFAIL 以上なら一時エラー
+#   （spam 判定が spam以外の判定より少ないキーは対象外。共有の中継サーバ等）
+#   全キーが REPUTATION_GOOD 件以上 spam以外と判定され、spam 判定が無ければ、CHECK_DATA を省略（rep_good）
+#   ただし REPUTATION_RECHECK 件に1件は省略せずに検査する（評価の良い接続元からの spam で評価が下がるように）
+def reputation_check(param):
+    c = G.REPUTATION
+    if c is None:
+        return
+    param.rep_keys = reputation_keys(param.client)
+    now = time.time()
+    bad = None
+    good = G.REPUTATION_GOOD > 0 and bool(param.rep_keys)
+    recheck = G.REPUTATION_RECHECK
+    with c.lock:
+        ents = []
+        for key in param.rep_keys:
+            ent = c.d.get(key)
+            if ent is None or ent.expire < now:
+                good = False
+                continue
+            ents.append(ent)
+            if ent.spam >= ent.good and (bad is None or ent.spam > bad[1].spam):
+                bad = (key, Obj(**ent.__dict__))
+            good = good and ent.spam == 0 and ent.good >= G.REPUTATION_GOOD and not (recheck and ent.skip + 1 >= recheck)
+        if good:
+            for ent in ents:
+                ent.skip += 1
+    if bad:
+        (kind, v), ent = bad
+        for th, action in ((G.REPUTATION_REJECT, "reject"), (G.REPUTATION_TEMPFAIL, "tempfail")):
+            if th and ent.spam >= th:
+                putlog(b"reputation %s %s=%s spam=%d good=%d" % (action.encode(), kind.encode(), v, ent.spam, ent.good))
+                with G.STATS_LOCK:
+                    if action == "reject":
+                        G.REP_STAT.rejected += 1
+                    else:
+                        G.REP_STAT.tempfailed += 1
+                raise SpamError() if action == "reject" else BadReputation()
+    if good:
+        param.rep_good = True
+        with G.STATS_LOCK:
+            G.REP_STAT.good += 1
+
+# 評価キャッシュの保存（REPUTATION_FILE。STATS_INTERVAL 秒毎と終了時。最初の呼び出しで読み込み）
+#   WORKERS 指定時は、ワーカー毎に xxx.w0.json のようなファイルとなる
+def reputation_proc(force=False):
+    c = G.REPUTATION
+    if c is None or not G.REPUTATION_FILE:
+        return
+    path = G.REPUTATION_FILE
+    if G.WORKERS > 0:
+        root, ext = os.path.splitext(path)
+        path = "%s.w%d%s" % (root, G.WORKER_IDX, ext)
+    now = time.time()
+    if not c.loaded:
+        c.loaded = True
+        G.REP_TIME = now
+        try:
+            reputation_load(c, path, now)
+        except FileNotFoundError:
+            pass
+        except Exception:
+            putlog(traceback.format_exc())
+    if not force and now - G.REP_TIME < G.STATS_INTERVAL:
+        return
+    G.REP_TIME = now
+    with c.lock:
+        ll = [[k, v.decode("latin-1"), e.spam, e.good, e.expire] for (k, v), e in c.d.items() if e.expire >= now]
+    try:
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf8") as f:
+            json.dump(ll, f)
+        os.replace(tmp, path)
+    except Exception:
+        putlog(traceback.format_exc())
 
+def reputation_load(c, path, now):
+    with open(path, encoding="utf8") as f:
+        ll = json.load(f)
+    with c.lock:
+        for k, v, spam, good, expire in ll[-G.REPUTATION_SIZE:]:
+            if expire >= now and k in REP_ATTRS:
+                c.d[(k, v.encode("latin-1"))] = Obj(spam=spam, good=good, skip=0, expire=expire)
+
+#スパム判定
+#   v（judge_head の結果）があれば、それを判定結果とする
+#   skipped（skip_summary）は検査対象外としたパートで、ログに付加する
+#   検査時間を超過した場合、SCAN_TIMEOUT_ACTION が "pass" なら通過、それ以外は ScanTimeout 例外
+#   tm（セッションの処理段階毎の所要時間）があれば検査段階の時間を加算し、判定ログに付加する
+#   rep_good（評価の良い接続元）なら CHECK_DATA を省略し、判定ログに rep=good を付加する
+def is_spam(data, msg_id, t, fname=None, v=None, skipped=b'', tm=None, head_tg=None, rep_good=False):
     if fname:
         sdecfn = fname
         spamfn = fname
@@ -312,58 +1744,47 @@ def is_spam(data, msg_id, t, fname=None):
         spamfn = spam_fname(t).encode("utf8")
     lim_num = G.VERBOSE and 1000 or 100
 
-    if ret:
-        putlog(b'pass-white f=%s msg_id=%s WHITE_HEAD(%d) = [ %.*s ] m=<%s>\r\n' % (sdecfn, msg_id, re_i, lim_num, strip_ln(b', '.join(G.WHITE_HEAD[re_i])), ms))
-        return  False
-
-    # スパム検査(prehead)
-    ret, re_i, ms = is_match(head, G.PRECHK_HEAD_RE)
-    if ret:
-        subject = get_re_data(SUBJECT_RE, data)
-        from_s  = get_re_data(FROM_RE, data)
-        to_s    = get_re_data(TO_RE, data)
-        strip_s = strip_ln(b', '.join(G.PRECHK_HEAD[re_i]))
-        msg = b'SPAM is detected. f=%s msg_id=%s PRECHK_HEAD(%d) = [ %.*s ] m=<%s> from=<%s> to=<%s> s=<%s>\r\n' % (spamfn, msg_id, re_i, lim_num, strip_s, ms, from_s, to_s, subject)
-        putlog(msg)
-        spam_log(msg, data, t)
-        return True
-
-    # ホワイトリスト検査(body)
-    ret, re_i, ms = is_match(data, G.WHITE_RE)
-    if ret:
-        putlog(b'pass-white f=%s msg_id=%s WHITE_DATA(%d) = [ %.*s ] m=<%s>\r\n' % (sdecfn, msg_id, re_i, lim_num, strip_ln(b', '.join(G.WHITE_DATA[re_i])), ms))
+    tm = {} if tm is None else tm
+    if rep_good:
+        skipped += b' rep=good'
+    try:
+        v = v or judge_spam(data, head_tg, rep_good)
+    except ScanTimeout as e:
+        putlog(b'scan timeout f=%s msg_id=%s %s(%d) = [ %.*s ] action=%s%s' % (sdecfn, msg_id, e.name.encode(), e.re_i,
+               lim_num, strip_ln(e.pattern), G.SCAN_TIMEOUT_ACTION.encode(), tm_str(tm)))
+        if G.SCAN_TIMEOUT_ACTION == "pass":
+            return  False
+        raise
+    for k, ns in v.tm.items():
+        tm[k] = tm.get(k, 0) + ns
+
+    if v.kind == "white":
+        strip_s = strip_ln(b', '.join(map(term_key, v.rule)))
+        putlog(b'pass-white f=%s msg_id=%s %s(%d) = [ %.*s ] m=<%s>%s%s\r\n' % (sdecfn, msg_id, v.name.encode(), v.re_i, lim_num, strip_s, v.ms, skipped, tm_str(tm)))
         return  False
 
-    # スパム検査(head)
-    ret, re_i, ms = is_match(head, G.CHECK_HEAD_RE)
-    if ret:
-        subject = get_re_data(SUBJECT_RE, data)
-        from_s  = get_re_data(FROM_RE, data)
-        to_s    = get_re_data(TO_RE, data)
-        strip_s = strip_ln(b', '.join(G.CHECK_HEAD[re_i]))
-        msg = b'SPAM is detected. f=%s msg_id=%s CHECK_HEAD(%d) = [ %.*s ] m=<%s> from=<%s> to=<%s> s=<%s>\r\n' % (spamfn, msg_id, re_i, lim_num, strip_s, ms, from_s, to_s, subject)
-        putlog(msg)
-        spam_log(msg, data, t)
-        return True
-
-    # スパム検査(body)
-    ret, re_i, ms = is_match(data, G.CHECK_RE)
-    if ret:
-        subject = get_re_data(SUBJECT_RE, data)
-        from_s  = get_re_data(FROM_RE, data)
-        to_s    = get_re_data(TO_RE, data)
-        strip_s = strip_ln(b', '.join(G.CHECK_DATA[re_i]))
-        msg = b'SPAM is detected. f=%s msg_id=%s CHECK_DATA(%d) = [ %.*s ] m=<%s> from=<%s> to=<%s> s=<%s>\r\n' % (spamfn, msg_id, re_i, lim_num, strip_s, ms, from_s, to_s, subject)
+    if v.kind == "spam":
+        idx = header_of(v.hdr)
+        subject = idx.get(b'subject', [b''])[0]
+        from_s  = idx.get(b'from', [b''])[0]
+        to_s    = idx.get(b'to', [b''])[0]
+        strip_s = strip_ln(b', '.join(map(term_key, v.rule)))
+        msg = b'SPAM is detected. f=%s msg_id=%s %s(%d) = [ %.*s ] m=<%s> from=<%s> to=<%s> s=<%s>%s%s\r\n' % (spamfn, msg_id, v.name.encode(), v.re_i, lim_num, strip_s, v.ms, from_s, to_s, subject, skipped, tm_str(tm))
         putlog(msg)
-        spam_log(msg, data, t)
+        with tm_phase(tm, "log"):
+            spam_log(msg, data, t)
         return True
 
-    putlog(b'pass f=%s msg_id=%s' % (sdecfn, msg_id))
+    putlog(b'pass f=%s msg_id=%s%s%s' % (sdecfn, msg_id, skipped, tm_str(tm)))
     return  False
 
 #スパムデータ出力
 def spam_log(msg, data, t):
-    if G.DBG >= 1:
+    if G.DBG >= 1 and log_writer_on(t):
+        if data[-1:] != b'\n':
+            msg = b'\r\n' + msg
+        log_enqueue(spam_fname(t), data[:] + msg)
+    elif G.DBG >= 1:
         fname = logpath(spam_fname(t), is_time_zero(t))
         f = open(fname, "wb")
         f.write(data)
@@ -374,8 +1795,29 @@ def spam_log(msg, data, t):
 class SpamError(Exception):
     pass
 
-# メールの検査（データフェーズ終了時）
-def data_proc(data, param):
+# 一時エラー（reply を返してセッションを終了）
+class TempFail(Exception):
+    reply = b"451 4.3.0 Temporary failure\r\n"
+
+# 検査時間の超過（name(re_i) のルールの pattern を検査中）
+class ScanTimeout(TempFail):
+    reply = b"451 4.7.1 content scan timeout\r\n"
+
+    def __init__(self, re_i=-1, pattern=b'', name=''):
+        super().__init__(re_i, pattern, name)
+        self.re_i, self.pattern, self.name = re_i, pattern, name
+
+# 同時検査数の超過
+class Overload(TempFail):
+    reply = b"451 4.3.2 System busy, try again later\r\n"
+
+# 接続元の評価による一時エラー（reputation_check）
+class BadReputation(TempFail):
+    reply = b"451 4.7.1 Client host has a poor reputation, try again later\r\n"
+
+# 受信データの蓄積（データフェーズ終了時に True を返す）
+#   head が False なら、ヘッダのみの検査（head_proc）は呼び出し側で行う
+def data_proc(data, param, head=True):
     if param.phase == HEADER_PHASE:
         xkey = b'XFORWARD NAME='
         xval = b'SOURCE=LOCAL'
@@ -383,17 +1825,217 @@ def data_proc(data, param):
             param.is_local = True
             param.rdata = b''
             return
+        elif data[:9].upper() == b'XFORWARD ':
+            xforward_attrs(param.client, data)
         elif data[:4] == b'DATA':
             param.phase = DATA_PHASE
+            param.tmark = tm_add(param.tm, "pre", param.tmark)
+            reputation_check(param)     # 評価の悪い接続元は、ここで SpamError / BadReputation 例外
+
+    data_tail(param, data)
+    if param.verdict:
+        pass                            # ヘッダで判定済み（以降は読み捨て）
+    elif G.SCAN_EXEC:
+        spool_write(param.raw, data)   # デコード・検査は全てプール側で行う（ヘッダのみの検査も行わない）
+    else:
+        with tm_phase(param.tm, "dec"):
+            decode_feed(param.dec, data)
+
+    if head and head_pending(param):
+        head_proc(param)
+    if param.rdata != b'\r\n.\r\n':
+        return  False
+    param.tmark = param.t_eod = tm_add(param.tm, "data", param.tmark)
+    return  True
+
+# ヘッダのみの検査が可能か（ヘッダの終わりまで受信済みで未検査）
+#   SCAN_POOL 指定時は、検査をセッションのスレッド・イベントループで行わないよう、ヘッダのみの検査も行わない
+def head_pending(param):
+    return  G.HEAD_VERDICT and not G.SCAN_EXEC and param.verdict is None and param.dec.sep >= 0 and not param.is_local
+
+# ヘッダの終わりで、ヘッダのみの検査を先に行う
+def head_proc(param):
+    param.head = decode_head(param.dec) + b'\r\n\r\n'
+    param.head_tg = head_target(param.head[:-4])
+    try:
+        param.verdict = judge_head(param.head_tg) or False
+    except ScanTimeout:
+        param.verdict = False       # データ終了時の検査で改めて扱う
+    if param.verdict:
+        spool_close(param.raw)
+        spool_close(param.dec.out)
+
+# 受信データ自体は保持せず（デコーダに渡すのみ）、終端判定用の末尾のみ保持
+def data_tail(param, data):
+    rdata = param.rdata + data
+    if not param.has_head:
+        param.has_head = rdata.find(b'\r\n\r\n', param.rlen and 0 or 1) >= 0
+    param.rdata = rdata[-5:]
+    param.rlen += len(data)
+
+# メールの検査（データフェーズ終了時。spamの場合、SpamError例外発生）
+#   判定結果は接続元の評価キャッシュに記録（検査時間の超過等の一時エラーは記録しない）
+#   CHECK_DATA を省略したセッション（rep_good）は、spam 以外の判定を記録しない（有効期限も延長しない）
+def check_proc(param):
+    try:
+        check_mail(param)
+    except SpamError:
+        reputation_add(param, True)
+        raise
+    if not param.rep_good:
+        reputation_add(param, False)
+
+#   プロファイル中（SIGUSR1, PROFILE_SESSIONS）はデコード・判定をプロファイル
+#   デコード結果は param.dec の出力バッファをそのまま使い、判定後に decode_restore で戻す
+def check_mail(param):
+    if param.verdict:
+        return  head_check_proc(param)
+    if G.SCAN_EXEC:
+        return  pool_check_proc(param)
+
+    with profile_session():
+        with tm_phase(param.tm, "dec"):
+            dec_data, param.msg_id = decode_finish(param.dec, True)
+        try:
+            if not param.is_local:
+                if is_spam(dec_data, param.msg_id, param.t, skipped=skip_summary(param.dec), tm=param.tm,
+                           head_tg=param.head_tg, rep_good=param.rep_good):
+                    raise SpamError()
+                elif G.DBG >= 2:
+                    with tm_phase(param.tm, "log"):
+                        sdec_log(dec_data, param.t)
+        finally:
+            if isinstance(dec_data, mmap.mmap):
+                dec_data.close()
+            else:
+                decode_restore(param.dec, dec_data)
+
+# ヘッダで判定済みの場合（spam/sdec ファイルはヘッダ部のみ）
+def head_check_proc(param):
+    param.msg_id = param.dec.msg_id
+    if is_spam(param.head, param.msg_id, param.t, v=param.verdict, tm=param.tm):
+        raise SpamError()
+    elif G.DBG >= 2:
+        with tm_phase(param.tm, "log"):
+            sdec_log(param.head, param.t)
+
+# SPAM判定プロセスプール生成
+#   forkserver 経由で起動し、各プロセスは自身で spam_dat を読み込んで
+#   コンパイル済み正規表現を保持し続ける
+#   実行コストの検査は行わず、親プロセスで無効化した正規表現（G.RULES.DISABLED）を受け取って使う
+def scan_pool():
+    return  concurrent.futures.ProcessPoolExecutor(
+                G.SCAN_POOL, mp_context=multiprocessing.get_context("forkserver"),
+                initializer=pool_init, initargs=(G.VERBOSE, G.RULES.DISABLED))
+
+def pool_init(verbose, disabled):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    G.VERBOSE = verbose
+    G.RULE_DISABLED = disabled
+    loadcheck_spam_dat()
+
+# プール内での検査（メールデータは共有メモリ経由で受け取る）
+#   tm（処理段階毎の所要時間）は加算して返す。prof なら cProfile の結果も返す
+#   disabled は親プロセスのルールセットで無効化した正規表現（異なれば再ロード）
+#   order（親プロセスの評価順の版数とコストのファイル）が変われば、評価順を更新
+def pool_check(shm_name, size, t, tm, prof=False, rep_good=False, disabled=frozenset(), order=(0, "")):
+    if disabled != G.RULE_DISABLED:
+        G.RULE_DISABLED = disabled
+        loadcheck_spam_dat(True)
+    else:
+        loadcheck_spam_dat()  # 変更があった場合のみ再ロード
+    order_apply(order)
+    G.LOG_BUF = []
+    prof = prof and cProfile.Profile()
+    try:
+        if prof:
+            prof.enable()
+        # 共有メモリの解放は親プロセスが行う
+        # （forkserver 経由のため resource_tracker は親と共有）
+        shm = shared_memory.SharedMemory(name=shm_name)
+        try:
+            with tm_phase(tm, "dec"):
+                st = decode_init()
+                dec_data, msg_id = decode_chunks((bytes(shm.buf[i:min(i + DECODE_CHUNK, size)])
+                                                  for i in range(0, size, DECODE_CHUNK)), st)
+        finally:
+            shm.close()
 
-    param.rdata += data
-    if param.rdata[-5:] == b'\r\n.\r\n':
-        dec_data, param.msg_id = decode_mail(param.rdata)
-        if not param.is_local:
-            if is_spam(dec_data, param.msg_id, param.t):
-                raise SpamError()
-            elif G.DBG >= 2:
-                open(logpath(sdec_fname(param.t), is_time_zero(param.t)), "wb").write(dec_data)
+        try:
+            ret = is_spam(dec_data, msg_id, t, skipped=skip_summary(st), tm=tm, rep_good=rep_good)
+        except ScanTimeout:
+            ret = None      # 親プロセスで ScanTimeout とする
+        if not ret and G.DBG >= 2:
+            with tm_phase(tm, "log"):
+                sdec_log(dec_data, t)
+        return  ret, msg_id, G.LOG_BUF, G.RULES.CHECK_ST and stats_take(), tm, prof and prof_stats(prof)
+    finally:
+        if prof:
+            prof.disable()
+        G.LOG_BUF = None
+
+def pool_check_proc(param):
+    size = param.raw.size
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    try:
+        spool_readinto(param.raw, shm.buf)
+        with profile_session(False) as smp:
+            ret, param.msg_id, logs, stats, param.tm, pst = G.SCAN_EXEC.submit(
+                pool_check, shm.name, size, param.t, param.tm, smp and smp.mode == "cprofile", param.rep_good,
+                G.RULES.DISABLED, (G.ORDER_VER, G.ORDER_VER and order_file())).result()
+            if smp:
+                smp.stats = pst
+
+    except concurrent.futures.process.BrokenProcessPool:
+        putlog("scan pool is broken. restarting...")
+        G.SCAN_EXEC = scan_pool()
+        raise
+
+    finally:
+        shm.close()
+        shm.unlink()
+
+    for kind, a, b in logs:
+        if kind == "log":
+            putlog(a, b)
+        else:
+            log_enqueue(a, b)
+    if stats:
+        stats_merge(stats)
+    if ret is None:
+        raise ScanTimeout()
+    if ret:
+        raise SpamError()
+
+# セッション状態の生成
+#   tm は処理段階毎の所要時間（PHASES）、tmark は直前の段階の終了時刻、t_eod はデータ終端の時刻
+#   pipe は直接中継（relay_direct）用のパイプ（None: 未開始、False: 使用しない）、spliced はその中継量
+#   client は XFORWARD の属性、rep_keys は評価キャッシュのキー、rep_good は評価の良い接続元（CHECK_DATA を省略）
+def session_param(t):
+    acct = Obj(cap=G.SESSION_MEM_CAP, used=0, total=G.TOTAL_MEM_CAP)
+    now = time.perf_counter_ns()
+    return  Obj(rdata=b'', rlen=0, has_head=False, phase=HEADER_PHASE, is_local=False, t=t,
+                msg_id=b'', xforward=b'', need_rewrite=True, verdict=None, head=b'', head_tg=None,
+                smtp=spool_init(acct), dec=decode_init(acct), raw=spool_init(acct),
+                tm={}, t0=now, tmark=now, t_eod=0, pipe=None, spliced=0, client={}, rep_keys=None, rep_good=False)
+
+# SMTP通信記録（DBG < 0 ではファイル保存しないため記録しない）
+def add_transcript(param, rmode, data):
+    if G.DBG >= 0:
+        spool_write(param.smtp, rmode and b"R: " or b"S: ")
+        spool_write(param.smtp, data)
+
+#   セッション全体の所要時間を記録し、ヒストグラムへ集計
+def close_param(param):
+    spool_close(param.smtp)
+    spool_close(param.dec.out)
+    spool_close(param.raw)
+    if param.pipe:
+        list(map(os.close, param.pipe))
+        param.pipe = False
+    tm_add(param.tm, "total", param.t0)
+    hist_add(param.tm)
 
 def rewrite_filter(data, param):
     if not param.xforward:
@@ -412,27 +2054,81 @@ def rewrite_filter(data, param):
     return data
 
 # フィルター動作コア部
+#   相手側の送信待ちデータが RELAY_BUF_MAX を超えている間は受信しない
+RELAY_BUF_MAX = 1000000
+RELAY_PIPE_SIZE = 1024 * 1024
+
+# 受信側の直接中継（検査・通信記録の保存が不要になったデータを、ユーザ空間にコピーせず splice で中継）の開始
+#   ローカルからの投入（is_local）、またはヘッダでホワイトリストと判定済み（DBG >= 2 では通信記録を保存するため除く）で、
+#   ヘッダ（rewrite_filter の対象）の終わりまで中継済みの場合
+#   RELAY_SPLICE が無効、または os.splice が無い（Linux, Python 3.10 以降のみ）場合は従来通り
+def relay_direct(param, data):
+    if param.is_local:
+        data_tail(param, data)
+    if not param.has_head or param.rdata == b'\r\n.\r\n':
+        return
+    if not (param.is_local or param.verdict and param.verdict.kind == "white" and G.DBG < 2):
+        return
+    if not G.RELAY_SPLICE or not hasattr(os, "splice"):
+        param.pipe = False
+        return
+    param.pipe = os.pipe()
+    try:
+        fcntl.fcntl(param.pipe[1], getattr(fcntl, "F_SETPIPE_SZ", 1031), RELAY_PIPE_SIZE)
+    except OSError:
+        pass
+
+# splice での中継（src のソケットから読める分を、パイプ経由で dst のソケットへ。0 は受信終了）
+#   読めるデータが無い場合（EAGAIN）は -1 を返し、次の select で再試行
+#   最初の splice に失敗した場合は None を返し、以降は従来通り中継
+#   判定済みのセッションは、データ終端を検出しないため、最初の中継時に判定ログを出力
+def relay_splice(param, src, dst):
+    try:
+        n = os.splice(src, param.pipe[1], RELAY_PIPE_SIZE, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+    except BlockingIOError:
+        return  -1
+    except OSError:
+        if param.spliced:
+            raise
+        list(map(os.close, param.pipe))
+        param.pipe = False
+        return  None
+    if n and param.verdict and not param.spliced and param.rdata != b'\r\n.\r\n':
+        check_proc(param)
+    left = n
+    while left:
+        try:
+            left -= os.splice(param.pipe[0], dst, left, flags=os.SPLICE_F_MOVE)
+        except BlockingIOError:
+            select.select([], [dst], [])    # 中継先の送信バッファの空き待ち
+    param.spliced += n
+    return  n
+
 def content_filter_core(r, dst_addr, t):
+    param = session_param(t)
+    s = None
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.connect(dst_addr)
+        param.tmark = tm_add(param.tm, "conn", param.t0)
         s_map = {
-            s.fileno(): Obj(Sock=s, SWait=True, RWait=True, RSockF=r.fileno(), Data=b""),
-            r.fileno(): Obj(Sock=r, SWait=True, RWait=True, RSockF=s.fileno(), Data=b"")
+            s.fileno(): Obj(Sock=s, SWait=True, RWait=True, RSockF=r.fileno(), Data=bytearray()),
+            r.fileno(): Obj(Sock=r, SWait=True, RWait=True, RSockF=s.fileno(), Data=bytearray())
         }
-        smtp_data = b''
-
-        param = Obj(rdata=b'', phase=HEADER_PHASE, is_local=False, t=t, msg_id=b'',
-                    xforward=b'', need_rewrite=True)
 
         while s_map[s.fileno()].RWait and s_map[r.fileno()].RWait:
-            rfds = [x.Sock.fileno() for x in s_map.values() if x.RWait]
+            rfds = [x.Sock.fileno() for x in s_map.values() if x.RWait and len(s_map[x.RSockF].Data) < RELAY_BUF_MAX]
             wfds = [x.Sock.fileno() for x in s_map.values() if x.Data and x.SWait]
 
             rl, wl, xl = select.select(rfds, wfds, [])
 
             for i in rl:
-                data = s_map[i].Sock.recv(1000000)
+                if i == r.fileno() and param.pipe and not s_map[s.fileno()].Data:
+                    n = relay_splice(param, i, s.fileno())
+                    if n is not None:
+                        s_map[i].RWait = n != 0
+                        continue
+                data = s_map[i].Sock.recv(RELAY_BUF_MAX)
                 if len(data) > 0:
                     if param.need_rewrite:
                         data = rewrite_filter(data, param)
@@ -442,27 +2138,44 @@ def content_filter_core(r, dst_addr, t):
 
                 if data:
                     rmode = (i == r.fileno())
-                    smtp_data += (rmode and b"R: " or b"S: ") + data
-                    if rmode and not param.is_local:
-                        data_proc(data, param) # spamの場合、SpamError例外発生
+                    add_transcript(param, rmode, data)
+                    if rmode and not param.is_local and data_proc(data, param):
+                        scan_proc(param) # spamの場合、SpamError例外発生
+                    if rmode and param.pipe is None:
+                        relay_direct(param, data)
 
             for i in wl:
                 sent = s_map[i].Sock.send(s_map[i].Data)
                 if sent >= 0:
-                    s_map[i].Data = s_map[i].Data[sent:]
+                    del s_map[i].Data[:sent]
                 else:
                     s_map[i].SWait = False
+                if i == r.fileno():
+                    tm_reply(param)
 
-        if G.DBG >= 2 and not param.is_local and param.rdata.find(b'\r\n\r\n') > 0:
-            write_log(t, smtp_data, param.msg_id)
+        if G.DBG >= 2 and not param.is_local and param.has_head:
+            with tm_phase(param.tm, "log"):
+                write_log(t, param.smtp, param.msg_id)
 
     except SpamError:
         ret = b"%d SPAM checker was invoked.\r\n" % G.SPAM_ERRCODE
         r.send(ret)
+        tm_reply(param)
         time.sleep(0.1)
         putlog(ret)
         if G.DBG >= 1:
-            write_log(t, smtp_data + ret, param.msg_id)
+            with tm_phase(param.tm, "log"):
+                write_log(t, param.smtp, param.msg_id, tail=ret)
+
+    except TempFail as e:
+        ret = e.reply
+        r.send(ret)
+        tm_reply(param)
+        time.sleep(0.1)
+        putlog(ret)
+        if G.DBG >= 1:
+            with tm_phase(param.tm, "log"):
+                write_log(t, param.smtp, param.msg_id, tail=ret)
 
     except Exception:
         ret = b"450 internal error\r\n"
@@ -471,55 +2184,285 @@ def content_filter_core(r, dst_addr, t):
         msg = traceback.format_exc()
         putlog(msg)
         if G.DBG >= 0:
-            write_log(t, msg.encode("utf8") + smtp_data, param.msg_id)
+            write_log(t, param.smtp, param.msg_id, head=msg.encode("utf8"))
 
     try:
-        s.close()
+        close_param(param)
+        if s:
+            s.close()
         r.close()
 
     except Exception:
         msg = traceback.format_exc()
         putlog(msg)
         if G.DBG >= 0:
-            write_log(t, msg.encode("utf8") + smtp_data, param.msg_id)
+            write_log(t, param.smtp, param.msg_id, head=msg.encode("utf8"))
+
+# 受付制御（kind は "sessions"（同時セッション数）または "scans"（同時検査数））
+#   上限に達している場合は wait 秒まで空きを待ち、空かなければ False
+def admit_enter(kind, wait=0):
+    adm = G.ADMIT
+    with G.ADMIT_COND:
+        ok = admit_free(kind) or wait > 0 and G.ADMIT_COND.wait_for(lambda: admit_free(kind), wait)
+        if ok:
+            setattr(adm, kind, getattr(adm, kind) + 1)
+            if kind == "sessions":
+                adm.sessions_total += 1
+    return  ok
+
+def admit_leave(kind):
+    with G.ADMIT_COND:
+        setattr(G.ADMIT, kind, getattr(G.ADMIT, kind) - 1)
+        G.ADMIT_COND.notify_all()
+
+#   TOTAL_MEM_CAP の 3/4 を超えている間は、新しいセッションを受け付けない
+def admit_free(kind):
+    adm = G.ADMIT
+    if kind == "scans":
+        return  not G.MAX_SCANS or adm.scans < G.MAX_SCANS
+    if G.TOTAL_MEM_CAP and adm.mem >= G.TOTAL_MEM_CAP * 3 // 4:
+        return  False
+    return  not G.MAX_SESSIONS or adm.sessions < G.MAX_SESSIONS
+
+# asyncio版（イベントループを止めないよう、空きをポーリングで待つ）
+async def admit_aenter(kind, wait=0):
+    limit = time.monotonic() + wait
+    while not admit_enter(kind):
+        if time.monotonic() >= limit:
+            return  False
+        await asyncio.sleep(0.05)
+    return  True
+
+# 空き待ちの行列（ADMIT_QUEUE 件まで）への追加。満杯なら False
+def admit_queue(n=1):
+    with G.ADMIT_COND:
+        if n > 0 and G.ADMIT.waiting >= G.ADMIT_QUEUE:
+            return  False
+        G.ADMIT.waiting += n
+    return  True
+
+# 受付拒否の記録（ログは10秒に1回まで）
+def admit_reject(kind):
+    adm = G.ADMIT
+    with G.ADMIT_COND:
+        setattr(adm, kind + "_rejected", getattr(adm, kind + "_rejected") + 1)
+        adm.log_cnt += 1
+        now = time.time()
+        if now - adm.log_time < 10:
+            return
+        msg = "overload: %d rejected (sessions=%d waiting=%d scans=%d mem=%d)" % (
+                adm.log_cnt, adm.sessions, adm.waiting, adm.scans, adm.mem)
+        adm.log_time, adm.log_cnt = now, 0
+    putlog(msg)
+
+# 同時検査数を制限した検査（上限超過で ADMIT_WAIT 秒待っても空かなければ Overload 例外）
+def scan_proc(param):
+    if param.verdict:
+        return  check_proc(param)
+    if not admit_enter("scans", G.ADMIT_WAIT):
+        admit_reject("scans")
+        raise Overload()
+    try:
+        check_proc(param)
+    finally:
+        admit_leave("scans")
 
 # フィルター動作ラッパ部
-def content_filter_proc(r, dst_addr, t):
+#   queued の場合は空き待ち（ADMIT_WAIT 秒まで待っても空かなければ 421 を返して切断）
+def content_filter_proc(r, dst_addr, t, queued=False):
+    if queued:
+        ok = admit_enter("sessions", G.ADMIT_WAIT)
+        admit_queue(-1)
+        if not ok:
+            return  busy_close(r)
     try:
-        G.THR_CNT += 1
         content_filter_core(r, dst_addr, t)
 
     finally:
-        G.THR_CNT -= 1
+        admit_leave("sessions")
+
+def busy_close(r):
+    admit_reject("sessions")
+    try:
+        r.send(BUSY_REPLY)
+    except OSError:
+        pass
+    r.close()
 
 # タイムスタンプ用時刻オブジェクト生成
 def gen_timeobj(last_t=None):
-    t = Obj(t=int(time.time()), idx=0)
+    t = Obj(t=int(time.time()), idx=G.WORKER_IDX)
 
     if last_t and last_t.t == t.t:
-        t.idx = last_t.idx + 1
+        t.idx = last_t.idx + max(G.WORKERS, 1)
     return  t
 
-# フィルタリクエスト受付
-def content_filter(src_addr, dst_addr):
+# 待ち受けソケット生成
+#   ワーカーモードでは SO_REUSEPORT で各ワーカーが個別に bind する
+#   （SO_REUSEPORT が無い環境では、マスターが生成したソケットを共有）
+def listen_socket(src_addr):
+    if G.LISTEN_SOCK:
+        return G.LISTEN_SOCK
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if G.WORKERS > 0:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     s.bind(src_addr)
-    s.listen(10)
+    s.listen(G.LISTEN_BACKLOG)
+    return s
+
+# フィルタリクエスト受付
+#   同時セッション数の上限を超えた場合は空き待ちの行列へ入れ、それも満杯なら即座に 421 を返す
+def content_filter(src_addr, dst_addr):
+    s = listen_socket(src_addr)
     last_t = Obj(t=0, idx=0)
 
     while True:
         try:
             r, addr = s.accept()
             t = gen_timeobj(last_t)
-            _thread.start_new_thread(content_filter_core, (r, dst_addr, t))
             last_t = t
+            if admit_enter("sessions"):
+                _thread.start_new_thread(content_filter_proc, (r, dst_addr, t))
+            elif admit_queue():
+                _thread.start_new_thread(content_filter_proc, (r, dst_addr, t, True))
+            else:
+                busy_close(r)
 
         except Exception as e:
             time.sleep(1)
             msg = traceback.format_exc()
             putlog(msg)
 
+# フィルター動作コア部（asyncio版）
+#   recv/send は全セッション共通のイベントループで処理し、
+#   decode_mail/is_spam とヘッダのみの検査（head_proc）は executor（SCAN_WORKERS 本）で実行する
+async def content_filter_acore(r_reader, r_writer, dst_addr, t, executor):
+    loop = asyncio.get_running_loop()
+    s_writer = None
+    param = session_param(t)
+
+    async def relay(reader, writer, rmode):
+        while True:
+            data = await reader.read(RELAY_BUF_MAX)
+            if not data:
+                return
+            if param.need_rewrite:
+                data = rewrite_filter(data, param)
+            add_transcript(param, rmode, data)
+            if rmode and not param.is_local and param.phase == DATA_PHASE and not (param.verdict or G.SCAN_EXEC):
+                # DATA のデコードはイベントループを止めないよう executor で行う
+                done = await loop.run_in_executor(executor, data_proc, data, param, False)
+            else:
+                done = rmode and not param.is_local and data_proc(data, param, False)
+            if rmode and head_pending(param):
+                await loop.run_in_executor(executor, head_proc, param)
+            if done:
+                # spamの場合、SpamError例外発生（data は転送しない）
+                if param.verdict:
+                    await loop.run_in_executor(executor, check_proc, param)
+                elif not await admit_aenter("scans", G.ADMIT_WAIT):
+                    admit_reject("scans")
+                    raise Overload()
+                else:
+                    try:
+                        await loop.run_in_executor(executor, check_proc, param)
+                    finally:
+                        admit_leave("scans")
+            writer.write(data)
+            if not rmode:
+                tm_reply(param)
+            await writer.drain()
+
+    try:
+        s_reader, s_writer = await asyncio.open_connection(*dst_addr)
+        param.tmark = tm_add(param.tm, "conn", param.t0)
+        tasks = [asyncio.ensure_future(relay(s_reader, r_writer, False)),
+                 asyncio.ensure_future(relay(r_reader, s_writer, True))]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+        for task in done:
+            task.result()
+
+        if G.DBG >= 2 and not param.is_local and param.has_head:
+            with tm_phase(param.tm, "log"):
+                write_log(t, param.smtp, param.msg_id)
+
+    except SpamError:
+        ret = b"%d SPAM checker was invoked.\r\n" % G.SPAM_ERRCODE
+        r_writer.write(ret)
+        tm_reply(param)
+        await asyncio.sleep(0.1)
+        putlog(ret)
+        if G.DBG >= 1:
+            with tm_phase(param.tm, "log"):
+                write_log(t, param.smtp, param.msg_id, tail=ret)
+
+    except TempFail as e:
+        ret = e.reply
+        r_writer.write(ret)
+        tm_reply(param)
+        await asyncio.sleep(0.1)
+        putlog(ret)
+        if G.DBG >= 1:
+            with tm_phase(param.tm, "log"):
+                write_log(t, param.smtp, param.msg_id, tail=ret)
+
+    except Exception:
+        ret = b"450 internal error\r\n"
+        r_writer.write(ret)
+        await asyncio.sleep(0.1)
+        msg = traceback.format_exc()
+        putlog(msg)
+        if G.DBG >= 0:
+            write_log(t, param.smtp, param.msg_id, head=msg.encode("utf8"))
+
+    try:
+        close_param(param)
+        if s_writer:
+            s_writer.close()
+        r_writer.close()
+
+    except Exception:
+        msg = traceback.format_exc()
+        putlog(msg)
+        if G.DBG >= 0:
+            write_log(t, param.smtp, param.msg_id, head=msg.encode("utf8"))
+
+# フィルタリクエスト受付（asyncio版）
+async def content_filter_aserver(src_addr, dst_addr):
+    s = listen_socket(src_addr)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=G.SCAN_WORKERS)
+    last = Obj(t=Obj(t=0, idx=0))
+
+    async def accept_proc(r_reader, r_writer):
+        t = gen_timeobj(last.t)
+        last.t = t
+        ok = admit_enter("sessions")
+        if not ok and admit_queue():
+            ok = await admit_aenter("sessions", G.ADMIT_WAIT)
+            admit_queue(-1)
+        if not ok:
+            admit_reject("sessions")
+            r_writer.write(BUSY_REPLY)
+            r_writer.close()
+            return
+        try:
+            await content_filter_acore(r_reader, r_writer, dst_addr, t, executor)
+
+        finally:
+            admit_leave("sessions")
+
+    server = await asyncio.start_server(accept_proc, sock=s)
+    async with server:
+        await server.serve_forever()
+
+def content_filter_async(src_addr, dst_addr):
+    asyncio.run(content_filter_aserver(src_addr, dst_addr))
+
 # デーモン化
 def daemonize():
     if os.fork() > 0: sys.exit(0)
@@ -531,52 +2474,372 @@ def daemonize():
 def check_allmatch(re_list):
     for r in reduce(add, reduce(add, re_list)):
         if r.match(b"LWKUAka6R8/8zckFodssb5xFTvmezjzWdleI8gW85K7"):
-            raise Exception(r)
+            raise Exception("matches every message: %r" % r)
     return True
 
 
-# 設定ファイルの動的読み込み
-# （変更があった場合、自動的に再ロードする）
-def loadcheck_spam_dat():
+# ルール統計オブジェクトの生成（enable が偽なら統計を取らない）
+def build_rule_stats(obj, enable=True):
+    obj.RULE_STATS = {}
+    for name, _, _, _, _, st_name, _ in CHECK_STAGES:
+        setattr(obj, st_name, enable and rule_stats(name, getattr(obj, name), obj.RULE_STATS) or None)
+
+# 正規表現のコンパイル（RE_CACHE 用のエントリを返す）
+#   構文解析結果から必須リテラルと共有用のキー（term_norm）も得る
+#   snap（RULE_SNAPSHOT 指定時）なら、_sre 用の内部表現（スナップショット保存用）も得て内部APIでコンパイル
+def regex_compile(pat, snap=False):
+    flags = re.IGNORECASE
+    p = sre_parse.parse(pat, flags)
+    if snap:
+        try:
+            try:
+                import re._compiler as sre_compile
+            except ImportError:
+                import sre_compile
+            indexgroup = [None] * p.state.groups
+            for k, i in p.state.groupdict.items():
+                indexgroup[i] = k
+            code = (int(flags | p.state.flags), [int(x) for x in sre_compile._code(p, flags)], p.state.groups - 1,
+                    dict(p.state.groupdict), tuple(indexgroup))
+            return  Obj(re=_sre.compile(pat, *code), lit=parsed_literal(p), code=code, key=None, cost=None, cost_max=0)
+        except re.error:
+            raise
+        except Exception:
+            pass    # 内部APIが使えない場合は通常のコンパイル（スナップショットには保存しない）
+    return  Obj(re=re.compile(pat, flags), lit=parsed_literal(p), code=None, key=(p.state.flags, parsed_key(p)),
+                cost=None, cost_max=0)
+
+# 構文解析結果の比較用の値（IGNORECASE のため、リテラルの英大文字は小文字とする）
+def parsed_key(x):
+    if isinstance(x, sre_parse.SubPattern):
+        x = x.data
+    if isinstance(x, (list, tuple)):
+        if len(x) == 2 and x[0] in (sre_parse.LITERAL, sre_parse.NOT_LITERAL) and 65 <= x[1] <= 90:
+            return  (x[0], x[1] + 32)
+        return  tuple(map(parsed_key, x))
+    return  x
+
+# ルールのコンパイル（cache: 今回のルールセット用の RE_CACHE）
+#   前回のルールセット、スナップショット（snap。RULE_SNAPSHOT 指定が無ければ None）にある正規表現は再コンパイルしない
+#   guard（rule_guard）により、実行コストの上限を超える正規表現を無効化（NEVER_RE）
+#   terms（共有の正規表現表）により、大文字小文字の違い等のみで同じ意味の正規表現は
+#   全ルール・全リストで同じオブジェクトとし、1メッセージにつき1回のみ検索する（is_match の memo）
+def compile_rules(LL, cache, snap, guard=None, terms=None):
+    terms = {} if terms is None else terms
+    guard = guard or Obj(max=0, disabled=set())
+    ret = []
+    for L in LL:
+        sub = []
+        for term in L:
+            field, pat = type(term) == tuple and term or (None, term)
+            ent = cache.get(pat) or G.RE_CACHE.get(pat)
+            if ent is None and snap and pat in snap:
+                ent = snapshot_entry(pat, snap[pat])
+            if ent is None:
+                ent = regex_compile(pat, snap is not None)
+                check_allmatch([[[ent.re]]])
+            cache[pat] = ent
+            if guard.max and rule_cost_check(pat, ent, guard):
+                guard.disabled.add(pat)
+            if pat in guard.disabled:
+                key, r = NEVER_RE, NEVER_RE
+            else:
+                key, r = term_norm(pat, ent), ent.re
+            r = terms.get(key) or terms.setdefault(key, r)
+            if field is not None:
+                fr = FieldRe(field, r)
+                r = terms.get((fr.field, key)) or terms.setdefault((fr.field, key), fr)
+            sub.append(r)
+        ret.append(sub)
+    return  ret
+
+# 正規表現の共有用のキー（コンパイル後の内部表現。IGNORECASE のためリテラルは小文字化済み）
+#   内部表現が無い場合は構文解析結果（parsed_key）、それも無ければパターンそのもの
+def term_norm(pat, ent):
+    return  ent.code and (ent.code[0], tuple(ent.code[1])) or ent.key or pat
+
+# 正規表現の実行コスト検査の設定（max が 0 なら検査しない）
+#   disabled は無効化する正規表現（ルールセットの DISABLED となる）
+#   検査は1つのプロセスのみで行い、SCAN_POOL のプロセスとワーカーは親プロセス・マスターの結果（RULE_DISABLED）を使う
+#   検査用の入力（stress_corpus）は、測定が必要な正規表現がある場合のみ生成する
+def rule_guard(obj):
+    if G.RULE_DISABLED is not None:
+        return  Obj(max=0, disabled=set(G.RULE_DISABLED))
+    return  Obj(max=obj.RULE_COST_MAX, action=obj.RULE_COST_ACTION, files=obj.RULE_STRESS_FILES,
+                tmp_dir=obj.TMP_DIR, corpus=None, disabled=set(), measured=False)
+
+# 実行コストの検査用の入力
+#   バックトラックが爆発しやすい単調な入力と、TMP_DIR の最新の SMTP通信記録（デコード後）
+def stress_corpus(tmp_dir, files):
+    ll = [c * 2000 + b'\x00' for c in (b'a', b'1', b' ', b'.', b'-', b'/', b'=', b'<')]
+    ll += [b'ab' * 1000 + b'\x00', b'a\r\n' * 700, (b'w' * 20 + b' ') * 100]
+    fl = [x for x in glob.glob(os.path.join(tmp_dir, "smtp_*.txt")) if os.path.getsize(x) < 1024 * 1024]
+    for fn in sorted(fl, key=os.path.getmtime)[-files:] if files else []:
+        try:
+            ll.append(bytes(decode_chunks(smtpfile_chunks(fn))[0]))
+        except Exception:
+            pass
+    return  ll
+
+# 正規表現の実行コストの検査（最も遅い入力での秒数。上限を超えて中断した場合は None）
+def regex_cost(r, corpus, limit):
+    worst = 0
+    for data in corpus:
+        t0 = time.perf_counter()
+        try:
+            with scan_budget(limit):
+                r.search(data)
+        except ScanTimeout:
+            return  None
+        worst = max(worst, time.perf_counter() - t0)
+        if worst > limit:
+            break
+    return  worst
+
+# 上限（RULE_COST_MAX 秒）を超える正規表現は、RULE_COST_ACTION が "reject" なら無効化（True を返す）、それ以外は警告のみ
+#   測定結果（cost。上限 cost_max を超えて打ち切った場合はそれより大きい値）は RE_CACHE のエントリに保存し、
+#   ロード毎に現在の上限・動作を適用する（測り直すのは、打ち切った測定より上限が大きくなった場合のみ）
+def rule_cost_check(pat, ent, guard):
+    if ent.cost is None or (ent.cost > ent.cost_max and ent.cost_max < guard.max):
+        if guard.corpus is None:
+            guard.corpus = stress_corpus(guard.tmp_dir, guard.files)
+        cost = regex_cost(ent.re, guard.corpus, guard.max)
+        ent.cost, ent.cost_max = cost is None and float("inf") or cost, guard.max
+        guard.measured = True
+    if ent.cost <= guard.max:
+        return  False
+    putlog("slow rule (%s sec, %s): %s" % (ent.cost > ent.cost_max and ">%g" % ent.cost_max or "%.3f" % ent.cost,
+                                           guard.action == "reject" and "disabled" or "flagged", bytes2str(pat)))
+    return  guard.action == "reject"
+
+# コンパイル済み正規表現のスナップショット（RULE_SNAPSHOT）
+#   値は (内部表現, 必須リテラル, 実行コスト, その測定時の上限)。実行コストの無い旧形式は未測定とする
+#   Python のバージョンが異なる場合は None を返し、内部APIを使わずに re.compile でコンパイルする
+#   （load_rules で空のスナップショットに置き換え、次回の起動時に作り直す）
+def load_rule_snapshot(fname):
+    try:
+        with open(fname, "rb") as f:
+            ver, snap = pickle.load(f)
+    except Exception:
+        return  {}
+    if ver != snapshot_version():
+        putlog("rule snapshot %s is for another Python version (%s). re.compile is used." % (fname, ver[0].split()[0]))
+        return  None
+    return  dict((pat, v + (None, 0)[len(v) - 2:]) for pat, v in snap.items())
+
+def save_rule_snapshot(fname, cache):
+    snap = dict((pat, (ent.code, ent.lit, ent.cost, ent.cost_max)) for pat, ent in cache.items() if ent.code)
+    tmp = fname + ".tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump((snapshot_version(), snap), f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, fname)
+
+def snapshot_version():
+    return  (sys.version, getattr(_sre, "MAGIC", None))
+
+# スナップショットの1件から RE_CACHE 用のエントリを復元（内部表現から復元できなければ None）
+def snapshot_entry(pat, v):
+    try:
+        code, lit, cost, cost_max = v
+        return  Obj(re=_sre.compile(pat, *code), lit=lit, code=code, key=None, cost=cost, cost_max=cost_max)
+    except Exception:
+        return  None
+
+# 実行コスト検査で無効化した正規表現の受け渡し（WORKERS 指定時。マスターが再ロード後に書き、ワーカーが読む）
+def save_rule_disabled(disabled):
+    path = logpath("rule_disabled.json", False)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf8") as f:
+        json.dump(sorted(x.decode("latin-1") for x in disabled), f)
+    os.replace(tmp, path)
+
+def load_rule_disabled():
+    with open(logpath("rule_disabled.json", False), encoding="utf8") as f:
+        return  frozenset(x.encode("latin-1") for x in json.load(f))
+
+# ルールセットの生成（G.RULES として一括で差し替える）
+def load_rules(obj, snap_file):
     def str_to_byte(LL):
         ret = []
         for L in LL:
             sub = []
             for s in L:
+                if type(s) == tuple:    # フィールド指定 (フィールド名, 正規表現)
+                    sub.append(tuple(x if type(x) == bytes else x.encode("utf8") for x in s))
+                    continue
                 sub.append(s if type(s) == bytes else s.encode("utf8"))
             ret.append(sub)
         return ret
 
+    rs = Obj(
+        WHITE_HEAD   = str_to_byte(spam_dat.WHITE_HEAD),
+        PRECHK_HEAD  = str_to_byte(spam_dat.PRECHK_HEAD),
+        WHITE_DATA   = str_to_byte(spam_dat.WHITE_DATA),
+        CHECK_HEAD   = str_to_byte(spam_dat.CHECK_HEAD),
+        CHECK_DATA   = str_to_byte(spam_dat.CHECK_DATA),
+    )
+    # 起動時のみスナップショットを読み込む（以降は RE_CACHE を利用）
+    snap = None
+    if snap_file:
+        snap = {} if G.RE_CACHE else load_rule_snapshot(snap_file)
+    cache = {}
+    terms = {}
+    guard = rule_guard(obj)
+    for name, _, _, re_name, _, _, _ in CHECK_STAGES:
+        setattr(rs, re_name, compile_rules(getattr(rs, name), cache, snap, guard, terms))
+    new_pats = set(k for k, ent in cache.items() if ent.code) - set(G.RE_CACHE) - set(snap or ())
+    G.RE_CACHE = cache
+    rs.DISABLED = frozenset(guard.disabled)
+    if snap_file and (snap is None or new_pats or getattr(guard, "measured", False)):
+        try:
+            save_rule_snapshot(snap_file, cache)
+        except Exception:
+            putlog(traceback.format_exc())
+
+    for name, _, _, re_name, pf_name, _, _ in CHECK_STAGES:
+        setattr(rs, pf_name, build_prefilter(getattr(rs, re_name)))
+    rs.LITERALS = {x for _, _, _, _, pf_name, _, _ in CHECK_STAGES for lits in getattr(rs, pf_name) for x in lits}
+    build_rule_stats(rs, obj.STATS_FILE or obj.RULE_OPTIMIZE or obj.RULE_COST_FILE)
+    build_order(rs, obj.RULE_OPTIMIZE and term_costs(rs.RULE_STATS, obj.RULE_COST))
+    rs.ORDER_VER = 0
+    rs.VERDICT_CACHE = verdict_cache(getattr(spam_dat, "VERDICT_CACHE", 0), getattr(spam_dat, "VERDICT_CACHE_TTL", 600))
+    ignore = str_to_byte([getattr(spam_dat, "VERDICT_CACHE_IGNORE", CACHE_IGNORE_DEFAULT)])[0]
+    rs.CACHE_IGNORE_RE = re.compile(b"|".join(b"(?:%s)" % x for x in ignore) or b"(?!)", re.IGNORECASE)
+    rs.CACHE_TERMS = list(dict.fromkeys(L for ll in rs.WHITE_RE + rs.CHECK_RE for L in ll))
+    return  rs
+
+# ルール数、正規表現の数（延べ数と共有後の数）
+def rules_summary(rs):
+    ll = [L for _, _, _, re_name, _, _, _ in CHECK_STAGES for L in getattr(rs, re_name)]
+    terms = [x for L in ll for x in L]
+    return  "rules=%d terms=%d unique=%d" % (len(ll), len(terms), len(set(map(id, terms))))
+
+# spam_dat.py の変更監視（inotify。使えない環境では None を返し、os.stat で検査）
+#   エディタ等による置き換えにも対応するため、ディレクトリを監視する
+#   （書き込み時の IN_MODIFY も監視し、close されないまま更新される場合にも対応）
+IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE = 0x2, 0x4, 0x8, 0x80, 0x100
+
+def watch_init():
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return  None
+        path = os.path.dirname(os.path.abspath(spam_dat.__file__)).encode()
+        if libc.inotify_add_watch(fd, path, IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+            os.close(fd)
+            return  None
+        return  fd
+    except Exception:
+        return  None
+
+# 監視イベントの読み出し（spam_dat.py のイベントがあれば True）
+def watch_changed(fd):
+    name = os.path.basename(spam_dat.__file__).encode()
+    ret = False
+    while True:
+        try:
+            buf = os.read(fd, 65536)
+        except BlockingIOError:
+            return  ret
+        pos = 0
+        while pos + 16 <= len(buf):
+            nlen = int.from_bytes(buf[pos + 12:pos + 16], sys.byteorder)
+            ret = ret or buf[pos + 16:pos + 16 + nlen].rstrip(b"\0") == name
+            pos += 16 + nlen
+
+# 定期処理の待ち（spam_dat.py が変更された場合は即座に戻る）
+def watch_wait(sec):
+    fds = [x for x in (G.WATCH_FD, G.WAKE_FD) if x is not None]
+    if fds:
+        select.select(fds, [], [], sec)
+    else:
+        time.sleep(sec)
+
+# 設定ファイルの動的読み込み
+# （変更があった場合、自動的に再ロードする）
+#   ルールは前回からの差分のみコンパイルし、G.RULES を一括で差し替える
+#   force なら変更が無くても再ロードする（RULE_DISABLED の変更時）
+def loadcheck_spam_dat(force=False):
+    if not force and G.STAT and G.WATCH_FD is not None and not watch_changed(G.WATCH_FD):
+        return
+
     while True:
         nstat = os.stat(spam_dat.__file__)
-        if G.STAT and nstat.st_mtime == G.STAT.st_mtime:
+        if not force and G.STAT and nstat.st_mtime == G.STAT.st_mtime:
             return
         if nstat.st_size > 0:
             try:
+                t0 = time.time()
                 importlib.reload(spam_dat)
                 obj = Obj(
                     SRC_ADDR     = spam_dat.SRC_ADDR,
                     DST_ADDR     = spam_dat.DST_ADDR,
-                    WHITE_HEAD   = str_to_byte(spam_dat.WHITE_HEAD),
-                    PRECHK_HEAD  = str_to_byte(spam_dat.PRECHK_HEAD),
-                    WHITE_DATA   = str_to_byte(spam_dat.WHITE_DATA),
-                    CHECK_HEAD   = str_to_byte(spam_dat.CHECK_HEAD),
-                    CHECK_DATA   = str_to_byte(spam_dat.CHECK_DATA),
                     TMP_DIR      = spam_dat.TMP_DIR,
                     DBG          = spam_dat.DBG,
                     SPAM_ERRCODE = spam_dat.SPAM_ERRCODE,
+                    SERVER_MODE  = getattr(spam_dat, "SERVER_MODE", "thread"),
+                    SCAN_WORKERS = getattr(spam_dat, "SCAN_WORKERS", 4),
+                    SESSION_MEM_CAP = getattr(spam_dat, "SESSION_MEM_CAP", 0),
+                    WORKERS      = getattr(spam_dat, "WORKERS", 0),
+                    SCAN_POOL    = getattr(spam_dat, "SCAN_POOL", 0),
+                    LOG_WRITER   = getattr(spam_dat, "LOG_WRITER", False),
+                    LOG_QUEUE_MAX = getattr(spam_dat, "LOG_QUEUE_MAX", 64 * 1024 * 1024),
+                    LOG_COMPRESS = getattr(spam_dat, "LOG_COMPRESS", ""),
+                    LOG_SEGMENT_SIZE = getattr(spam_dat, "LOG_SEGMENT_SIZE", 256 * 1024 * 1024),
+                    LOG_SEGMENT_SEC = getattr(spam_dat, "LOG_SEGMENT_SEC", 3600),
+                    LOG_MAX_TOTAL = getattr(spam_dat, "LOG_MAX_TOTAL", 0),
+                    INDEX_FILE   = getattr(spam_dat, "INDEX_FILE", ""),
+                    RULE_SNAPSHOT = getattr(spam_dat, "RULE_SNAPSHOT", ""),
+                    HEAD_VERDICT = getattr(spam_dat, "HEAD_VERDICT", False),
+                    SCAN_TIME_BUDGET = getattr(spam_dat, "SCAN_TIME_BUDGET", 0),
+                    SCAN_TIMEOUT_ACTION = getattr(spam_dat, "SCAN_TIMEOUT_ACTION", "tempfail"),
+                    RULE_COST_MAX = getattr(spam_dat, "RULE_COST_MAX", 0),
+                    RULE_COST_ACTION = getattr(spam_dat, "RULE_COST_ACTION", "flag"),
+                    RULE_STRESS_FILES = getattr(spam_dat, "RULE_STRESS_FILES", 3),
+                    MAX_SESSIONS = getattr(spam_dat, "MAX_SESSIONS", 0),
+                    MAX_SCANS    = getattr(spam_dat, "MAX_SCANS", 0),
+                    TOTAL_MEM_CAP = getattr(spam_dat, "TOTAL_MEM_CAP", 0),
+                    ADMIT_QUEUE  = getattr(spam_dat, "ADMIT_QUEUE", 0),
+                    ADMIT_WAIT   = getattr(spam_dat, "ADMIT_WAIT", 5),
+                    LISTEN_BACKLOG = getattr(spam_dat, "LISTEN_BACKLOG", 10),
+                    RELAY_SPLICE = getattr(spam_dat, "RELAY_SPLICE", False),
+                    REPUTATION_SIZE = getattr(spam_dat, "REPUTATION_SIZE", 0),
+                    REPUTATION_TTL = getattr(spam_dat, "REPUTATION_TTL", 3600),
+                    REPUTATION_TEMPFAIL = getattr(spam_dat, "REPUTATION_TEMPFAIL", 0),
+                    REPUTATION_REJECT = getattr(spam_dat, "REPUTATION_REJECT", 0),
+                    REPUTATION_GOOD = getattr(spam_dat, "REPUTATION_GOOD", 0),
+                    REPUTATION_RECHECK = getattr(spam_dat, "REPUTATION_RECHECK", 10),
+                    REPUTATION_KEYS = list(getattr(spam_dat, "REPUTATION_KEYS", ["addr", "net", "name", "helo"])),
+                    REPUTATION_FILE = getattr(spam_dat, "REPUTATION_FILE", ""),
+                    PROFILE_SESSIONS = getattr(spam_dat, "PROFILE_SESSIONS", 0),
+                    PROFILE_MODE = getattr(spam_dat, "PROFILE_MODE", "cprofile"),
+                    PART_POLICY  = part_policy(getattr(spam_dat, "SCAN_TYPES", None),
+                                               getattr(spam_dat, "PART_SCAN_MAX", 0), getattr(spam_dat, "MSG_SCAN_MAX", 0)),
                 )
-                obj.WHITE_HEAD_RE = [[re.compile(x, re.IGNORECASE) for x in y] for y in obj.WHITE_HEAD]
-                obj.PRECHK_HEAD_RE = [[re.compile(x, re.IGNORECASE) for x in y] for y in obj.PRECHK_HEAD]
-                obj.WHITE_RE = [[re.compile(x, re.IGNORECASE) for x in y] for y in obj.WHITE_DATA]
-                obj.CHECK_HEAD_RE = [[re.compile(x, re.IGNORECASE) for x in y] for y in obj.CHECK_HEAD]
-                obj.CHECK_RE = [[re.compile(x, re.IGNORECASE) for x in y] for y in obj.CHECK_DATA]
-                check_allmatch([obj.WHITE_HEAD_RE, obj.PRECHK_HEAD_RE, obj.WHITE_RE, obj.CHECK_HEAD_RE, obj.CHECK_RE])
+                if set(obj.REPUTATION_KEYS) - set(REP_ATTRS):
+                    raise Exception("unknown REPUTATION_KEYS: %s" % (set(obj.REPUTATION_KEYS) - set(REP_ATTRS)))
+                if obj.LOG_COMPRESS == "zstd" and zstandard is None:
+                    putlog("zstandard module is not found. LOG_COMPRESS=gzip is used.")
+                    obj.LOG_COMPRESS = "gzip"
+                obj.STATS_FILE = getattr(spam_dat, "STATS_FILE", "")
+                obj.STATS_INTERVAL = getattr(spam_dat, "STATS_INTERVAL", 60)
+                obj.RULE_OPTIMIZE = getattr(spam_dat, "RULE_OPTIMIZE", False)
+                obj.RULE_COST_FILE = getattr(spam_dat, "RULE_COST_FILE", "")
+                # 実行中の統計は再ロード後も引き継ぐため、コストファイルは起動時のみ読み込む
+                if G.STAT and obj.RULE_COST_FILE == G.RULE_COST_FILE:
+                    obj.RULE_COST = G.RULE_COST
+                else:
+                    obj.RULE_COST = obj.RULE_COST_FILE and load_rule_cost(obj.RULE_COST_FILE) or None
+                obj.RULES = load_rules(obj, obj.RULE_SNAPSHOT)
 
                 list(map(lambda kv: G.__setattr__(kv[0], kv[1]), obj.__dict__.items()))
+                reputation_init()
 
                 if G.STAT:
-                    putlog("reload done")
+                    putlog("reload done (%.3f sec, %s)" % (time.time() - t0, rules_summary(G.RULES)))
+                else:
+                    G.WATCH_FD = watch_init()
                 G.STAT = nstat
                 return
             except:
@@ -584,17 +2847,269 @@ def loadcheck_spam_dat():
                 putlog(msg)
         time.sleep(2)
 
+#   ファイルが無い場合はセグメントファイルから読み込む（LOG_WRITER）
 def load_smtpfile(f):
-    ll = []
-    for L in open(f, "rb").readlines():
-        if L[:3] == b"S: ":
-            continue
-        elif L[:3] == b"R: ":
-            ll.append(L[3:])
+    return  b"".join(smtpfile_chunks(f))
+
+# SMTP通信記録の受信側（"R: "）の内容を、DECODE_CHUNK 程度毎に返す（送信側 "S: " の行は除く）
+#   ファイルは読み込まずに mmap して、チャンク毎に変換する
+#   （変換済みの範囲はページを解放し、ファイル全体が常駐しないようにする）
+def smtpfile_chunks(f):
+    data = not os.path.exists(f) and segment_read(os.path.basename(f))
+    if data:
+        yield from transcript_chunks(data)
+        return
+    with open(f, "rb") as fobj:
+        if os.fstat(fobj.fileno()).st_size == 0:
+            return
+        with mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield from transcript_chunks(mm)
+
+def transcript_chunks(src):
+    pos = 0
+    while pos < len(src):
+        end = src.find(b'\n', pos + DECODE_CHUNK) + 1 or len(src)
+        ll = src[pos:end].split(b'\n')
+        last = ll.pop()     # 改行で終わらない最後の行（通常は空）
+        ll = [L[3:] if L[:3] == b"R: " else L for L in ll if L[:3] != b"S: "]
+        ll.append(last[3:] if last[:3] == b"R: " else b'' if last[:3] == b"S: " else last)
+        yield b'\n'.join(ll)
+        if isinstance(src, mmap.mmap) and hasattr(mmap, "MADV_DONTNEED"):
+            src.madvise(mmap.MADV_DONTNEED, pos - pos % mmap.PAGESIZE, end - pos + pos % mmap.PAGESIZE)
+        pos = end
+
+# コーパス一括検査（-c）の1ファイル分（プロセスプール内で実行）
+def corpus_check(fname):
+    t0 = time.perf_counter()
+    st = decode_init()
+    dec_data, msg_id = decode_chunks(smtpfile_chunks(fname), st)
+    try:
+        v = judge_spam(dec_data)
+    except ScanTimeout as e:
+        v = Obj(kind="timeout", name=e.name, re_i=e.re_i)
+    rule = v.name and "%s(%d)" % (v.name, v.re_i) or "-"
+    return  fname, v.kind, rule, st.size, time.perf_counter() - t0, G.RULES.CHECK_ST and stats_take()
+
+def corpus_files(args):
+    for arg in args:
+        if os.path.isdir(arg):
+            for root, dirs, files in os.walk(arg):
+                for fn in sorted(files):
+                    if fn.startswith("smtp_"):
+                        yield os.path.join(root, fn)
         else:
-            ll.append(L)
-    #open("/tmp/a.txt", "wb").write(b"".join(ll))
-    return  b"".join(ll)
+            for fn in sorted(glob.glob(arg)):
+                yield fn
+
+# 結果ファイル（ファイル名 TAB 判定 TAB ルール）の読み込み
+def load_corpus_result(fname):
+    ret = {}
+    for L in open(fname, encoding="utf8"):
+        ll = L.rstrip("\n").split("\t")
+        if len(ll) == 3:
+            ret[os.path.basename(ll[0])] = (ll[1], ll[2])
+    return ret
+
+# コーパス一括検査
+#   全コアで検査し、判定の集計・ルール毎のヒット数・処理速度・遅いメールを出力
+#   baseline（以前の -o 出力）を指定すると、判定が変わったメールのみ出力
+#   costfile を指定すると、正規表現毎のコストを保存（RULE_COST_FILE として利用可能）
+def corpus_proc(args, baseline=None, outfile=None, costfile=None, slow_num=10):
+    G.DBG = -1
+    if costfile:
+        rs = Obj(**G.RULES.__dict__)
+        build_rule_stats(rs)
+        G.RULES = rs
+    base = baseline and load_corpus_result(baseline)
+    out = outfile and open(outfile, "w", encoding="utf8")
+    kinds = {"pass": 0, "white": 0, "spam": 0, "timeout": 0}
+    rules = {}
+    slow = []
+    changed = 0
+    total = 0
+    t0 = time.perf_counter()
+
+    with multiprocessing.Pool() as pool:
+        for fname, kind, rule, size, sec, stats in pool.imap_unordered(corpus_check, corpus_files(args), 16):
+            if stats:
+                stats_merge(stats)
+            kinds[kind] += 1
+            if rule != "-":
+                rules[rule] = rules.get(rule, 0) + 1
+            total += size
+            slow = sorted(slow + [(sec, fname)], reverse=True)[:slow_num]
+            if out:
+                out.write("%s\t%s\t%s\n" % (fname, kind, rule))
+            if base is not None:
+                old = base.get(os.path.basename(fname), ("-", "-"))
+                if old != (kind, rule):
+                    changed += 1
+                    putlog("changed %s: %s %s -> %s %s" % (fname, old[0], old[1], kind, rule))
+
+    elapsed = max(time.perf_counter() - t0, 1e-6)
+    num = sum(kinds.values())
+    putlog("msgs=%d pass=%d white=%d spam=%d%s" % (num, kinds["pass"], kinds["white"], kinds["spam"],
+                                                   kinds["timeout"] and " timeout=%d" % kinds["timeout"] or ""))
+    if base is not None:
+        putlog("changed=%d" % changed)
+    putlog("%.1f msgs/sec %.2f MB/sec (%.2f sec)" % (num / elapsed, total / elapsed / 1000000, elapsed))
+    for rule, cnt in sorted(rules.items(), key=lambda x: -x[1]):
+        putlog("  %6d %s" % (cnt, rule))
+    putlog("slowest:")
+    for sec, fname in slow:
+        putlog("  %8.1f ms %s" % (sec * 1000, fname))
+    if costfile:
+        save_rule_cost(costfile, term_costs(G.RULES.RULE_STATS, load_rule_cost(costfile)))
+
+# SMTP通信記録の索引（-i で作成・追加、-w でルール案に一致する過去のメールを検索）
+#   デコード済みのメールを圧縮して保存し、trigram の転置索引（SQLite FTS5）で候補を絞り込んだ後、
+#   is_match で実際の正規表現により確認する（索引は位置情報を持たないため、絞り込みは候補の上位集合）
+#   INDEX_TEXT_MAX を超える部分は転置索引に含めず、そのようなメールは常に候補とする
+INDEX_TEXT_MAX = 4 * 1024 * 1024
+
+def index_path():
+    return  G.INDEX_FILE or logpath("transcript_index.db", False)
+
+# 索引を開く（FTS5 の trigram が使えない SQLite では fts=False で、全件を確認）
+def index_open(path):
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE IF NOT EXISTS msgs (id INTEGER PRIMARY KEY, name TEXT UNIQUE, mtime REAL,"
+               " size INTEGER, msg_id BLOB, full INTEGER, comp TEXT, data BLOB)")
+    try:
+        db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS grams USING fts5(text, content='', detail='none',"
+                   " tokenize='trigram')")
+        fts = True
+    except sqlite3.OperationalError:
+        fts = False
+    return  Obj(db=db, fts=fts)
+
+# 索引対象の SMTP通信記録（args が無ければ TMP_DIR の smtp_*.txt とセグメントファイル）
+#   (名前, ファイル, セグメント内の位置, サイズ, 圧縮方式) を返す。名前はファイル名部分
+def index_sources(args):
+    for fn in corpus_files(args or [G.TMP_DIR]):
+        yield os.path.basename(fn), fn, None, None, None
+    for ipath in [] if args else sorted(glob.glob(os.path.join(G.TMP_DIR, "seg_*.idx"))):
+        for L in open(ipath, encoding="utf8"):
+            name, off, size, comp = L.rstrip("\n").split("\t")
+            if name.startswith("smtp_"):
+                yield name, ipath[:-4] + ".dat", int(off), int(size), comp
+
+# 1件のデコード（プロセスプール内で実行）
+#   圧縮済みのデコード結果と、転置索引用のテキスト（バイト値のまま latin-1 の文字とする）を返す
+def index_decode(src):
+    name, fn, off, size, comp = src
+    try:
+        if off is None:
+            chunks = smtpfile_chunks(fn)
+        else:
+            with open(fn, "rb") as f:
+                chunks = transcript_chunks(log_decompress(os.pread(f.fileno(), size, off), comp))
+        dec_data, msg_id = decode_chunks(chunks)
+        mtime = os.path.getmtime(fn)
+    except Exception as e:
+        return  name, None, str(e)
+    dec_data = bytes(dec_data)
+    text = dec_data[:INDEX_TEXT_MAX].decode("latin-1").replace("\0", " ")
+    comp = G.LOG_COMPRESS or "gzip"
+    return  name, (mtime, len(dec_data), msg_id, len(dec_data) <= INDEX_TEXT_MAX, comp,
+                   log_compress(dec_data, comp)), text
+
+# 索引への追加（索引に無いものだけを全コアでデコード）
+def index_update(ix, args=None):
+    t0 = time.perf_counter()
+    known = {x[0] for x in ix.db.execute("SELECT name FROM msgs")}
+    srcs = []
+    for src in index_sources(args):
+        if src[0] not in known:
+            known.add(src[0])
+            srcs.append(src)
+    added = 0
+    if srcs:
+        with multiprocessing.Pool() as pool:
+            for name, ent, text in pool.imap_unordered(index_decode, srcs, 16):
+                if ent is None:
+                    putlog("index skip %s: %s" % (name, text))
+                    continue
+                cur = ix.db.execute("INSERT INTO msgs (name, mtime, size, msg_id, full, comp, data)"
+                                    " VALUES (?, ?, ?, ?, ?, ?, ?)", (name,) + ent)
+                if ix.fts:
+                    ix.db.execute("INSERT INTO grams (rowid, text) VALUES (?, ?)", (cur.lastrowid, text))
+                added += 1
+                if added % 1000 == 0:
+                    ix.db.commit()
+        ix.db.commit()
+    putlog("index added=%d msgs=%d (%.2f sec)" % (added, ix.db.execute("SELECT count(*) FROM msgs").fetchone()[0],
+                                                   time.perf_counter() - t0))
+
+# ルール案（spam_dat の1ルールと同じ書式の Python リテラル。正規表現1つのみも可）
+def whatif_rule(spec):
+    rule = ast.literal_eval(spec)
+    if type(rule) != list:
+        rule = [rule]
+    enc = lambda x: x.encode("utf8") if type(x) == str else x
+    return  [tuple(map(enc, x)) if type(x) == tuple else enc(x) for x in rule]
+
+# 転置索引の検索式（各正規表現の必須リテラルの trigram の AND。リテラルが無い正規表現は絞り込みに使えない）
+def whatif_query(re_list):
+    grams = []
+    for r in re_list:
+        lit = regex_literal(r.re if type(r) is FieldRe else r)
+        if lit is None or b'\0' in lit:
+            putlog("no literal in %s (not narrowed)" % bytes2str(term_key(r.pattern) if type(r) is FieldRe
+                                                                  else r.pattern))
+            continue
+        s = lit.decode("latin-1")
+        grams += [s[i:i + 3] for i in range(len(s) - 2)]
+    return  " AND ".join('"%s"' % x.replace('"', '""') for x in sorted(set(grams)))
+
+# 候補の確認（プロセスプール内で実行。G.WHATIF は whatif_proc で設定）
+def whatif_check(ids):
+    w = G.WHATIF
+    if w.db is None:
+        w.db = sqlite3.connect(w.path)
+    ret = []
+    for i in ids:
+        name, msg_id, comp, data = w.db.execute("SELECT name, msg_id, comp, data FROM msgs WHERE id = ?",
+                                                (i,)).fetchone()
+        data = log_decompress(data, comp)
+        idx = data.find(b'\r\n\r\n')
+        head_tg = head_target(data[:idx] if idx >= 0 else data)
+        tg = w.head_only and head_tg or scan_target(data, hdr=head_tg.hdr)
+        ret_, re_i, ms = is_match(tg, w.re_list)
+        if ret_:
+            ret.append((name, msg_id, ms))
+    return  ret, len(ids)
+
+# ルール案に一致する過去のメールの検索（head_only は CHECK_HEAD 等と同じくヘッダのみを検査）
+#   ルール案が不正（書式の誤り、全てのメールに一致する正規表現等）なら、エラーを出力して終了コード 1 で終了
+def whatif_proc(spec, args=None, head_only=False):
+    G.DBG = -1
+    try:
+        re_list = compile_rules([whatif_rule(spec)], {}, None)
+    except Exception as e:
+        putlog("error: invalid rule %s (%s)" % (spec, e))
+        sys.exit(1)
+    path = index_path()
+    ix = index_open(path)
+    index_update(ix, args)
+    t0 = time.perf_counter()
+    query = ix.fts and whatif_query(re_list[0])
+    if query:
+        ids = [x[0] for x in ix.db.execute("SELECT rowid FROM grams WHERE grams MATCH ? UNION"
+                                           " SELECT id FROM msgs WHERE full = 0", (query,))]
+    else:
+        ids = [x[0] for x in ix.db.execute("SELECT id FROM msgs")]
+    total = ix.db.execute("SELECT count(*) FROM msgs").fetchone()[0]
+    ix.db.close()
+
+    G.WHATIF = Obj(path=path, db=None, re_list=re_list, head_only=head_only)
+    hits = []
+    with multiprocessing.Pool() as pool:
+        for ret, _ in pool.imap_unordered(whatif_check, [ids[i:i + 64] for i in range(0, len(ids), 64)]):
+            hits += ret
+    for name, msg_id, ms in sorted(hits):
+        putlog(b"match %s msg_id=%s [ %s ]" % (name.encode("utf8"), msg_id, ms))
+    putlog("msgs=%d candidates=%d matched=%d (%.2f sec)" % (total, len(ids), len(hits), time.perf_counter() - t0))
 
 # フィルターメイン
 def content_filter_server():
@@ -602,7 +3117,8 @@ def content_filter_server():
 
     loadcheck_spam_dat()
 
-    optlist, args = getopt.getopt(sys.argv[1:], "vdf")
+    optlist, args = getopt.getopt(sys.argv[1:], "vdfcb:o:s:iw:H")
+    opts = dict(optlist)
     for key, _ in optlist:
         key = key.replace("-", "")
         if key == "d":
@@ -618,41 +3134,175 @@ def content_filter_server():
                 if len(val) > 10 and val.find(".") == -1:
                     val += ".txt"
                 targ = val.replace("spam_", "smtp_").replace("sdec_", "smtp_")
-                dec_data, msg_id = decode_mail(load_smtpfile(targ))
+                st = decode_init()
+                dec_data, msg_id = decode_chunks(smtpfile_chunks(targ), st)
                 if len(args) == 1:
-                    open(logpath(sdec_fname(t), is_time_zero(t)), "wb").write(dec_data)
-                is_spam(dec_data, msg_id, t, fname=val.encode("utf8"))
+                    sdec_log(dec_data, t)
+                is_spam(dec_data, msg_id, t, fname=val.encode("utf8"), skipped=skip_summary(st))
+            return
+        elif key == "c":
+            G.IS_DAEMON = False
+            corpus_proc(args, opts.get("-b"), opts.get("-o"), opts.get("-s"))
+            return
+        elif key in ("i", "w"):
+            G.IS_DAEMON = False
+            if sqlite3 is None:
+                putlog("sqlite3 module is not found.")
+            elif key == "i":
+                G.DBG = -1
+                index_update(index_open(index_path()), args)
+            else:
+                whatif_proc(opts["-w"], args, "-H" in opts)
             return
 
     if G.IS_DAEMON:
         syslog.openlog("content_filter", syslog.LOG_PID, syslog.LOG_MAIL)
-    putlog("content_filter ver%s started." % VER)
+    putlog("content_filter ver%s started. (%s)" % (VER, rules_summary(G.RULES)))
 
     def sig_func(k, s):
         raise Exception()
     signal.signal(signal.SIGTERM, sig_func)
     signal.signal(signal.SIGINT,  sig_func)
 
+    # 処理段階毎の所要時間の出力とプロファイル開始（定期処理で行う。マスターはワーカーへ転送）
+    def usr1_func(k, s):
+        G.DUMP_REQ = True
+    signal.signal(signal.SIGUSR1, usr1_func)
+
     if G.IS_DAEMON:
         daemonize()
-    _thread.start_new_thread(content_filter, (G.SRC_ADDR, G.DST_ADDR))
+
+    if G.WORKERS > 0:
+        master_proc()
+    else:
+        serve_proc(loadcheck_spam_dat)
+    putlog("content_filter terminated.")
+
+# 受付開始と、終了（SIGTERM等）までの定期処理
+def serve_proc(poll_func):
+    if G.SCAN_POOL > 0:
+        G.SCAN_EXEC = scan_pool()
+    server = G.SERVER_MODE == "async" and content_filter_async or content_filter
+    _thread.start_new_thread(server, (G.SRC_ADDR, G.DST_ADDR))
 
     try:
         while True:
-            loadcheck_spam_dat()
-            time.sleep(1)
+            poll_func()
+            stats_proc()
+            optimize_proc()
+            reputation_proc()
+            dump_proc()
+            watch_wait(1)
     except:
         pass
+    stats_proc(True)
+    optimize_proc(True)
+    reputation_proc(True)
+    log_writer_stop()
 
-    if G.THR_CNT > 0:
+    if G.ADMIT.sessions > 0:
         putlog("Wait for threads...\n")
         for i in range(60):
-            if G.THR_CNT <= 0:
+            if G.ADMIT.sessions <= 0:
                 break
             time.sleep(1)
         else:
             putlog("...timeout.")
-    putlog("content_filter terminated.")
+
+    if G.SCAN_EXEC:
+        G.SCAN_EXEC.shutdown(cancel_futures=True)
+
+# ワーカープロセス（設定の再ロードはマスターからの SIGHUP 時のみ）
+#   実行コストの検査は行わず、マスターで無効化した正規表現を使う
+def worker_proc(idx):
+    G.WORKER_IDX = idx
+    G.RULE_DISABLED = G.RULES.DISABLED
+    if G.WATCH_FD is not None:
+        os.close(G.WATCH_FD)    # 監視はマスターのみ
+        G.WATCH_FD = None
+
+    G.WAKE_FD, wake_w = os.pipe()
+    os.set_blocking(wake_w, False)
+
+    def hup_func(k, s):
+        G.RELOAD_REQ = True
+        try:
+            os.write(wake_w, b"x")
+        except OSError:
+            pass
+    signal.signal(signal.SIGHUP, hup_func)
+
+    def poll_func():
+        if G.RELOAD_REQ:
+            G.RELOAD_REQ = False
+            os.read(G.WAKE_FD, 4096)
+            try:
+                disabled = load_rule_disabled()
+            except Exception:
+                putlog(traceback.format_exc())
+                disabled = G.RULE_DISABLED
+            force = disabled != G.RULE_DISABLED
+            G.RULE_DISABLED = disabled
+            loadcheck_spam_dat(force)
+
+    putlog("worker %d started." % idx)
+    serve_proc(poll_func)
+
+# マスタープロセス（WORKERS 個のワーカーを起動・監視し、再ロードを転送）
+def master_proc():
+    if not hasattr(socket, "SO_REUSEPORT"):
+        G.LISTEN_SOCK = listen_socket(G.SRC_ADDR)
+    pids = {}
+
+    try:
+        while True:
+            for idx in range(G.WORKERS):
+                if idx in pids.values():
+                    continue
+                pid = os.fork()
+                if pid == 0:
+                    try:
+                        worker_proc(idx)
+                    finally:
+                        os._exit(0)
+                pids[pid] = idx
+
+            while pids:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    break
+                putlog("worker %d (pid=%d) exited. status=%d" % (pids.pop(pid), pid, status))
+
+            stat = G.STAT
+            loadcheck_spam_dat()
+            if G.STAT is not stat:
+                try:
+                    save_rule_disabled(G.RULES.DISABLED)
+                except Exception:
+                    putlog(traceback.format_exc())
+                for pid in pids:
+                    os.kill(pid, signal.SIGHUP)
+            if G.DUMP_REQ:
+                G.DUMP_REQ = False
+                for pid in pids:
+                    os.kill(pid, signal.SIGUSR1)
+            watch_wait(1)
+    except:
+        pass
+
+    for pid in pids:
+        os.kill(pid, signal.SIGTERM)
+    for i in range(65):
+        while pids:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            pids.pop(pid, None)
+        if not pids:
+            break
+        time.sleep(1)
+    else:
+        putlog("...timeout.")
 
 if __name__ == "__main__":
     content_filter_server()
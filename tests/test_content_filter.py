@@ -0,0 +1,576 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# content_filter の回帰テスト
+#  - CfTest : bench/benchlib の SmtpSink / CfServer で content_filter.py を起動し、SMTP セッションの応答を確認
+#  - load   : 一時ディレクトリの spam_dat.py で content_filter をこのプロセスに読み込み、判定関数を直接呼ぶ
+#
+#   python3 -m pytest tests   （又は python3 -m unittest discover tests）
+#
+
+import os
+import sys
+import json
+import pickle
+import re
+import base64
+import quopri
+import random
+import time
+import fcntl
+import select
+import socket
+import subprocess
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+import benchlib
+
+DAT_DIR = tempfile.mkdtemp(prefix="cftest_")
+
+# 設定を上書きした spam_dat.py を（再）読み込みした content_filter を返す
+def load(**conf):
+    benchlib.write_spam_dat(DAT_DIR, DBG=0, TMP_DIR=os.path.join(DAT_DIR, "log"), **conf)
+    if DAT_DIR not in sys.path:
+        sys.path[:0] = [DAT_DIR, ROOT]
+    sys.dont_write_bytecode = True
+    import content_filter
+    content_filter.G.STAT = None
+    content_filter.loadcheck_spam_dat()
+    return  content_filter
+
+class CfTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.sink = benchlib.SmtpSink()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sink.shutdown()
+        cls.sink.server_close()
+
+    def server(self, **conf):
+        srv = benchlib.CfServer(self.sink.server_address, **conf)
+        self.addCleanup(srv.stop)
+        return srv
+
+    def reply(self, srv, mail, **kw):
+        return benchlib.smtp_session(srv.addr, mail, **kw)[1][:1]
+
+class VerdictCacheTest(unittest.TestCase):
+    # キャッシュのキーから除く行（To:）に依存するルールで、別の宛先の同じメールが誤判定されないこと
+    def check_rule(self, rule):
+        cf = load(VERDICT_CACHE=100, CHECK_DATA=[[rule]])
+        mail = benchlib.gen_mail(2000, b"hi")
+        judge = lambda to: cf.judge_spam(bytearray(mail.replace(b"To: b@bench.example", b"To: " + to))).kind
+        self.assertEqual(judge(b"bob@evil.example"), "spam")
+        self.assertEqual(judge(b"alice@evil.example"), "pass")
+        self.assertEqual(judge(b"bob@evil.example"), "spam")
+
+    # 次の行に跨るもの
+    def test_rule_spanning_ignored_line(self):
+        self.check_rule(rb"bob@evil\.example\r\nSubject: hi")
+
+    # 除いた行から本文まで跨るもの
+    def test_rule_spanning_into_body(self):
+        self.check_rule(rb"To: bob@evil\.example[\s\S]*consectetur")
+
+    # 除いた行を後読みするもの
+    def test_lookbehind_on_ignored_line(self):
+        self.check_rule(rb"(?<=To: bob@evil\.example\r\n)Subject")
+
+class HeadVerdictTest(unittest.TestCase):
+    HEAD_RULES = dict(WHITE_HEAD=[[rb"(?m)^From: .*@white\.example"]], PRECHK_HEAD=[[rb"Received-SPF: fail"]],
+                      CHECK_HEAD=[[rb"Subject: .*(offer|deal)"], [rb"^MAIL FROM:<spam@"]], CHECK_DATA=[[rb"bitcoin"]])
+
+    def mails(self, n=300):
+        rnd = random.Random(1)
+        for _ in range(n):
+            hdr = [b"MAIL FROM:<%s@b.example>" % rnd.choice([b"a", b"spam"]),
+                   b"Received-SPF: " + rnd.choice([b"pass", b"fail", b"softfail"]),
+                   b"From: x@" + rnd.choice([b"white.example", b"other.example"]),
+                   b"Subject: " + rnd.choice([b"hello", b"special offer", b"good deal", b"news"])]
+            body = [rnd.choice([b"hello world", b"buy bitcoin now", b"regards"]) for _ in range(3)]
+            yield b"\r\n".join(hdr + [b""] + body + [b""])
+
+    # ヘッダのみで確定した判定（judge_head）が、メール全体での判定と同じであること
+    def check_rules(self, **rules):
+        cf = load(**rules)
+        decided = 0
+        for mail in self.mails():
+            head = mail[:mail.find(b"\r\n\r\n")]
+            v = cf.judge_head(cf.head_target(head))
+            if v:
+                full = cf.judge_spam(bytearray(mail))
+                self.assertEqual((v.kind, v.name, v.re_i), (full.kind, full.name, full.re_i), mail)
+                decided += 1
+        self.assertGreater(decided, 0)
+
+    def test_same_verdict_as_full_scan(self):
+        self.check_rules(**self.HEAD_RULES)
+
+    # WHITE_DATA があれば CHECK_HEAD では確定しない
+    def test_same_verdict_with_white_data(self):
+        self.check_rules(WHITE_DATA=[[rb"regards"]], **self.HEAD_RULES)
+
+class DecodeChunkTest(unittest.TestCase):
+    TEXT = "日本語の本文 café résumé 0123456789 ".encode("utf8") * 40
+
+    def mails(self):
+        b64 = base64.encodebytes(self.TEXT).replace(b"\n", b"\r\n")
+        qp = quopri.encodestring(self.TEXT + b"\r\nsoft=line " * 20).replace(b"\n", b"\r\n")
+        head = (b"Message-ID: <chunk@example>\r\nSubject: =?UTF-8?B?5pel5pys6Kqe?=\r\n"
+                b"To: a@example,\r\n\tb@example\r\n")
+        yield head + b"Content-Transfer-Encoding: base64\r\n\r\n" + b64
+        yield head + b"Content-Transfer-Encoding: quoted-printable\r\n\r\n" + qp
+        yield (head + b'Content-Type: multipart/mixed; boundary="outer"\r\n\r\npreamble\r\n'
+               b"--outer\r\nContent-Type: text/plain\r\nContent-Transfer-Encoding: base64\r\n\r\n" + b64 +
+               b'--outer\r\nContent-Type: multipart/alternative; boundary="inner"\r\n\r\n'
+               b"--inner\r\nContent-Type: text/html\r\nContent-Transfer-Encoding: quoted-printable\r\n\r\n" + qp +
+               b"--inner--\r\n--outer\r\nContent-Type: application/octet-stream\r\n"
+               b"Content-Transfer-Encoding: base64\r\n\r\n" + b64 + b"--outer--\r\n")
+
+    def splits(self, mail, rnd):
+        i = 0
+        while i < len(mail):
+            n = rnd.choice([1, 2, 3, 5, 76, 77, 1000, rnd.randint(1, 300)])
+            yield mail[i:i + n]
+            i += n
+
+    # ランダムなチャンク分割での decode_feed の結果が、メール全体のデコードとバイト単位で一致すること
+    def test_random_splits(self):
+        cf = load()
+        rnd = random.Random(3)
+        for mail in self.mails():
+            whole, msg_id = cf.decode_mail(mail)
+            self.assertIn("本文".encode("utf8"), whole)
+            self.assertEqual(msg_id, b"<chunk@example>")
+            for _ in range(50):
+                st = cf.decode_init()
+                for data in self.splits(mail, rnd):
+                    cf.decode_feed(st, data)
+                self.assertEqual(cf.decode_head(st) + b"\r\n\r\n", whole[:whole.find(b"\r\n\r\n") + 4])
+                self.assertEqual(cf.decode_finish(st), (whole, msg_id))
+                self.assertEqual(cf.decode_finish(st, True), (whole, msg_id))
+
+    # inplace の結果を decode_restore で戻せば、続けてデコードした結果が全体のデコードと一致すること
+    def test_restore_after_inplace(self):
+        cf = load()
+        for mail in self.mails():
+            acct = cf.Obj(cap=0, used=0, total=0)
+            st = cf.decode_init(acct)
+            cf.decode_feed(st, mail)
+            used = acct.used
+            msg, _ = cf.decode_finish(st, True)
+            self.assertEqual(msg, cf.decode_mail(mail)[0])
+            self.assertEqual(acct.used, 0)
+            cf.decode_restore(st, msg)
+            self.assertEqual(acct.used, used)
+            more = b"\r\n.\r\nMAIL FROM:<a@example>\r\nDATA\r\nSubject: next\r\n\r\nsecond body\r\n"
+            cf.decode_feed(st, more)
+            self.assertEqual(cf.decode_finish(st, True)[0], cf.decode_mail(mail + more)[0])
+
+class FieldReTest(unittest.TestCase):
+    # (フィールド名, 正規表現, ヘッダ全体を対象とする同等の正規表現)
+    CASES = [(b"Subject", rb"^\[?ad", rb"(?m)^(?i:subject):[ \t]*\[?ad"),
+             (b"to", rb"bob@evil\.example", rb"(?m)^(?i:to):(?:.|\r\n[ \t])*bob@evil\.example"),
+             (b"X-Mailer:", rb"(?i)mass ?mail", rb"(?im)^x-mailer:.*mass ?mail"),
+             (b"RECEIVED", rb"(?m)^from evil", rb"(?m)^(?i:received):[ \t]*from evil"),
+             (b"Subject", rb"ad.*sale", rb"(?m)^(?i:subject):.*ad.*sale")]
+
+    def heads(self, n=400):
+        rnd = random.Random(4)
+        for _ in range(n):
+            ll = [b"MAIL FROM:<a@example>"]
+            for _ in range(rnd.randint(0, 2)):
+                ll.append(rnd.choice([b"Subject", b"subject", b"SUBJECT"]) + b": " +
+                          rnd.choice([b"[ad] big sale", b"ad sale", b"hello", b"about ads", b"[AD] sale"]))
+            to = rnd.choice([b"alice@example", b"bob@evil.example", b"BOB@EVIL.EXAMPLE"])
+            ll.append(rnd.choice([b"To: carol@example, " + to, b"To: carol@example,\r\n\t" + to,
+                                  b"to:\r\n " + to + b",\r\n dave@example"]))
+            for _ in range(rnd.randint(0, 3)):
+                ll.append(rnd.choice([b"Received", b"received"]) + b": " +
+                          rnd.choice([b"from evil.example", b"from good.example", b"by evil.example"]) +
+                          rnd.choice([b"", b"\r\n\tby mx.example"]))
+            if rnd.random() < 0.5:
+                ll.append(rnd.choice([b"X-Mailer", b"x-mailer"]) + b": " + rnd.choice([b"Mass Mail 1.0", b"mutt"]))
+            rnd.shuffle(ll)
+            yield b"\r\n".join(ll)
+
+    # 継続行・同名フィールドの複数回・フィールド名の大小文字で、同等の正規表現と結果が一致すること
+    def test_same_as_plain_regex(self):
+        cf = load()
+        hits = set()
+        for head in self.heads():
+            hdr = cf.header_ref(head)
+            for i, (field, pat, plain) in enumerate(self.CASES):
+                fr = cf.FieldRe(field, re.compile(pat))
+                ret = re.search(plain, head) is not None
+                self.assertEqual(fr.search(hdr) is not None, ret, (field, pat, head))
+                self.assertEqual(fr.search(head) is not None, ret, (field, pat, head))
+                if ret:
+                    hits.add(i)
+        self.assertEqual(hits, set(range(len(self.CASES))))
+
+    def test_values(self):
+        cf = load()
+        idx = cf.header_index(b"Subject: a\r\nsubject: =?UTF-8?B?5pel5pys6Kqe?=\r\nTo: x,\r\n\ty\r\nbody")
+        self.assertEqual(idx[b"subject"], [b"a", "日本語".encode("utf8")])
+        self.assertEqual(idx[b"to"], [b"x,\ty"])
+        self.assertIsNone(cf.FieldRe(b"Cc", re.compile(rb".")).search(cf.header_ref(b"To: x")))
+
+class PartPolicyTest(unittest.TestCase):
+    def mail(self):
+        return (b'Subject: parts\r\nContent-Type: multipart/mixed; boundary="b"\r\n\r\n'
+                b"This is a multi-part message in MIME format.\r\n"
+                b"--b\r\nContent-Type: text/plain\r\n\r\n" + b"text-line-1\r\n" * 3 +
+                b"--b\r\nContent-Type: image/png; name=x.png\r\nContent-Transfer-Encoding: base64\r\n\r\n" +
+                base64.encodebytes(b"png-body" * 20).replace(b"\n", b"\r\n") +
+                b"--b\r\nContent-Type: text/html\r\n\r\n" + b"html-line-3\r\n" * 3 + b"--b--\r\n")
+
+    def decode(self, **conf):
+        cf = load(**conf)
+        st = cf.decode_init()
+        msg, _ = cf.decode_mail(self.mail(), st)
+        return  cf, bytes(msg), cf.skip_summary(st)
+
+    def test_none(self):
+        cf, msg, skip = self.decode()
+        self.assertIsNone(cf.G.PART_POLICY)
+        self.assertEqual((msg.count(b"text-line"), msg.count(b"png-body"), msg.count(b"html-line")), (3, 20, 3))
+        self.assertEqual(skip, b"")
+
+    # 対象外の Content-Type は本文のみ除き（ヘッダは残す）、プリアンブルは skip に含めない
+    def test_scan_types(self):
+        cf, msg, skip = self.decode(SCAN_TYPES=["text/"])
+        self.assertEqual((msg.count(b"text-line"), msg.count(b"png-body"), msg.count(b"html-line")), (3, 0, 3))
+        self.assertIn(b"name=x.png", msg)
+        self.assertNotIn(b"multi-part message", msg)
+        self.assertEqual(skip, b" skip=<2:image/png>")
+
+    def test_scan_types_judge(self):
+        cf = load(SCAN_TYPES=["text/html"], CHECK_DATA=[[rb"png-body"]])
+        self.assertFalse(cf.judge_spam(cf.decode_mail(self.mail())[0]).name)
+        cf = load(SCAN_TYPES=None, CHECK_DATA=[[rb"png-body"]])
+        self.assertEqual(cf.judge_spam(cf.decode_mail(self.mail())[0]).name, "CHECK_DATA")
+
+    # パート毎の上限は、上限に達した後の行をそのパートについてのみ除く
+    def test_part_scan_max(self):
+        cf, msg, skip = self.decode(PART_SCAN_MAX=20)
+        self.assertEqual((msg.count(b"text-line"), msg.count(b"html-line")), (2, 2))
+        self.assertEqual(skip, b" skip=<1:text/plain(+13) 2:image/png(+%d) 3:text/html(+13)>"
+                         % sum(len(x) + 2 for x in base64.encodebytes(b"png-body" * 20).split(b"\n")[1:-1]))
+
+    # メール全体の上限は、以降の全パートの本文を除く
+    def test_msg_scan_max(self):
+        cf, msg, skip = self.decode(MSG_SCAN_MAX=80)
+        self.assertEqual((msg.count(b"text-line"), msg.count(b"png-body"), msg.count(b"html-line")), (3, 0, 0))
+        self.assertIn(b"This is a multi-part message", msg)
+        self.assertRegex(skip, rb"^ skip=<2:image/png\(\+\d+\) 3:text/html\(\+39\)>$")
+
+class PrefilterTest(unittest.TestCase):
+    RULES = [[rb"viagra|cialis"], [rb"(?:free )?money"], [rb"Cheap (watches)?rolex"], [rb"(?i)WINNER"],
+             [rb"(?i:lottery) results"], [rb"[a-z]+@[a-z]+\.example"], [rb"^\d{4,}$"], [rb"(?:abc){0,2}xyz"],
+             [rb"(?!spam)[a-z]{4}prize"], [rb"bank", rb"(?i)account"], [rb"(?m)^Subject: (re: )*urgent"],
+             [rb"unsubscribe\s+here"]]
+    WORDS = [b"viagra", b"CIALIS", b"free", b"money", b"Money", b"cheap", b"Cheap", b"watches", b"rolex", b"winner",
+             b"WiNnEr", b"LOTTERY", b"results", b"bob@evil.example", b"12345", b"abcxyz", b"xyz", b"spamprize",
+             b"megaprize", b"bank", b"ACCOUNT", b"\r\nSubject: re: urgent", b"unsubscribe", b"here", b"\r\n"]
+
+    def mails(self, n=500):
+        rnd = random.Random(2)
+        for _ in range(n):
+            yield b" ".join(rnd.choice(self.WORDS) for _ in range(rnd.randint(1, 8)))
+
+    # 前置フィルタの有無で、ルール毎の is_match の結果が変わらないこと
+    def check_same(self, cf):
+        rs = cf.G.RULES
+        re_list, pf_list = rs.CHECK_RE, rs.CHECK_PF
+        self.assertTrue(any(pf_list))
+        hits = set()
+        for data in self.mails():
+            for i, ll in enumerate(re_list):
+                ret = cf.is_match(cf.scan_target(data), [ll])
+                self.assertEqual(ret, cf.is_match(cf.scan_target(data, lits=rs.LITERALS), [ll], [pf_list[i]]), (ll, data))
+                if ret[0]:
+                    hits.add(i)
+            self.assertEqual(cf.is_match(cf.scan_target(data), re_list),
+                             cf.is_match(cf.scan_target(data, lits=rs.LITERALS), re_list, pf_list), data)
+        self.assertEqual(hits, set(range(len(re_list))))
+
+    def test_same_result(self):
+        self.check_same(load(CHECK_DATA=self.RULES))
+
+    # 小文字化コピーを作らない巨大なメールの経路（リテラルの一括検索、チャンク境界を含む）
+    def test_same_result_chunked(self):
+        cf = load(CHECK_DATA=self.RULES)
+        with mock.patch.object(cf, "LOWER_COPY_MAX", 0), mock.patch.object(cf, "DECODE_CHUNK", 7):
+            self.check_same(cf)
+
+    def test_literals(self):
+        cf = load(CHECK_DATA=self.RULES)
+        lits = [(), (b"money",), (b"cheap ",), (b"winner",), (b" results",), (b".example",), (), (b"xyz",),
+                (b"prize",), (b"bank", b"account"), (b"subject: ",), (b"unsubscribe",)]
+        self.assertEqual(list(map(set, cf.G.RULES.CHECK_PF)), list(map(set, lits)))
+
+class AdmissionTest(CfTest):
+    def connect(self, srv):
+        c = socket.create_connection(srv.addr)
+        c.settimeout(10)
+        f = c.makefile("rb")
+        self.addCleanup(c.close)
+        self.addCleanup(f.close)
+        return  c, f
+
+    def greeting(self, c, f, wait=0.0):
+        if wait and not select.select([c], [], [], wait)[0]:
+            return  None
+        return  f.readline()
+
+    # 上限に達したら行列で待ち（行列も満杯なら 421）、先のセッションの終了（admit_leave）で起こされること
+    def check_queue(self, mode):
+        srv = self.server(SERVER_MODE=mode, MAX_SESSIONS=1, ADMIT_QUEUE=1, ADMIT_WAIT=10)
+        c1, f1 = self.connect(srv)
+        self.assertEqual(self.greeting(c1, f1)[:3], b"220")
+        c2, f2 = self.connect(srv)
+        self.assertIsNone(self.greeting(c2, f2, 0.5))
+        c3, f3 = self.connect(srv)
+        self.assertEqual(self.greeting(c3, f3)[:3], b"421")
+        t0 = time.monotonic()
+        f1.close()
+        c1.close()
+        self.assertEqual(self.greeting(c2, f2, 5)[:3], b"220")
+        self.assertLess(time.monotonic() - t0, 2)
+
+    def test_session_queue_thread(self):
+        self.check_queue("thread")
+
+    def test_session_queue_async(self):
+        self.check_queue("async")
+
+    # 全セッションのメモリ量が TOTAL_MEM_CAP の 3/4 以上の間は新しいセッションに 421 を返し、減れば受け付けること
+    def test_total_mem_cap(self):
+        srv = self.server(TOTAL_MEM_CAP=200000, ADMIT_WAIT=0.2)
+        c1, f1 = self.connect(srv)
+        self.greeting(c1, f1)
+        for cmd in (b"EHLO bench.example", b"MAIL FROM:<a@bench.example>", b"RCPT TO:<b@bench.example>", b"DATA"):
+            c1.sendall(cmd + b"\r\n")
+            while f1.readline()[3:4] == b"-":
+                pass
+        c1.sendall(benchlib.gen_mail(160000))
+        time.sleep(0.5)
+        c2, f2 = self.connect(srv)
+        self.assertEqual(self.greeting(c2, f2)[:3], b"421")
+        c1.sendall(b".\r\n")
+        self.assertEqual(f1.readline()[:1], b"2")
+        f1.close()
+        c1.close()
+        time.sleep(0.3)
+        c3, f3 = self.connect(srv)
+        self.assertEqual(self.greeting(c3, f3)[:3], b"220")
+
+    # 同時検査数の上限では、空き待ちの検査が admit_leave で起こされ、待っても空かなければ Overload（451）
+    def test_scan_wait_and_overload(self):
+        cf = load(MAX_SCANS=1, ADMIT_WAIT=0.3)
+        self.assertTrue(cf.admit_enter("scans"))
+        got = []
+        th = threading.Thread(target=lambda: got.append((cf.admit_enter("scans", 5), time.monotonic())))
+        th.start()
+        time.sleep(0.2)
+        t0 = time.monotonic()
+        cf.admit_leave("scans")
+        th.join(5)
+        self.assertTrue(got[0][0])
+        self.assertLess(got[0][1] - t0, 0.5)
+
+        rejected = cf.G.ADMIT.scans_rejected
+        with self.assertRaises(cf.Overload) as e:
+            cf.scan_proc(cf.Obj(verdict=None))
+        cf.admit_leave("scans")
+        self.assertEqual(e.exception.reply[:3], b"451")
+        self.assertEqual(cf.G.ADMIT.scans_rejected, rejected + 1)
+        self.assertEqual(cf.G.ADMIT.scans, 0)
+
+class ReputationTest(CfTest):
+    # 評価の良い接続元（CHECK_DATA を省略）からの spam は REPUTATION_RECHECK 件目で検出され、以後は省略しないこと
+    def test_good_client_sending_spam(self):
+        srv = self.server(REPUTATION_SIZE=100, REPUTATION_GOOD=2, REPUTATION_RECHECK=3, CHECK_DATA=[[b"viagra"]])
+        clean, spam = benchlib.gen_mail(2000, b"hello"), benchlib.gen_mail(2000, b"viagra now")
+        replies = [self.reply(srv, m) for m in (clean, clean, spam, spam, spam, spam)]
+        self.assertEqual(replies, [b"2", b"2", b"2", b"2", b"5", b"5"])
+
+class RuleCostTest(CfTest):
+    # RULE_COST_ACTION の変更が再ロードで適用され、SCAN_POOL のプロセスも親プロセスの判定に従うこと
+    def test_action_change_applies_on_reload(self):
+        srv = self.server(SCAN_POOL=1, RULE_COST_MAX=0.001, RULE_COST_ACTION="reject", CHECK_DATA=[[rb"a.*z"]])
+        mail = benchlib.gen_mail(2000, b"a zz")
+        self.assertEqual(self.reply(srv, mail), b"2")
+        for action, ret in (("flag", b"5"), ("reject", b"2")):
+            with open(os.path.join(srv.tmp.name, "spam_dat.py"), "a", encoding="utf8") as f:
+                f.write("RULE_COST_ACTION = %r\n" % action)
+            time.sleep(0.5)
+            self.assertEqual(self.reply(srv, mail), ret)
+
+class RuleOrderTest(CfTest):
+    # SCAN_POOL 指定時も、プールの統計で親プロセスが評価順を最適化し、プールのプロセスがその順で評価すること
+    #   （常にマッチする正規表現より、マッチしない正規表現を先に評価するようになり、前者の評価回数が増えなくなる）
+    def test_order_changes_under_scan_pool(self):
+        cost_file = os.path.join(DAT_DIR, "order_cost.json")
+        hit, miss = rb"[a-z]+ [a-z]+", rb"\d{30}"
+        srv = self.server(SCAN_POOL=1, RULE_OPTIMIZE=True, RULE_COST_FILE=cost_file, STATS_INTERVAL=1,
+                          CHECK_DATA=[[hit, miss]])
+        mail = benchlib.gen_mail(2000)
+        evals = []
+        for _ in range(2):
+            for _ in range(25):
+                self.assertEqual(self.reply(srv, mail), b"2")
+            time.sleep(2.5)
+            with open(cost_file, encoding="utf8") as f:
+                d = json.load(f)["data"]
+            evals.append((d[hit.decode()][0], d[miss.decode()][0]))
+        # 評価順は1回目の途中でも更新されうるため、1回目はマッチしない正規表現の評価回数のみ確かめる
+        self.assertEqual(evals[0][1], 25)
+        self.assertLess(evals[1][0], 40)
+        self.assertEqual(evals[1][1], 50)
+
+class RuleCompileTest(unittest.TestCase):
+    # RULE_SNAPSHOT が無ければ re.compile でコンパイルし、大文字小文字の違いのみの正規表現は共有すること
+    def test_compile_without_snapshot(self):
+        cf = load(RULE_SNAPSHOT="", CHECK_DATA=[[rb"Viagra\d"], [rb"viagra\d", rb"VIAGRA\D"]])
+        self.assertTrue(all(ent.code is None for ent in cf.G.RE_CACHE.values()))
+        (a,), (b, c) = cf.G.RULES.CHECK_RE
+        self.assertIs(a, b)
+        self.assertIsNot(a, c)
+
+    def load_snapshot(self, ver, snap, **conf):
+        path = os.path.join(DAT_DIR, "rule_snapshot.pickle")
+        with open(path, "wb") as f:
+            pickle.dump((ver, snap), f)
+        load().G.RE_CACHE = {}
+        return  path, load(RULE_SNAPSHOT=path, **conf)
+
+    # 別の Python のバージョンで作られたスナップショットは使わず re.compile でコンパイルし、次回の起動時に作り直すこと
+    def test_snapshot_from_other_version(self):
+        pat = rb"viagra\d"
+        bad = ((0, [1, 2, 3], 0, {}, (None,)), b"viagra", 0.5, 1.0)
+        path, cf = self.load_snapshot(("2.7.18 (default)", 0), {pat: bad}, CHECK_DATA=[[pat]])
+        self.assertIsNone(cf.G.RE_CACHE[pat].code)
+        self.assertIsNone(cf.G.RE_CACHE[pat].cost)
+        self.assertEqual(cf.judge_spam(bytearray(b"Subject: x\r\n\r\nVIAGRA1\r\n")).name, "CHECK_DATA")
+        with open(path, "rb") as f:
+            self.assertEqual(pickle.load(f), (cf.snapshot_version(), {}))
+
+        cf.G.RE_CACHE = {}
+        cf = load(RULE_SNAPSHOT=path, CHECK_DATA=[[pat]])
+        self.assertEqual(cf.judge_spam(bytearray(b"Subject: x\r\n\r\nVIAGRA1\r\n")).name, "CHECK_DATA")
+        with open(path, "rb") as f:
+            ver, snap = pickle.load(f)
+        self.assertEqual(ver, cf.snapshot_version())
+        self.assertEqual(pat in snap, cf.G.RE_CACHE[pat].code is not None)
+
+    # 同じバージョンでも内部表現から復元できない項目はコンパイルし直すこと
+    def test_snapshot_bad_entry(self):
+        cf = load()
+        pat = rb"viagra\d"
+        path, cf = self.load_snapshot(cf.snapshot_version(), {pat: (("bad",), b"viagra")}, CHECK_DATA=[[pat]])
+        self.assertEqual(cf.judge_spam(bytearray(b"Subject: x\r\n\r\nviagra2\r\n")).name, "CHECK_DATA")
+        self.assertNotEqual(cf.G.RE_CACHE[pat].code, ("bad",))
+
+def tcp_pair():
+    with socket.create_server(("127.0.0.1", 0)) as ls:
+        c = socket.create_connection(ls.getsockname())
+        return  c, ls.accept()[0]
+
+class WhatifTest(CfTest):
+    # 通信記録を -i で索引に追加し、-w（-H）で一致するメールが出力されること
+    def test_index_and_whatif(self):
+        srv = self.server(DBG=2)
+        for subject in (b"hello", b"bitcoin invoice", b"Invoice", b"news"):
+            self.assertEqual(self.reply(srv, benchlib.gen_mail(2000, subject)), b"2")
+        time.sleep(0.3)
+        run = lambda *args: subprocess.run([sys.executable, benchlib.CF_PATH] + list(args), capture_output=True,
+                                           env=dict(os.environ, PYTHONPATH=srv.tmp.name), timeout=60)
+        p = run("-i")
+        self.assertEqual(p.returncode, 0)
+        self.assertIn(b"index added=4 msgs=4", p.stdout)
+
+        p = run("-w", "[rb'bitcoin', ('Subject', rb'invoice')]")
+        self.assertEqual(p.returncode, 0)
+        self.assertEqual(p.stdout.count(b"match smtp_"), 1)
+        self.assertIn(b"[ bitcoin, invoice ]", p.stdout)
+        self.assertIn(b"msgs=4", p.stdout)
+
+        p = run("-w", "rb'(?m)^Subject: .*invoice'", "-H")
+        self.assertEqual(p.stdout.count(b"match smtp_"), 2)
+        p = run("-w", "rb'Lorem ipsum'", "-H")
+        self.assertEqual(p.stdout.count(b"match smtp_"), 0)
+        p = run("-w", "rb'Lorem ipsum'")
+        self.assertEqual(p.stdout.count(b"match smtp_"), 4)
+        self.assertIn(b"index added=0 msgs=4", p.stdout)
+
+    # 全てのメールに一致する正規表現や書式の誤りは、トレースバックではなくエラーと終了コード 1
+    def test_whatif_invalid_rule(self):
+        srv = self.server(DBG=2)
+        for spec in ("[rb'Subject', rb'.']", "rb'('", "[rb'Subj"):
+            p = subprocess.run([sys.executable, benchlib.CF_PATH, "-w", spec], capture_output=True,
+                               env=dict(os.environ, PYTHONPATH=srv.tmp.name), timeout=60)
+            self.assertEqual(p.returncode, 1, spec)
+            self.assertIn(b"error: invalid rule", p.stdout)
+            self.assertNotIn(b"Traceback", p.stdout + p.stderr)
+
+class LogWriterTest(unittest.TestCase):
+    # 通信記録（メモリ上・一時ファイルへ退避済みの spool）を分割して圧縮し、セグメントから元の内容で読めること
+    def test_stream_spool(self):
+        for comp in ("", "gzip"):
+            cf = load(LOG_WRITER=True, LOG_COMPRESS=comp)
+            for cap in (0, 1000):
+                acct = cf.Obj(cap=cap, used=0, total=0)
+                sp = cf.spool_init(acct)
+                data = [os.urandom(700) for _ in range(20)]
+                for x in data:
+                    cf.spool_write(sp, x)
+                self.assertEqual(sp.f is not None, cap > 0)
+                t = cf.Obj(t=int(time.time()), idx=cap + len(comp))
+                with mock.patch.object(cf, "DECODE_CHUNK", 1024):
+                    cf.write_log(t, sp, b"<id>", head=b"HEAD\r\n", tail=b"TAIL\r\n")
+                    self.assertEqual((sp.size, acct.used), (0, 0))
+                    cf.log_writer_stop()
+                cf.G.LOG_QUEUE = None
+                self.assertEqual(cf.segment_read(cf.smtp_fname(t)), b"HEAD\r\n" + b"".join(data) + b"TAIL\r\n")
+
+class SpliceTest(unittest.TestCase):
+    # 短いパイプ・満杯の中継先で splice が EAGAIN となっても、セッションのエラーにせず全て中継すること
+    @unittest.skipUnless(hasattr(os, "splice"), "splice is not available")
+    def test_short_pipe(self):
+        cf = load(RELAY_SPLICE=True)
+        param = cf.session_param(None)
+        param.pipe = os.pipe()
+        fcntl.fcntl(param.pipe[1], getattr(fcntl, "F_SETPIPE_SZ", 1031), 4096)
+        (peer, src), (dst, sink) = tcp_pair(), tcp_pair()
+        for x in (peer, src, dst, sink):
+            self.addCleanup(x.close)
+        src.setblocking(False)
+        dst.setblocking(False)
+        dst.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        self.assertEqual(cf.relay_splice(param, src.fileno(), dst.fileno()), -1)
+
+        data = os.urandom(1024 * 1024)
+        got = bytearray()
+        def recv_all():
+            while len(got) < len(data):
+                got.extend(sink.recv(65536))
+        reader = threading.Thread(target=recv_all)
+        reader.start()
+        threading.Thread(target=peer.sendall, args=(data,)).start()
+        while param.spliced < len(data):
+            select.select([src], [], [], 5)
+            self.assertNotIn(cf.relay_splice(param, src.fileno(), dst.fileno()), (0, None))
+        reader.join(5)
+        self.assertEqual(got, data)
+
+if __name__ == "__main__":
+    unittest.main()